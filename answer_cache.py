@@ -0,0 +1,166 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# On-disk cache of answers keyed by the standalone (contextualized) question. Lookups compare
+# the question embedding against stored ones, so paraphrases of a question asked before are
+# answered without retrieval or generation. Entries are tied to the model and to the version
+# of the keyword collection they were generated from.
+ANSWER_CACHE_PATH = "./cache/answer_cache.sqlite3"
+ANSWER_CACHE_SIMILARITY = 0.95  # cosine similarity needed for a hit
+ANSWER_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+ANSWER_CACHE_MAX_ENTRIES = 2000
+
+
+class CachedAnswer:
+    def __init__(self, question, answer, documents, similarity):
+        self.question = question
+        self.answer = answer
+        self.documents = documents
+        self.similarity = similarity
+
+
+def documents_to_json(documents):
+    return json.dumps([{'id': getattr(doc, 'id', None), 'page_content': doc.page_content, 'metadata': doc.metadata}
+                       for doc in documents])
+
+
+def documents_from_json(data):
+    from langchain_core.documents import Document
+
+    return [Document(**doc) for doc in json.loads(data)]
+
+
+class AnswerCache:
+    def __init__(self, path=ANSWER_CACHE_PATH, collection_version='', similarity=ANSWER_CACHE_SIMILARITY,
+                 ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        # collection_version is the version string, or a function returning the current one, so a
+        # collection updated while the app runs is noticed on the next lookup
+        self.get_collection_version = collection_version if callable(collection_version) else lambda: collection_version
+        self.collection_version = self.get_collection_version()
+        self.similarity = similarity
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                question TEXT NOT NULL,
+                model TEXT NOT NULL,
+                collection_version TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                documents TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+        # A rebuilt keyword collection invalidates every answer generated from the old one
+        self._db.execute("DELETE FROM answers WHERE collection_version != ?", (self.collection_version,))
+        self._db.commit()
+        self._data_version = None
+        self._dirty = True
+        self._ids = []
+        self._models = []
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def _refresh(self):
+        # Keep normalised embeddings in memory; reload only when the answers changed. data_version
+        # tracks commits by other connections (e.g. other server processes), _dirty our own writes.
+        data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version and not self._dirty:
+            return
+        rows = self._db.execute("SELECT id, model, embedding FROM answers").fetchall()
+        self._ids = [row[0] for row in rows]
+        self._models = [row[1] for row in rows]
+        if rows:
+            matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            self._matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        else:
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._data_version = data_version
+        self._dirty = False
+
+    def _check_version(self):
+        version = self.get_collection_version()
+        if version != self.collection_version:
+            print(f"Keyword collection changed ({self.collection_version} -> {version}), dropping cached answers")
+            self.collection_version = version
+            self._db.execute("DELETE FROM answers WHERE collection_version != ?", (version,))
+            self._dirty = True
+
+    def _count(self, name):
+        self._db.execute("INSERT INTO stats (name, value) VALUES (?, 1) "
+                         "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def lookup(self, question, embedding, model):
+        with self._lock:
+            self._check_version()
+            self._evict()
+            self._refresh()
+            best_id, best_similarity = None, 0.0
+            if self._ids:
+                query = np.asarray(embedding, dtype=np.float32)
+                similarities = self._matrix @ (query / max(np.linalg.norm(query), 1e-12))
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.similarity:
+                        break
+                    if self._models[i] == model:
+                        best_id, best_similarity = self._ids[i], float(similarities[i])
+                        break
+            row = None
+            if best_id is not None:
+                row = self._db.execute("SELECT question, answer, documents FROM answers WHERE id = ?",
+                                       (best_id,)).fetchone()
+            if row is None:
+                self._count('misses')
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE answers SET last_used = ?, hits = hits + 1 WHERE id = ?",
+                             (time.time(), best_id))
+            self._count('hits')
+            self._db.commit()
+        return CachedAnswer(row[0], row[1], documents_from_json(row[2]), best_similarity)
+
+    def store(self, question, embedding, model, answer, documents):
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            self._db.execute(
+                "INSERT INTO answers (question, model, collection_version, embedding, answer, documents, "
+                "created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (question, model, self.collection_version, np.asarray(embedding, dtype=np.float32).tobytes(),
+                 answer, documents_to_json(documents), now, now))
+            self._dirty = True
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # TTL first, then least recently used entries beyond the size limit
+        expired = self._db.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl,))
+        dropped = self._db.execute("DELETE FROM answers WHERE id NOT IN "
+                                   "(SELECT id FROM answers ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+        if expired.rowcount or dropped.rowcount:
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM answers")
+            self._db.commit()
+            self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._db.execute("SELECT name, value FROM stats").fetchall())
+            entries = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+        return {'hits': hits, 'misses': misses, 'entries': entries,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
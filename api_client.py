@@ -0,0 +1,87 @@
+import json
+import os
+
+from resource_cache import ResourceKey, resource_cache
+
+# Client for api_server.py. When OPM_API_URL is set, app.py sends chat turns, uploads and
+# session resets to the API server instead of running the chain in the Streamlit process.
+API_URL = os.getenv("OPM_API_URL")
+API_TIMEOUT = 300  # seconds, for a whole streamed answer
+API_MAX_CONNECTIONS = 32
+
+
+def get_client(url=API_URL):
+    key = ResourceKey("api_client", None, None, url)
+    return resource_cache.get_or_create(key, lambda: _create_client(url))
+
+
+def _create_client(url):
+    import httpx
+
+    limits = httpx.Limits(max_connections=API_MAX_CONNECTIONS, max_keepalive_connections=API_MAX_CONNECTIONS)
+    return httpx.Client(base_url=url, limits=limits, timeout=API_TIMEOUT)
+
+
+def _headers(api_key):
+    return {'Authorization': f"Bearer {api_key}"} if api_key else {}
+
+
+def _events(response):
+    # Server-sent events as (name, data) pairs
+    name, data = None, []
+    for line in response.iter_lines():
+        if line.startswith('event:'):
+            name = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].strip())
+        elif not line and name is not None:
+            yield name, json.loads("\n".join(data))
+            name, data = None, []
+
+
+class RemoteChain:
+    # Same stream() interface as rag_chain.ConversationalRAG
+    def __init__(self, model, api_key, url=API_URL):
+        self.model = model
+        self.api_key = api_key
+        self.url = url
+
+    def stream(self, inputs, config=None):
+        from langchain_core.documents import Document
+
+        session_id = ((config or {}).get("configurable") or inputs.get("configurable") or {})["session_id"]
+        body = {
+            "input": inputs["input"],
+            "file_context": inputs.get("file_context", ""),
+            "session_id": session_id,
+            "model": self.model,
+            "deck_summaries": [summary.to_dict() for summary in inputs.get("deck_summaries", [])],
+            "deck_keywords": inputs.get("deck_keywords", []),
+            "use_answer_cache": inputs.get("use_answer_cache", True),
+        }
+        with get_client(self.url).stream('POST', '/chat', json=body, headers=_headers(self.api_key)) as response:
+            if response.status_code != 200:
+                response.read()
+                raise RuntimeError(f"API server returned {response.status_code}: {response.text}")
+            for name, data in _events(response):
+                if name == 'context':
+                    yield {"context": [Document(**document) for document in data]}
+                elif name == 'answer':
+                    yield {"answer": data}
+                elif name == 'timings':
+                    yield {"timings": data}
+                elif name == 'error':
+                    raise RuntimeError(f"API server error: {data['message']}")
+                elif name == 'done':
+                    return
+
+
+def add_documents(session_id, texts, metadatas, api_key, url=API_URL):
+    response = get_client(url).post(f"/sessions/{session_id}/documents", json={'texts': texts, 'metadatas': metadatas},
+                                    headers=_headers(api_key))
+    response.raise_for_status()
+    return response.json()['chunks']
+
+
+def clear_session(session_id, api_key, url=API_URL):
+    get_client(url).delete(f"/sessions/{session_id}", headers=_headers(api_key)).raise_for_status()
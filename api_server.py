@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from rag_chain import clear_session_history, get_conversational_rag_chain, get_session_store
+from tracing import metrics_response
+
+# HTTP API around the RAG chain, so generation does not run in the Streamlit script and can be
+# scaled over several worker processes. app.py uses it when OPM_API_URL is set (api_client.py).
+#   POST   /chat                            server-sent events: context, answer (per token), timings, done
+#   POST   /sessions/{session_id}/documents add uploaded texts to the session's retrieval store
+#   DELETE /sessions/{session_id}           drop the session's chat history and uploads
+#   GET    /metrics                         Prometheus metrics (see tracing.py)
+# The OpenAI key is taken from the Authorization header, or OPENAI_API_KEY on the server.
+# Every worker opens the keyword collection read-only; chat histories are shared through SQLite
+# and uploads through a Chroma server (OPM_CHROMA_URL) when there is more than one worker.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPM_API_MAX_CONCURRENCY", "16"))  # per worker
+SESSION_WORKERS = 4  # threads per worker for uploads and session clears, apart from the chat threads
+QUEUE_TIMEOUT = 10  # seconds a request waits for a free slot before a 503
+RETRY_AFTER = 5
+DEFAULT_MODEL = "gpt-4o-mini"
+SHARED_CHAT_HISTORY = "sqlite:./cache/chat_history.sqlite3"
+
+_slots = None
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+_session_executor = ThreadPoolExecutor(max_workers=SESSION_WORKERS)
+
+
+def api_key_from(request):
+    authorization = request.headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        return authorization[len('bearer '):].strip()
+    return os.getenv("OPENAI_API_KEY")
+
+
+def document_to_dict(document):
+    return {'page_content': document.page_content, 'metadata': document.metadata}
+
+
+def event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_chain(chain, inputs, session_id, queue, loop, cancelled):
+    # Runs in a worker thread; chunks are handed to the event loop as they are produced
+    def put(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    chunks = chain.stream(inputs, config={"configurable": {"session_id": session_id}})
+    try:
+        for chunk in chunks:
+            if cancelled.is_set():
+                break
+            if 'context' in chunk:
+                put(event('context', [document_to_dict(document) for document in chunk['context']]))
+            if 'answer' in chunk:
+                put(event('answer', chunk['answer']))
+            if 'timings' in chunk:
+                put(event('timings', chunk['timings']))
+        put(event('done', {}))
+    except Exception as e:
+        print(f"Chat request failed: {e!r}")
+        put(event('error', {'message': str(e)}))
+    finally:
+        chunks.close()
+        put(None)
+
+
+async def acquire_slot():
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    try:
+        await asyncio.wait_for(_slots.acquire(), QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def busy():
+    return JSONResponse({'error': 'too many concurrent requests'}, status_code=503,
+                        headers={'Retry-After': str(RETRY_AFTER)})
+
+
+async def chat(request):
+    body = await request.json()
+    api_key = api_key_from(request)
+    if not api_key:
+        return JSONResponse({'error': 'no OpenAI API key'}, status_code=401)
+    if not body.get('input') or not body.get('session_id'):
+        return JSONResponse({'error': 'input and session_id are required'}, status_code=400)
+    from deck_context import DeckSummary
+
+    inputs = {
+        "input": body['input'],
+        "file_context": body.get('file_context', ''),
+        "deck_summaries": [DeckSummary.from_dict(summary) for summary in body.get('deck_summaries', [])],
+        "deck_keywords": body.get('deck_keywords', []),
+        "use_answer_cache": body.get('use_answer_cache', True),
+    }
+    if not await acquire_slot():
+        return busy()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def release():
+        # From the stream's end or, if the client went away before it started, the background task
+        if not cancelled.is_set():
+            cancelled.set()  # the worker thread stops at the next chunk
+            _slots.release()
+
+    async def events():
+        try:
+            chain = await loop.run_in_executor(
+                _executor, get_conversational_rag_chain, body.get('model', DEFAULT_MODEL), api_key)
+            loop.run_in_executor(_executor, stream_chain, chain, inputs, body['session_id'], queue, loop, cancelled)
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            release()
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'},
+                             background=BackgroundTask(release))
+
+
+async def add_documents(request):
+    body = await request.json()
+    api_key = api_key_from(request)
+    if not api_key:
+        return JSONResponse({'error': 'no OpenAI API key'}, status_code=401)
+    session_id = request.path_params['session_id']
+
+    def add():
+        # Straight into the store; process_file.add_to_database would post to OPM_API_URL if it is set
+        return get_session_store(api_key).add_documents(session_id, body['texts'], body['metadatas'])
+
+    chunks = await asyncio.get_running_loop().run_in_executor(_session_executor, add)
+    return JSONResponse({'chunks': chunks})
+
+
+async def clear_session(request):
+    session_id = request.path_params['session_id']
+    api_key = api_key_from(request)
+
+    def clear():
+        clear_session_history(session_id)
+        if api_key:
+            get_session_store(api_key).clear_session(session_id)
+
+    await asyncio.get_running_loop().run_in_executor(_session_executor, clear)
+    return JSONResponse({'cleared': session_id})
+
+
+async def health(request):
+    return JSONResponse({'status': 'ok'})
+
+
+async def metrics(request):
+    response = metrics_response()
+    if response is None:
+        return JSONResponse({'error': 'prometheus_client is not installed'}, status_code=404)
+    body, content_type = response
+    return Response(body, media_type=content_type)
+
+
+app = Starlette(routes=[
+    Route('/health', health),
+    Route('/metrics', metrics),
+    Route('/chat', chat, methods=['POST']),
+    Route('/sessions/{session_id}/documents', add_documents, methods=['POST']),
+    Route('/sessions/{session_id}', clear_session, methods=['DELETE']),
+])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the RAG chain over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.workers > 1 and os.getenv("OPM_CHAT_HISTORY", "memory") == "memory":
+        # Requests of one session can reach any worker; the workers inherit this environment
+        os.environ["OPM_CHAT_HISTORY"] = SHARED_CHAT_HISTORY
+        print(f"Sharing chat histories between workers in {SHARED_CHAT_HISTORY}")
+    uvicorn.run("api_server:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
-import streamlit as st
+from timing import timed, print_startup_report_once
+with timed("import streamlit"):
+    import streamlit as st
+    import streamlit.components.v1 as components
 import os
+import re
 from dotenv import load_dotenv
-from process_file import process_file
-from rag_chain import create_conversational_rag_chain
+from table_store import MONOTONICITY, TableStore, table_chart
+from upload_worker import start_upload, upload_key
+from keyword_pages import keyword_page_path, render_keyword_page
+from api_client import API_URL, RemoteChain, clear_session
+with timed("import rag_chain"):
+    from rag_chain import clear_session_history, get_conversational_rag_chain, get_session_store
+from resource_cache import ResourceKey, hash_api_key, resource_cache
+from tracing import LOG_CONTEXT, start_metrics_server_once, start_trace
 import uuid
-from process_file import plot_sgwfn_data
-import streamlit.components.v1 as components
 
 st.set_page_config(layout="centered", page_title="OPM Assistant", page_icon="opm_logo_compact.png")
 KEYWORDS_TO_SHOW = 4
@@ -17,31 +25,91 @@ if 'messages' not in st.session_state:
     st.session_state.messages = []
 if 'custom_context' not in st.session_state:
     st.session_state.custom_context = []
+if 'deck_summaries' not in st.session_state:
+    st.session_state.deck_summaries = []
+if 'deck_keywords' not in st.session_state:
+    st.session_state.deck_keywords = []  # manual keywords used in the uploads, see deck_pages.py
 if 'context_added' not in st.session_state:
     st.session_state.context_added = False
 if 'processed_files' not in st.session_state:
-    st.session_state.processed_files = set()
+    st.session_state.processed_files = set()  # content hashes, see upload_worker.upload_key
+if 'upload_tasks' not in st.session_state:
+    st.session_state.upload_tasks = {}
+if 'upload_keys' not in st.session_state:
+    st.session_state.upload_keys = {}  # uploader file id -> content hash, to hash each upload once
 if 'data' not in st.session_state:
     st.session_state.data = []
 if 'api_key' not in st.session_state:
     st.session_state.api_key = None
 if "file_uploader_key" not in st.session_state:
     st.session_state["file_uploader_key"] = 0
+if 'upload_errors' not in st.session_state:
+    st.session_state.upload_errors = []
 if "uploaded_files" not in st.session_state:
     st.session_state["uploaded_files"] = []
 
 def clear_chat():
+    # Drop the session's uploads and chat history; other sessions are evicted when idle
+    if API_URL:
+        clear_session(st.session_state.session_id, st.session_state.api_key)
+    else:
+        if st.session_state.api_key and st.session_state.processed_files:
+            get_session_store(st.session_state.api_key).clear_session(st.session_state.session_id)
+        clear_session_history(st.session_state.session_id)
     st.session_state.messages = []
     st.session_state.session_id = str(uuid.uuid4())
     st.session_state.custom_context = []
+    st.session_state.deck_summaries = []
+    st.session_state.deck_keywords = []
     st.session_state.context_added = False
     st.session_state.processed_files.clear()
+    st.session_state.upload_tasks = {}
+    st.session_state.upload_keys = {}
     st.session_state.data = []
     st.session_state["uploaded_files"] = []
     st.session_state["file_uploader_key"] += 1
 
 
+@st.fragment(run_every=1)
+def show_upload_progress():
+    # Polls the background uploads; finished results are attached to the session and the
+    # whole app is rerun so the chat sees them
+    finished = []
+    for key, task in st.session_state.upload_tasks.items():
+        status = task.status
+        if status == 'done':
+            result = task.result()
+            if result.deck_summary:
+                st.session_state.deck_summaries.append(result.deck_summary)
+            st.session_state.deck_keywords.extend(keyword for keyword in result.keywords
+                                                  if keyword not in st.session_state.deck_keywords)
+            if result.content:
+                st.session_state.custom_context.append(result.content)
+            if result.data:
+                st.session_state.data.append(result.data)
+            finished.append(key)
+        elif status == 'failed':
+            print(f"Processing {task.name} failed: {task.error()!r}")
+            st.session_state.upload_errors.append(f"Could not process {task.name}: {task.error()}")
+            finished.append(key)
+        else:
+            st.caption(f"{'Parsing' if status == 'parsing' else 'Indexing'} {task.name}...")
+    if finished:
+        for key in finished:
+            st.session_state.processed_files.add(key)
+            del st.session_state.upload_tasks[key]
+        st.session_state.context_added = False
+        if not st.session_state.upload_tasks:
+            st.session_state.upload_done = True
+        st.rerun()
+
+
 def is_api_key_valid(api_key):
+    # Validating the key is a network round-trip, so only do it once per key and process
+    key = ResourceKey("api_key_valid", None, hash_api_key(api_key), None)
+    return resource_cache.get_or_create(key, lambda: _check_api_key(api_key))
+
+def _check_api_key(api_key):
     import openai
     client = openai.OpenAI(api_key=api_key)
     try:
@@ -51,22 +119,27 @@ def is_api_key_valid(api_key):
     else:
         return True
 
-def render_html_file(html_file_path):
-    # Ensure the path is relative to the current working directory
-    if not html_file_path.startswith('opm-reference-manual'):
-        # remove everything before 'opm-reference-manual'
-        html_file_path = 'opm-reference-manual' + html_file_path.split('opm-reference-manual')[1]
-    try:
-        with open(html_file_path, 'r', encoding='utf-8') as file:
-            html_content = file.read()
-        # Create a container with fixed height and scrolling
-        components.html(
-            f"""{html_content}""",
-            height=420,
-            scrolling=True
-        )
-    except FileNotFoundError:
-        st.error(f"HTML file not found: {html_file_path}")
+def show_keyword_page(title, source):
+    # Pre-rendered, minified page (see generate_keyword_pages.py), or the unprocessed page if they
+    # have not been built; cached in memory
+    page_path = keyword_page_path(title, source)
+    if page_path is None:
+        st.error(f"No page found for keyword {title}")
+        return
+    components.html(render_keyword_page(page_path), height=420, scrolling=True)
+
+def session_tables():
+    # Saturation and PVT tables of all uploaded decks
+    return TableStore.merge(st.session_state.data)
+
+def show_table_chart(tables, keyword, key):
+    keyword_tables = tables.get(keyword)
+    labels = [table.label for table in keyword_tables]
+    selected = st.multiselect(f"{keyword} tables", labels, default=labels, key=key) if len(labels) > 1 else labels
+    chosen = [table for table in keyword_tables if table.label in selected]
+    if chosen:
+        # Charts are cached by table hash, so reruns do not rebuild them
+        st.altair_chart(table_chart(chosen), width="stretch")
 
 with st.sidebar:
     st.image('opm_logo.png')
@@ -94,6 +167,16 @@ with st.sidebar:
         st.error('Invalid OpenAI API key. Please provide a valid key.')
         st.stop()
 
+    # Build (or fetch the cached) chain up front so a chat submission pays no setup cost.
+    # With OPM_API_URL set, the chain runs in the API server (api_server.py)
+    conversational_rag_chain = None
+    if st.session_state.api_key and API_URL:
+        conversational_rag_chain = RemoteChain(model, st.session_state.api_key)
+    elif st.session_state.api_key:
+        conversational_rag_chain = get_conversational_rag_chain(model=model, api_key=st.session_state.api_key)
+        print_startup_report_once()
+    start_metrics_server_once()
+
 
     # File uploader
     uploaded_files = st.file_uploader("Upload a file",
@@ -102,19 +185,33 @@ with st.sidebar:
                                       label_visibility="collapsed",
                                       key=st.session_state["file_uploader_key"])
     if uploaded_files:
-        new_files_processed = False
+        # All uploads, so INCLUDE statements in a deck can be resolved against the other files
+        uploaded_contents = {uploaded_file.name: uploaded_file.getvalue() for uploaded_file in uploaded_files}
         for uploaded_file in uploaded_files:
-            if uploaded_file.name not in st.session_state.processed_files:
-                result = process_file(uploaded_file, st.session_state.session_id)
-                if result.content:
-                    st.session_state.custom_context.append(result.content)
-                if result.data:
-                    st.session_state.data.append(result.data)
-                st.session_state.processed_files.add(uploaded_file.name)
-                new_files_processed = True
-        if new_files_processed:
-            st.success("New file(s) processed successfully!")
-        st.session_state.context_added = False
+            key = st.session_state.upload_keys.get(uploaded_file.file_id)
+            if key is None:
+                key = upload_key(uploaded_file.name, uploaded_contents[uploaded_file.name], uploaded_contents)
+                st.session_state.upload_keys[uploaded_file.file_id] = key
+            if key not in st.session_state.processed_files and key not in st.session_state.upload_tasks:
+                st.session_state.upload_tasks[key] = start_upload(
+                    key, uploaded_file.name, uploaded_contents[uploaded_file.name], uploaded_contents,
+                    st.session_state.session_id, st.session_state.api_key)
+    if st.session_state.upload_tasks:
+        show_upload_progress()
+    for error in st.session_state.upload_errors:
+        st.error(error)
+    st.session_state.upload_errors = []
+    if st.session_state.pop('upload_done', False):
+        st.success("New file(s) processed successfully!")
+
+tables = session_tables()
+if tables:
+    with st.expander(f"Deck tables ({len(tables)})"):
+        keyword = st.selectbox("Keyword", tables.plottable_keywords(), key="table_keyword")
+        if keyword:
+            show_table_chart(tables, keyword, key=f"table_regions_{keyword}")
+        for issue in tables.validate():
+            st.warning(issue)
 
 # Display the entire chat history
 for i, message in enumerate(st.session_state.messages):
@@ -123,15 +220,16 @@ for i, message in enumerate(st.session_state.messages):
 
     # Check if this is an assistant message
     if message["role"] == "assistant":
-        # Check if the message contains "SGWFN" and "plot"
-        if "SGWFN" in message["content"] and "plot" in message["content"]:
-            # Retrieve the SGWFN data
-            recent_sgwfn_data = st.session_state.data[0]
-            if recent_sgwfn_data:
-                fig = plot_sgwfn_data(recent_sgwfn_data)
-                st.pyplot(fig)
-            else:
-                st.warning("No SGWFN data available to plot.")
+        # Plot the table keywords named in an answer about plotting
+        if "plot" in message["content"].lower():
+            named = set(re.findall(r"\b[A-Z][A-Z0-9]+\b", message["content"]))
+            for keyword in MONOTONICITY:
+                if keyword not in named:
+                    continue
+                if tables.get(keyword):
+                    show_table_chart(tables, keyword, key=f"chart_{i}_{keyword}")
+                else:
+                    st.warning(f"No {keyword} data available to plot.")
 
     # Check if this is an assistant message and has context
     if message["role"] == "assistant" and "context" in st.session_state.get(f"message_{i}", {}):
@@ -156,10 +254,7 @@ for i, message in enumerate(st.session_state.messages):
 
             for j, (title, doc) in enumerate(unique_docs.items()):
                 if st.session_state.get(f"show_doc_{i}_{j}", False):
-                    file_path = doc.metadata.get('source', '')
-                    html_file_path = file_path.replace('.txt', '.html')
-                    html_file_path = html_file_path.replace('txt_parts', 'html_parts')
-                    render_html_file(html_file_path)
+                    show_keyword_page(title, doc.metadata.get('source', ''))
 
 # Chat input
 if prompt := st.chat_input("How can I help you?"):
@@ -167,8 +262,6 @@ if prompt := st.chat_input("How can I help you?"):
         st.info("Please add your OpenAI API key in the sidebar to continue.")
         st.stop()
 
-    conversational_rag_chain = create_conversational_rag_chain(model=model, api_key=st.session_state.api_key)
-
     # Display the user's message immediately
     with st.chat_message("user"):
         st.markdown(prompt)
@@ -177,13 +270,14 @@ if prompt := st.chat_input("How can I help you?"):
     message = {"role": "user", "content": prompt}
     st.session_state.messages.append(message)
 
-    # Print the prompt for debugging
-    print(f"User prompt: {prompt}")
+    if LOG_CONTEXT:
+        print(f"User prompt: {prompt}")
 
-    # Add custom context to the prompt only if it hasn't been added before
+    # Send the uploaded files' text with the first question after the upload only; the chain
+    # keeps it apart from the question itself
+    file_context = ""
     if not st.session_state.context_added:
-        custom_context = "\n".join(st.session_state.custom_context)
-        prompt = f"{custom_context}\n\n{prompt}"
+        file_context = "\n".join(st.session_state.custom_context)
         st.session_state.context_added = True
 
     # Display the assistant's response with streaming
@@ -191,29 +285,48 @@ if prompt := st.chat_input("How can I help you?"):
         message_placeholder = st.empty()
         full_response = ""
         context = []
-        
+        timings = {}
+        # Time spent rendering in the UI; the chain's own stages are traced where it runs
+        trace = start_trace("chat_ui", session_id=st.session_state.session_id, remote=bool(API_URL))
+
         for chunk in conversational_rag_chain.stream({
             "input": prompt,
-            "configurable": {"session_id": st.session_state.session_id}
+            "file_context": file_context,
+            "configurable": {"session_id": st.session_state.session_id},
+            # Decks are summarised and matched to each question inside the chain
+            "deck_summaries": st.session_state.deck_summaries,
+            # Retrieval favours the manual pages of the keywords used in the uploads
+            "deck_keywords": st.session_state.deck_keywords,
+            # Cached answers know nothing about uploaded files
+            "use_answer_cache": not (st.session_state.custom_context or st.session_state.deck_summaries),
         }, config={"configurable": {"session_id": st.session_state.session_id}}):
             if 'answer' in chunk:
+                trace.mark("first_token")
                 full_response += chunk['answer']
-                message_placeholder.markdown(full_response + "▌")
+                with trace.stage("render"):
+                    message_placeholder.markdown(full_response + "▌")
             if 'context' in chunk:
                 context.extend(chunk['context'])
-        
-        message_placeholder.markdown(full_response)
+            if 'timings' in chunk:
+                timings = chunk['timings']
+
+        with trace.stage("render"):
+            message_placeholder.markdown(full_response)
+        trace.set(answer_chars=len(full_response), chain_total_ms=round(timings.get('total', 0.0) * 1000, 3))
+        trace.finish()
 
     # Store the response and context in session state
     message_index = len(st.session_state.messages)
     st.session_state[f"message_{message_index}"] = {
-        "context": context
+        "context": context,
+        "timings": timings,
     }
     st.session_state.messages.append({"role": "assistant", "content": full_response})
 
-    # Print the response and context for debugging
-    print(f"Assistant response: {full_response}")
-    print(f"Context: {context}")
+    # Full prompts, answers and context only on request (OPM_LOG_CONTEXT=1); traces are in OPM_TRACE_FILE
+    if LOG_CONTEXT:
+        print(f"Assistant response: {full_response}")
+        print(f"Context: {context}")
 
     # update site
     st.rerun()
@@ -0,0 +1,238 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from api_client import API_URL, RemoteChain, clear_session
+from batch_embed import RateLimiter
+from rag_chain import (KEYWORD_COLLECTION, clear_session_history, file_prompt, get_conversational_rag_chain,
+                       get_history_store, get_session_store)
+from tokens import count_tokens
+from upload_worker import start_upload, upload_key
+
+# Answers a file of questions without the UI, e.g. a backlog of support questions or a review
+# of many decks. Each input line is a JSON object:
+#   {"id": "q1", "question": "...", "attachments": ["case/CASE.DATA"], "session": "case"}
+# Only "question" is required. Questions with the same "session" share a chat history and their
+# attachments, and are asked in file order; sessions run concurrently. Attachments are parsed
+# and stored as in the app (process_file.py), relative to the question file. Answers are
+# appended to the output file as they finish, so an interrupted run continues where it stopped:
+#   python batch_answer.py questions.jsonl answers.jsonl --workers 8 --questions-per-minute 60
+# Against fake_llm_server.py: OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake
+BATCH_WORKERS = 4
+BATCH_QUESTIONS_PER_MINUTE = 60
+DEFAULT_MODEL = "gpt-4o-mini"
+
+
+def item_id(item, line):
+    # Without an explicit id, the line itself identifies the question across runs
+    return str(item.get('id') or hashlib.sha256(line.encode('utf-8')).hexdigest()[:16])
+
+
+def load_items(path):
+    items = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                item['id'] = item_id(item, line.strip())
+                items.append(item)
+    return items
+
+
+def load_answered(path):
+    # id -> record of the questions answered by earlier runs; failed ones are asked again
+    answered = {}
+    if not os.path.exists(path):
+        return answered
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut off by the interruption
+            if record.get('status') == 'ok':
+                answered[record['id']] = record
+    return answered
+
+
+def end_partial_line(path):
+    # A record cut off by an interruption must not swallow the next one
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+
+def group_sessions(items):
+    # Items without a session are sessions of their own
+    sessions = {}
+    for item in items:
+        sessions.setdefault(item.get('session') or f"item-{item['id']}", []).append(item)
+    return list(sessions.values())
+
+
+def source_dict(document):
+    metadata = document.metadata
+    return {key: metadata[key] for key in ('title', 'source', 'part', 'page') if key in metadata}
+
+
+class BatchRunner:
+    def __init__(self, chain, api_key, output_path, base_directory='.', questions_per_minute=None, model=None):
+        self.chain = chain
+        self.api_key = api_key
+        self.output_path = output_path
+        self.base_directory = base_directory
+        self.rate_limiter = RateLimiter(questions_per_minute)
+        self.model = model
+        self._write_lock = threading.Lock()
+
+    def _write(self, record):
+        with self._write_lock:
+            with open(self.output_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, default=str) + "\n")
+                f.flush()
+
+    def _read_attachments(self, paths):
+        files = {}
+        for path in paths:
+            with open(os.path.join(self.base_directory, path), 'rb') as f:
+                files[os.path.basename(path)] = f.read()
+        return files
+
+    def _upload(self, session_id, paths):
+        # Parsed in the upload process pool, with results cached by content for all sessions
+        files = self._read_attachments(paths)
+        tasks = [start_upload(upload_key(name, content, files), name, content, files, session_id, self.api_key)
+                 for name, content in files.items()]
+        return [task.result() for task in tasks]
+
+    def _ask(self, session_id, question, file_context, deck_summaries, deck_keywords, use_answer_cache):
+        answer, context, timings = "", [], {}
+        for chunk in self.chain.stream({
+            "input": question,
+            "file_context": file_context,
+            "configurable": {"session_id": session_id},
+            "deck_summaries": deck_summaries,
+            "deck_keywords": deck_keywords,
+            "use_answer_cache": use_answer_cache,
+        }, config={"configurable": {"session_id": session_id}}):
+            if 'answer' in chunk:
+                answer += chunk['answer']
+            if 'context' in chunk:
+                context.extend(chunk['context'])
+            if 'timings' in chunk:
+                timings = chunk['timings']
+        return answer, context, timings
+
+    def run_session(self, items, answered):
+        # Returns the number of questions answered in this run
+        session_id = f"batch-{uuid.uuid4()}"
+        deck_summaries, deck_keywords, custom_context = [], [], []
+        uploaded = set()
+        done = 0
+        try:
+            for item in items:
+                paths = [path for path in item.get('attachments', []) if path not in uploaded]
+                if paths:
+                    for result in self._upload(session_id, paths):
+                        if result.deck_summary:
+                            deck_summaries.append(result.deck_summary)
+                        deck_keywords.extend(keyword for keyword in result.keywords if keyword not in deck_keywords)
+                        if result.content:
+                            custom_context.append(result.content)
+                    uploaded.update(paths)
+
+                question = item['question']
+                # As in the app, file contents go with the next question only
+                file_context = "\n".join(custom_context)
+                custom_context = []
+
+                record = answered.get(item['id'])
+                if record is not None:
+                    # Answered in an earlier run: restore the turn so follow-up questions have their
+                    # history (only possible for a local chain)
+                    if not API_URL:
+                        turn = [(role, text, count_tokens(text, self.model))
+                                for role, text in (('human', file_prompt(question, file_context)),
+                                                   ('ai', record['answer']))]
+                        get_history_store().append(session_id, turn)
+                    continue
+
+                self.rate_limiter.wait()
+                start = time.perf_counter()
+                record = {'id': item['id'], 'session': item.get('session'), 'question': item['question']}
+                try:
+                    answer, context, timings = self._ask(session_id, question, file_context, deck_summaries,
+                                                         deck_keywords, not (uploaded or item.get('attachments')))
+                    record.update(status='ok', answer=answer, sources=[source_dict(doc) for doc in context],
+                                  timings=timings)
+                    done += 1
+                except Exception as e:
+                    record.update(status='error', error=repr(e))
+                record['seconds'] = round(time.perf_counter() - start, 3)
+                self._write(record)
+                print(f"{item['id']}: {record['status']} in {record['seconds']:.1f} s")
+        finally:
+            self._clear(session_id, bool(uploaded))
+        return done
+
+    def _clear(self, session_id, has_uploads):
+        if API_URL:
+            clear_session(session_id, self.api_key)
+            return
+        clear_session_history(session_id)
+        if has_uploads:
+            get_session_store(self.api_key).clear_session(session_id)
+
+    def run(self, items, workers=BATCH_WORKERS):
+        answered = load_answered(self.output_path)
+        end_partial_line(self.output_path)
+        sessions = [session for session in group_sessions(items)
+                    if any(item['id'] not in answered for item in session)]
+        pending = sum(1 for session in sessions for item in session if item['id'] not in answered)
+        print(f"{len(items)} questions, {len(answered)} answered before, {pending} to answer "
+              f"in {len(sessions)} sessions")
+        done = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in as_completed([pool.submit(self.run_session, session, answered) for session in sessions]):
+                done += future.result()
+        return done, pending
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSON-lines file of questions without the UI")
+    parser.add_argument("questions", help="JSON lines with 'question' and optional 'id', 'attachments', 'session'")
+    parser.add_argument("output", help="JSON lines of answers with sources and timings; appended to, for resuming")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--collection", default=KEYWORD_COLLECTION)
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="sessions answered concurrently")
+    parser.add_argument("--questions-per-minute", type=float, default=BATCH_QUESTIONS_PER_MINUTE,
+                        help="0 for no limit")
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    # One chain (and its retrieval, embedding and answer caches) for all questions
+    if API_URL:
+        chain = RemoteChain(args.model, api_key)
+    else:
+        chain = get_conversational_rag_chain(model=args.model, api_key=api_key, collection_name=args.collection)
+    runner = BatchRunner(chain, api_key, args.output, os.path.dirname(os.path.abspath(args.questions)),
+                         args.questions_per_minute, args.model)
+    start = time.perf_counter()
+    done, pending = runner.run(load_items(args.questions), args.workers)
+    print(f"Answered {done}/{pending} questions in {time.perf_counter() - start:.1f} s")
+    if done < pending:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+EMBED_BATCH_SIZE = 100  # texts per embedding request
+EMBED_MAX_WORKERS = 4  # concurrent embedding requests
+EMBED_REQUESTS_PER_MINUTE = 300
+
+
+class RateLimiter:
+    # Spaces out calls evenly so that at most `requests_per_minute` start per minute.
+    # Thread-safe; a rate of 0 or None disables limiting.
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def batched(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def iter_embedded_batches(embeddings, texts, batch_size=EMBED_BATCH_SIZE, max_workers=EMBED_MAX_WORKERS,
+                          rate_limiter=None):
+    # Embed `texts` in concurrent batches and yield (start_index, vectors) in input order,
+    # so callers can persist each batch as soon as it is ready
+    def embed(batch):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        return embeddings.embed_documents(batch)
+
+    batches = list(batched(texts, batch_size))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i, vectors in enumerate(pool.map(embed, batches)):
+            yield i * batch_size, vectors
+
+
+def embed_texts(embeddings, texts, **kwargs):
+    vectors = []
+    for _, batch_vectors in iter_embedded_batches(embeddings, texts, **kwargs):
+        vectors.extend(batch_vectors)
+    return vectors
@@ -0,0 +1,300 @@
+__import__('pysqlite3')
+import sys
+sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+
+import argparse
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+import numpy as np
+
+import tracing
+from chat_history import MemoryHistoryStore
+from generate_database import (CHUNK_OVERLAP, CHUNK_SIZE, TXT_DIRECTORY, html_documents_and_chunks, parse_txt_files,
+                               split_document)
+from keyword_chunker import PageStore
+from keyword_index import KeywordIndex
+from local_models import FakeChatModel, HashingEmbeddings
+from manual_sections import section_metadata, source_section
+from rag_chain import build_conversational_rag_chain
+
+# Offline latency and retrieval-quality benchmark. Builds an in-memory keyword collection with
+# hashing embeddings, replays a question set through the chain with a fake chat model and
+# compares recall@k and per-stage latency percentiles against a stored baseline. Latencies are
+# compared relative to a fixed CPU workload timed in the same run, so a baseline recorded on
+# one machine still gates runs on another. Chat history is kept in memory and no traces are
+# written unless --trace-file is given, so a run leaves nothing behind.
+QUESTIONS_PATH = "./benchmarks/questions.jsonl"
+BASELINE_PATH = "./benchmarks/baseline.json"
+HTML_DIRECTORY = "./opm-reference-manual/html_parts/chapters/subsections"
+BENCHMARK_COLLECTION = "BENCHMARK"
+PERCENTILES = [50, 90, 95, 99]
+RECALL_TOLERANCE = 0.02  # absolute drop in recall@k that counts as a regression
+LATENCY_TOLERANCE = 0.5  # relative increase in p50 latency, after calibration, that counts as a regression
+LATENCY_SLACK_MS = 5.0  # absolute slack, so sub-millisecond stages do not flap
+CALIBRATION_VALUES = 200000
+CALIBRATION_REPEATS = 9
+
+
+class TimedEmbeddings:
+    # Records the time spent embedding, which otherwise happens inside the vector store
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.seconds = 0.0
+
+    def embed_documents(self, texts):
+        start = time.perf_counter()
+        try:
+            return self.embeddings.embed_documents(texts)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def embed_query(self, text):
+        start = time.perf_counter()
+        try:
+            return self.embeddings.embed_query(text)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def calibration_ms(values=CALIBRATION_VALUES, repeats=CALIBRATION_REPEATS):
+    # Fastest time of a fixed single-threaded Python workload, the unit latencies are compared in
+    data = [random.Random(0).random() for _ in range(values)]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        sorted(data)
+        sum(value * value for value in data)
+        times.append(time.perf_counter() - start)
+    return round(min(times) * 1000, 3)
+
+
+def html_documents(directory):
+    # Plain text of the LibreOffice HTML pages, for trees without the TXT export
+    import lxml.html
+    from langchain_core.documents import Document
+
+    documents = []
+    for root, _, files in os.walk(directory):
+        for file in sorted(files):
+            if file.endswith('.html') and not file.startswith('index'):
+                path = os.path.normpath(os.path.join(root, file))
+                with open(path, 'rb') as f:
+                    body = lxml.html.fromstring(f.read()).find('body')
+                text = re.sub(r'[ \t]{2,}', ' ', re.sub(r'\n\s*\n+', '\n', body.text_content() if body is not None else ''))
+                title = os.path.splitext(file)[0].upper()
+                metadata = {'title': title, 'source': path, **section_metadata(title, source_section(path))}
+                documents.append(Document(page_content=text.strip(), metadata=metadata))
+    return documents
+
+
+def load_documents(txt_directory, html_directory):
+    if os.path.isdir(txt_directory):
+        return parse_txt_files(txt_directory)
+    print(f"{txt_directory} not found, using the text of {html_directory}")
+    return html_documents(html_directory)
+
+
+def character_chunks(documents, chunk_size, chunk_overlap):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [chunk for document in documents for chunk in split_document(document, text_splitter)]
+
+
+def build_collection(chunks, embeddings):
+    import chromadb
+    from langchain_chroma import Chroma
+
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection(BENCHMARK_COLLECTION, metadata={'hnsw:space': 'cosine'})
+    for start in range(0, len(chunks), 1000):
+        batch = chunks[start:start + 1000]
+        collection.upsert(
+            ids=[chunk_id for chunk_id, _ in batch],
+            embeddings=embeddings.embed_documents([split.page_content for _, split in batch]),
+            documents=[split.page_content for _, split in batch],
+            metadatas=[split.metadata for _, split in batch],
+        )
+    vector_store = Chroma(client=client, collection_name=BENCHMARK_COLLECTION, embedding_function=embeddings)
+    return vector_store, KeywordIndex.from_collection(collection)
+
+
+def load_questions(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_questions(chain, embeddings, questions, k):
+    # Items with the same "session" share a chat history, in file order
+    sessions = {}
+    timings = []
+    results = []
+    for item in questions:
+        session_id = sessions.setdefault(item.get('session') or uuid.uuid4().hex, uuid.uuid4().hex)
+        embeddings.seconds = 0.0
+        start = time.perf_counter()
+        turn = {}
+        context = []
+        for chunk in chain.stream({"input": item['question'], "use_answer_cache": False},
+                                  config={"configurable": {"session_id": session_id}}):
+            if 'context' in chunk:
+                context.extend(chunk['context'])
+            if 'answer' in chunk and 'stream_to_ui' not in turn:
+                # When the first token reaches the consumer, i.e. the UI
+                turn['stream_to_ui'] = time.perf_counter() - start
+            if 'timings' in chunk:
+                turn.update(chunk['timings'])
+        turn['embed'] = turn.get('embed', 0.0) + embeddings.seconds
+        timings.append(turn)
+
+        titles = [doc.metadata.get('title', '') for doc in context[:k]]
+        expected = item.get('expected', [])
+        found = [title for title in expected if title in titles]
+        rank = next((i + 1 for i, title in enumerate(titles) if title in expected), None)
+        results.append({'question': item['question'], 'expected': expected, 'retrieved': titles,
+                        'recall': len(found) / len(expected) if expected else None,
+                        'reciprocal_rank': 1.0 / rank if rank else 0.0})
+    return timings, results
+
+
+def summarize(timings, results, k, calibration=None):
+    stages = sorted({stage for turn in timings for stage in turn})
+    latency = {}
+    for stage in stages:
+        values = np.array([turn[stage] for turn in timings if stage in turn]) * 1000
+        latency[stage] = {f"p{p}": round(float(np.percentile(values, p)), 3) for p in PERCENTILES}
+        latency[stage]['count'] = len(values)
+    scored = [result for result in results if result['recall'] is not None]
+    return {
+        'k': k,
+        'questions': len(results),
+        'recall_at_k': round(float(np.mean([result['recall'] for result in scored])), 4) if scored else None,
+        'mrr': round(float(np.mean([result['reciprocal_rank'] for result in scored])), 4) if scored else None,
+        'calibration_ms': calibration,
+        'latency_ms': latency,
+    }
+
+
+def print_report(summary, results):
+    print(f"\n{summary['questions']} questions, recall@{summary['k']} {summary['recall_at_k']}, "
+          f"MRR {summary['mrr']}, calibration {summary['calibration_ms']} ms")
+    print(f"  {'stage':<28}" + "".join(f"{f'p{p}':>10}" for p in PERCENTILES) + f"{'count':>8}")
+    for stage, values in summary['latency_ms'].items():
+        print(f"  {stage:<28}" + "".join(f"{values[f'p{p}']:>10.1f}" for p in PERCENTILES) + f"{values['count']:>8}")
+    misses = [result for result in results if result['recall'] is not None and result['recall'] < 1]
+    if misses:
+        print("\nMissed expected keywords:")
+        for result in misses:
+            print(f"  {result['question']!r}: expected {result['expected']}, got {result['retrieved']}")
+
+
+def regressions(summary, baseline, recall_tolerance, latency_tolerance):
+    problems = []
+    if baseline.get('k') != summary['k']:
+        return [f"baseline is for k={baseline.get('k')}, run with k={summary['k']}"]
+    if baseline.get('recall_at_k') is not None and summary['recall_at_k'] is not None \
+            and summary['recall_at_k'] < baseline['recall_at_k'] - recall_tolerance:
+        problems.append(f"recall@{summary['k']} {summary['recall_at_k']} < baseline {baseline['recall_at_k']}")
+    if not baseline.get('calibration_ms') or not summary.get('calibration_ms'):
+        return problems  # latencies of different machines are not comparable
+    # The baseline's latencies, as they would be on this machine
+    scale = summary['calibration_ms'] / baseline['calibration_ms']
+    for stage, values in baseline.get('latency_ms', {}).items():
+        current = summary['latency_ms'].get(stage)
+        if current is None:
+            continue
+        limit = values['p50'] * scale * (1 + latency_tolerance) + LATENCY_SLACK_MS
+        if current['p50'] > limit:
+            problems.append(f"{stage} p50 {current['p50']:.1f} ms > {limit:.1f} ms "
+                            f"(baseline {values['p50']:.1f} ms x {scale:.2f} for this machine)")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency and retrieval-quality benchmark")
+    parser.add_argument("--questions", default=QUESTIONS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="write this run's results as the baseline")
+    parser.add_argument("--chunker", choices=["structure", "character"], default="structure",
+                        help="structure: keyword_chunker on the HTML pages; character: split page text by characters")
+    parser.add_argument("--txt-directory", default=TXT_DIRECTORY)
+    parser.add_argument("--html-directory", default=HTML_DIRECTORY)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1, help="replay the question set this many times")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="fake model delay before the first token (s)")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="fake model delay between tokens (s)")
+    parser.add_argument("--recall-tolerance", type=float, default=RECALL_TOLERANCE)
+    parser.add_argument("--latency-tolerance", type=float, default=LATENCY_TOLERANCE)
+    parser.add_argument("--output", help="also write the summary and per-question results to this JSON file")
+    parser.add_argument("--trace-file", default="", help="write the traces of the replayed turns to this file")
+    args = parser.parse_args()
+    tracing.TRACE_FILE = args.trace_file
+
+    embeddings = TimedEmbeddings(HashingEmbeddings())
+    start = time.perf_counter()
+    page_store = None
+    if args.chunker == 'structure':
+        pages, documents, page_chunks = html_documents_and_chunks(args.html_directory)
+        chunks = [chunk for page in pages for chunk in page_chunks[page.source]]
+        page_store = PageStore(':memory:')
+        page_store.put(pages)
+    else:
+        documents = load_documents(args.txt_directory, args.html_directory)
+        chunks = character_chunks(documents, args.chunk_size, args.chunk_overlap)
+    vector_store, index = build_collection(chunks, embeddings)
+    print(f"Indexed {len(documents)} pages in {len(chunks)} chunks ({args.chunker}) in "
+          f"{time.perf_counter() - start:.1f} s")
+
+    chain = build_conversational_rag_chain(
+        "fake",
+        llm=FakeChatModel(latency=args.llm_latency, token_delay=args.token_delay),
+        embeddings=embeddings,
+        vector_store=vector_store,
+        load_keyword_index=lambda: index,
+        load_page_store=lambda: page_store,
+        history_store=MemoryHistoryStore(),
+    )
+    chain.retriever.k = args.k
+    questions = load_questions(args.questions)
+    timings, results = [], []
+    for _ in range(args.repeat):
+        run_timings, run_results = run_questions(chain, embeddings, questions, args.k)
+        timings.extend(run_timings)
+        results.extend(run_results)
+    summary = summarize(timings, results[:len(questions)], args.k, calibration_ms())
+    print_report(summary, results[:len(questions)])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'results': results[:len(questions)]}, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+            f.write('\n')
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --update-baseline to create one")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    problems = regressions(summary, baseline, args.recall_tolerance, args.latency_tolerance)
+    if problems:
+        print("\nRegressions against the baseline:")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    print("\nNo regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
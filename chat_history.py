@@ -0,0 +1,210 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Chat histories per session. Two backends: an in-process LRU with idle TTL (the default), and
+# SQLite, which several server processes can share. Each session keeps a summary of its older
+# turns plus the recent messages; ConversationalRAG folds old turns into the summary once the
+# history exceeds its token budget (see compress_history).
+CHAT_HISTORY_BACKEND = os.getenv("OPM_CHAT_HISTORY", "memory")  # "memory" or "sqlite:<path>"
+HISTORY_MAX_SESSIONS = 1000  # in-memory backend
+HISTORY_TTL = 6 * 60 * 60  # seconds since the last turn before a session is dropped
+HISTORY_MAX_MESSAGES = 100  # hard cap per session, oldest dropped first
+HISTORY_TOKEN_BUDGET = 2000  # tokens of summary and messages replayed into the prompts
+HISTORY_KEEP_MESSAGES = 4  # most recent messages never folded into the summary
+
+
+class StoredMessage:
+    def __init__(self, id, role, content, tokens):
+        self.id = id
+        self.role = role  # 'human' or 'ai'
+        self.content = content
+        self.tokens = tokens
+
+
+class SessionHistory:
+    def __init__(self, summary='', summary_tokens=0, messages=None):
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.messages = messages or []
+
+    @property
+    def tokens(self):
+        return self.summary_tokens + sum(message.tokens for message in self.messages)
+
+    def to_messages(self):
+        # As LangChain messages for the prompts' chat_history placeholder
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"Summary of the earlier conversation: {self.summary}"))
+        for message in self.messages:
+            messages.append((HumanMessage if message.role == 'human' else AIMessage)(content=message.content))
+        return messages
+
+
+class MemoryHistoryStore:
+    def __init__(self, max_sessions=HISTORY_MAX_SESSIONS, ttl=HISTORY_TTL, max_messages=HISTORY_MAX_MESSAGES):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self._sessions = OrderedDict()  # session_id -> [SessionHistory, last_used]
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, (_, last_used) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - last_used <= self.ttl:
+                break
+            del self._sessions[session_id]
+
+    def load(self, session_id):
+        with self._lock:
+            self._evict(time.monotonic())
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return SessionHistory()
+            history = entry[0]
+            return SessionHistory(history.summary, history.summary_tokens, list(history.messages))
+
+    def append(self, session_id, messages):
+        # messages: [(role, content, tokens), ...]
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None) or [SessionHistory(), now]
+            history = entry[0]
+            history.messages.extend(StoredMessage(next(self._ids), *message) for message in messages)
+            del history.messages[:-self.max_messages]
+            self._sessions[session_id] = [history, now]
+            self._evict(now)
+
+    def set_summary(self, session_id, summary, summary_tokens, upto_id, previous=''):
+        # Replaces the messages up to and including upto_id with the summary, unless the summary
+        # is no longer `previous` (another compression got there first). Returns whether it did.
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[0].summary != previous:
+                return False
+            history = entry[0]
+            history.summary, history.summary_tokens = summary, summary_tokens
+            history.messages = [message for message in history.messages if message.id > upto_id]
+            return True
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteHistoryStore:
+    def __init__(self, path, ttl=HISTORY_TTL, max_messages=HISTORY_MAX_MESSAGES):
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                summary_tokens INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                tokens INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+        """)
+
+    def _evict(self, now):
+        expired = [row[0] for row in self._db.execute("SELECT session_id FROM sessions WHERE last_used < ?",
+                                                      (now - self.ttl,))]
+        for session_id in expired:
+            self._delete(session_id)
+
+    def _delete(self, session_id):
+        self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def load(self, session_id):
+        with self._lock:
+            row = self._db.execute("SELECT summary, summary_tokens, last_used FROM sessions WHERE session_id = ?",
+                                   (session_id,)).fetchone()
+            if row is None or row[2] < time.time() - self.ttl:
+                return SessionHistory()
+            messages = [StoredMessage(*message) for message in self._db.execute(
+                "SELECT id, role, content, tokens FROM messages WHERE session_id = ? ORDER BY id", (session_id,))]
+        return SessionHistory(row[0], row[1], messages)
+
+    def append(self, session_id, messages):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO sessions (session_id, last_used) VALUES (?, ?) "
+                             "ON CONFLICT(session_id) DO UPDATE SET last_used = excluded.last_used", (session_id, now))
+            self._db.executemany("INSERT INTO messages (session_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+                                 [(session_id, *message) for message in messages])
+            self._db.execute("DELETE FROM messages WHERE session_id = ? AND id NOT IN (SELECT id FROM messages "
+                             "WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                             (session_id, session_id, self.max_messages))
+            self._evict(now)
+
+    def set_summary(self, session_id, summary, summary_tokens, upto_id, previous=''):
+        # As MemoryHistoryStore.set_summary; the check and the update are one statement, so
+        # this holds across the processes sharing the database too
+        with self._lock, self._db:
+            updated = self._db.execute("UPDATE sessions SET summary = ?, summary_tokens = ? "
+                                       "WHERE session_id = ? AND summary = ?",
+                                       (summary, summary_tokens, session_id, previous)).rowcount
+            if updated:
+                self._db.execute("DELETE FROM messages WHERE session_id = ? AND id <= ?", (session_id, upto_id))
+        return bool(updated)
+
+    def clear(self, session_id):
+        with self._lock, self._db:
+            self._delete(session_id)
+
+
+def create_history_store(backend=CHAT_HISTORY_BACKEND):
+    if backend == 'memory':
+        return MemoryHistoryStore()
+    if backend.startswith('sqlite:'):
+        return SQLiteHistoryStore(backend[len('sqlite:'):])
+    raise ValueError(f"Unknown chat history backend {backend!r}")
+
+
+def messages_to_fold(history, budget=HISTORY_TOKEN_BUDGET, keep=HISTORY_KEEP_MESSAGES):
+    # The oldest messages to fold into the summary so the history fits the budget again,
+    # always leaving the most recent `keep` messages verbatim
+    if history.tokens <= budget:
+        return []
+    foldable = history.messages[:max(len(history.messages) - keep, 0)]
+    excess = history.tokens - budget
+    fold = []
+    for message in foldable:
+        fold.append(message)
+        excess -= message.tokens
+        if excess <= 0:
+            break
+    return fold
+
+
+def compress_history(store, session_id, summarize, count_tokens, budget=HISTORY_TOKEN_BUDGET):
+    # summarize(previous summary, [StoredMessage]) -> new summary. Folds whole turns, so the
+    # remaining history starts with a human message.
+    history = store.load(session_id)
+    fold = messages_to_fold(history, budget)
+    while fold and len(fold) < len(history.messages) and history.messages[len(fold)].role != 'human':
+        fold.append(history.messages[len(fold)])
+    if not fold:
+        return False
+    summary = summarize(history.summary, fold)
+    return store.set_summary(session_id, summary, count_tokens(summary), fold[-1].id, history.summary)
@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Read-only snapshot of the keyword collection for serving. The vectors are normalised to unit
+# length and quantised to int8 with a scale per vector (a quarter of the float32 size), stored in
+# flat files that are memory-mapped on the first search. Search is an exact inner-product scan;
+# a few thousand chunks do not need an approximate index. Chunk ids,
+# texts and metadata are those of the keyword index saved next to the collection, so the app
+# needs neither chromadb nor the collection's SQLite database. Built after generate_database.py,
+# e.g. in the Docker build stage:
+#   python compact_index.py
+SEARCH_BLOCK_ROWS = 4096  # rows converted to float32 at a time
+EXPORT_BATCH_SIZE = 1000
+
+
+def compact_index_directory(persist_directory, collection_name):
+    return os.path.join(persist_directory, f"compact_{collection_name}")
+
+
+def ids_hash(ids):
+    # Ties the vector rows to the order of the keyword index they are read with
+    return hashlib.sha256("\n".join(ids).encode('utf-8')).hexdigest()
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def quantize(vectors):
+    # int8 vectors and float32 scales, vector ~= int8 vector * scale
+    scales = np.abs(vectors).max(axis=-1) / 127
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+
+class CompactVectorStore:
+    # Implements the two search methods of the langchain Chroma store that HybridRetriever uses
+    def __init__(self, directory, manifest, embeddings, load_keyword_index):
+        self.directory = directory
+        self.manifest = manifest
+        self.embeddings = embeddings
+        self.load_keyword_index = load_keyword_index
+        self._vectors = None
+        self._scales = None
+        self._checked = False
+
+    def _map(self):
+        if self._vectors is None:
+            count, dimensions = self.manifest['count'], self.manifest['dimensions']
+            self._scales = np.memmap(os.path.join(self.directory, 'scales.f32'), dtype=np.float32, mode='r',
+                                     shape=(count,))
+            self._vectors = np.memmap(os.path.join(self.directory, 'vectors.i8'), dtype=np.int8, mode='r',
+                                      shape=(count, dimensions))
+        return self._vectors, self._scales
+
+    def _index(self):
+        index = self.load_keyword_index()
+        if not self._checked:
+            # The keyword index is rebuilt with the collection, so this only fails for files copied by hand
+            if index is None or ids_hash(index.ids) != self.manifest['ids_hash']:
+                raise RuntimeError(f"Compact index {self.directory} does not match the keyword index, "
+                                   f"rebuild it with compact_index.py")
+            self._checked = True
+        return index
+
+    def _scores(self, query):
+        vectors, scales = self._map()
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(scores), SEARCH_BLOCK_ROWS):
+            block = vectors[start:start + SEARCH_BLOCK_ROWS]
+            scores[start:start + len(block)] = (block.astype(np.float32) @ query) * scales[start:start + len(block)]
+        return scores
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        from langchain_core.documents import Document
+
+        index = self._index()
+        scores = self._scores(normalize(embedding))
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [Document(id=index.ids[i], page_content=index.texts[i], metadata=dict(index.metadatas[i]))
+                for i in best.tolist()]
+
+    def similarity_search(self, query, k=4):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k)
+
+
+def load_manifest(directory):
+    path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def open_compact_index(directory, collection_version, get_embeddings, load_keyword_index):
+    # None if there is no compact index, or it was built from another version of the collection.
+    # get_embeddings(model) returns the embeddings for the model the index was built with.
+    manifest = load_manifest(directory)
+    if manifest is None:
+        return None
+    if manifest.get('collection_version') != collection_version:
+        print(f"Compact index {directory} is out of date, rebuild it with compact_index.py")
+        return None
+    return CompactVectorStore(directory, manifest, get_embeddings(manifest['embedding_model']), load_keyword_index)
+
+
+def build_compact_index(collection, index, directory, embedding_model, collection_version='',
+                        batch_size=EXPORT_BATCH_SIZE):
+    # Vectors in the order of the keyword index, read from the collection without embedding anything
+    os.makedirs(directory, exist_ok=True)
+    vectors = None
+    for start in range(0, len(index.ids), batch_size):
+        ids = index.ids[start:start + batch_size]
+        data = collection.get(ids=ids, include=["embeddings"])
+        rows = dict(zip(data['ids'], data['embeddings']))
+        batch = normalize([rows[chunk_id] for chunk_id in ids])
+        if vectors is None:
+            vectors = np.empty((len(index.ids), batch.shape[1]), dtype=np.int8)
+            scales = np.empty(len(index.ids), dtype=np.float32)
+        vectors[start:start + len(ids)], scales[start:start + len(ids)] = quantize(batch)
+    if vectors is None:
+        raise ValueError("The collection is empty")
+    # Raw files without a header, mapped with the shape from the manifest
+    for name, array in (('vectors.i8', vectors), ('scales.f32', scales)):
+        path = os.path.join(directory, name)
+        array.tofile(path + '.tmp')
+        os.replace(path + '.tmp', path)
+    manifest = {
+        'count': len(index.ids),
+        'dimensions': int(vectors.shape[1]),
+        'embedding_model': embedding_model,
+        'collection_version': collection_version,
+        'ids_hash': ids_hash(index.ids),
+    }
+    with open(os.path.join(directory, 'manifest.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(directory, 'manifest.json.tmp'), os.path.join(directory, 'manifest.json'))
+    return manifest
+
+
+def main():
+    from rag_chain import (KEYWORD_COLLECTION, KEYWORD_PERSIST_DIRECTORY, LEGACY_EMBEDDING_MODEL, collection_version,
+                           use_pysqlite3)
+
+    parser = argparse.ArgumentParser(description="Export the keyword collection to a compact read-only index")
+    parser.add_argument("--collection", default=KEYWORD_COLLECTION)
+    args = parser.parse_args()
+
+    use_pysqlite3()
+    import chromadb
+    from keyword_index import keyword_index_path, load_keyword_index
+
+    index = load_keyword_index(keyword_index_path(KEYWORD_PERSIST_DIRECTORY, args.collection))
+    if index is None:
+        raise SystemExit("No keyword index, run generate_database.py first")
+    collection = chromadb.PersistentClient(path=KEYWORD_PERSIST_DIRECTORY).get_collection(args.collection)
+    model = (collection.metadata or {}).get('embedding_model', LEGACY_EMBEDDING_MODEL)
+    directory = compact_index_directory(KEYWORD_PERSIST_DIRECTORY, args.collection)
+    manifest = build_compact_index(collection, index, directory, model, collection_version(args.collection))
+    size = os.path.getsize(os.path.join(directory, 'vectors.i8'))
+    print(f"Compact index of {manifest['count']} chunks x {manifest['dimensions']} dimensions "
+          f"({size / 1e6:.1f} MB) saved to {directory}")
+
+
+if __name__ == "__main__":
+    main()
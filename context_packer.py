@@ -0,0 +1,165 @@
+import re
+
+from tokens import count_tokens
+
+# Packs retrieved chunks into the prompt under a token budget. Overlapping chunks of the same
+# page (the splitter repeats up to CHUNK_OVERLAP characters between neighbours) are merged,
+# near-duplicates (the same keyword page exported under several chapters) are dropped, and the
+# rest are added in relevance order until the model's budget is full. Before that, chunks of
+# the structure-aware chunker can be expanded to their whole page (expand_to_parents).
+CONTEXT_TOKENS = {
+    "gpt-4o-mini": 6000,
+    "gpt-4o": 4000,
+}
+DEFAULT_CONTEXT_TOKENS = 4000
+MIN_OVERLAP_CHARS = 20  # shorter common text between two chunks is not treated as overlap
+MAX_OVERLAP_CHARS = 500
+SHINGLE_WORDS = 5
+NEAR_DUPLICATE_SIMILARITY = 0.8  # Jaccard similarity of word shingles
+MIN_TRUNCATED_TOKENS = 200  # a chunk is only cut to fit if at least this much of it remains
+PARENT_MIN_CHUNKS = 2  # chunks of one page that are replaced by the whole page...
+PARENT_MAX_TOKENS = 1500  # ...if the page is at most this long
+
+WORD_PATTERN = re.compile(r"\S+")
+
+
+class PackedContext:
+    def __init__(self, documents, retrieved_tokens, packed_tokens, merged, dropped):
+        self.documents = documents
+        self.retrieved_tokens = retrieved_tokens
+        self.packed_tokens = packed_tokens
+        self.merged = merged  # chunks merged into a neighbour
+        self.dropped = dropped  # near-duplicates and chunks that did not fit
+
+    @property
+    def saved_tokens(self):
+        return self.retrieved_tokens - self.packed_tokens
+
+
+def overlap_merge(first, second):
+    # first + second with their common text once, if second continues first; otherwise None
+    if second in first:
+        return first
+    head = second[:MIN_OVERLAP_CHARS]
+    tail_start = max(len(first) - MAX_OVERLAP_CHARS, 0)
+    position = first.find(head, tail_start)
+    while position != -1:
+        overlap = len(first) - position
+        if second.startswith(first[position:]) and overlap >= MIN_OVERLAP_CHARS:
+            return first + second[overlap:]
+        position = first.find(head, position + 1)
+    return None
+
+
+def shingles(text):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def merge_overlapping(documents):
+    # Groups are kept at the rank of their best chunk; chunks are joined in page order
+    from langchain_core.documents import Document
+
+    groups = []  # [source, text, best document]
+    merged = 0
+    for document in documents:
+        source = document.metadata.get('source')
+        text = document.page_content
+        for group in groups:
+            if source is None or group[0] != source:
+                continue
+            joined = overlap_merge(group[1], text)
+            if joined is None:
+                joined = overlap_merge(text, group[1])
+            if joined is not None:
+                group[1] = joined
+                merged += 1
+                break
+        else:
+            groups.append([source, text, document])
+    packed = [document if text == document.page_content else
+              Document(id=document.id, page_content=text, metadata=document.metadata)
+              for _, text, document in groups]
+    return packed, merged
+
+
+def drop_near_duplicates(documents):
+    kept, kept_shingles = [], []
+    for document in documents:
+        document_shingles = shingles(document.page_content)
+        if any(similarity(document_shingles, other) >= NEAR_DUPLICATE_SIMILARITY for other in kept_shingles):
+            continue
+        kept.append(document)
+        kept_shingles.append(document_shingles)
+    return kept, len(documents) - len(kept)
+
+
+def truncate_to_tokens(text, tokens, model=None):
+    # Cut at a line break, estimating the cut from the text's own characters per token
+    cut = int(len(text) * tokens / max(count_tokens(text, model), 1))
+    while cut > 0 and count_tokens(text[:cut], model) > tokens:
+        cut = int(cut * 0.9)
+    line_end = text.rfind("\n", 0, cut)
+    return text[:line_end if line_end > cut // 2 else cut]
+
+
+def expand_to_parents(documents, load_page, model=None, min_chunks=PARENT_MIN_CHUNKS, max_tokens=PARENT_MAX_TOKENS):
+    # Small-to-big: several retrieved chunks of a short page are replaced by the page, at the
+    # rank of its best chunk. load_page(parent) returns the page text or None.
+    from langchain_core.documents import Document
+
+    counts = {}
+    for document in documents:
+        parent = document.metadata.get('parent')
+        if parent:
+            counts[parent] = counts.get(parent, 0) + 1
+    pages = {}
+    for parent, count in counts.items():
+        if count >= min_chunks:
+            text = load_page(parent)
+            if text and count_tokens(text, model) <= max_tokens:
+                pages[parent] = text
+
+    expanded = []
+    for document in documents:
+        parent = document.metadata.get('parent')
+        if parent not in pages:
+            expanded.append(document)
+        elif pages[parent] is not None:
+            metadata = {key: value for key, value in document.metadata.items() if key not in ('part', 'items')}
+            expanded.append(Document(id=parent, page_content=pages[parent], metadata={**metadata, 'part': 'page'}))
+            pages[parent] = None
+    return expanded, sum(1 for parent in pages)
+
+
+def pack_context(documents, model=None, max_tokens=None):
+    # `documents` best first, as returned by the retriever
+    from langchain_core.documents import Document
+
+    budget = max_tokens or CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    retrieved_tokens = sum(count_tokens(document.page_content, model) for document in documents)
+    candidates, merged = merge_overlapping(documents)
+    candidates, dropped = drop_near_duplicates(candidates)
+
+    packed, used = [], 0
+    for document in candidates:
+        tokens = count_tokens(document.page_content, model)
+        if used + tokens <= budget:
+            packed.append(document)
+            used += tokens
+        elif not packed and budget >= MIN_TRUNCATED_TOKENS:
+            # The best chunk alone is over the budget; keep its beginning
+            text = truncate_to_tokens(document.page_content, budget, model)
+            packed.append(Document(id=document.id, page_content=text, metadata=document.metadata))
+            used += count_tokens(text, model)
+        else:
+            dropped += 1
+    return PackedContext(packed, retrieved_tokens, used, merged, dropped)
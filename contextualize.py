@@ -0,0 +1,31 @@
+import re
+
+# Cheap check for whether a follow-up question needs the history-aware rewrite (an extra LLM
+# round-trip) before retrieval. Errs on the side of rewriting: a needless rewrite only costs
+# latency, a missed one retrieves for the wrong question.
+SHORT_QUESTION_WORDS = 3
+# Pronouns and references that point back into the conversation
+REFERENCE_PATTERN = re.compile(
+    r"\b(it|its|it's|this|that|these|those|they|them|their|theirs|he|she|him|her|"
+    r"above|previous|previously|earlier|same|former|latter|again|instead|else)\b",
+    re.IGNORECASE,
+)
+# Openings that continue the previous turn, e.g. "and for gas?", "what about WCONINJE?"
+FOLLOW_UP_START_PATTERN = re.compile(
+    r"^\s*(and|but|or|also|so|then|ok|okay|yes|no|what about|how about|why not|why)\b",
+    re.IGNORECASE,
+)
+
+
+def needs_contextualization(question, chat_history):
+    if not chat_history:
+        return False
+    if len(question.split()) <= SHORT_QUESTION_WORDS:
+        return True
+    if FOLLOW_UP_START_PATTERN.match(question):
+        return True
+    return bool(REFERENCE_PATTERN.search(question))
+
+
+def normalize_question(question):
+    return " ".join(re.findall(r"\w+", question.lower()))
@@ -0,0 +1,204 @@
+import re
+
+import numpy as np
+
+from deck_parser import SECTIONS, TABLE_COLUMNS, format_item, keyword_to_text
+from tokens import count_tokens
+
+# Question-dependent context from uploaded decks. Each deck is summarised once into per-keyword
+# blocks, with bulky numeric arrays (COORD, ZCORN, PERMX, ...) replaced by shape/statistics
+# stubs. For each question the blocks relevant to it are packed under a token budget.
+DECK_CONTEXT_TOKENS = {"gpt-4o-mini": 4000, "gpt-4o": 4000}
+DEFAULT_DECK_CONTEXT_TOKENS = 4000
+STUB_VALUES = 50  # arrays with more values than this are summarised
+STUB_TABLE_ROWS = 100  # table keywords with more rows than this are summarised
+STUB_RECORDS = 40  # keywords with more records than this are cut
+MAX_DISTINCT_LISTED = 10  # integer arrays with at most this many distinct values list their counts
+TOKENS_PER_VALUE = 2  # rough cost of one value in a full array, for reporting the savings
+
+# Words in a question that point to a deck section, matched as whole words (plurals included)
+SECTION_HINTS = {
+    "RUNSPEC": ["runspec", "dimension", "phase", "unit", "start date", "tabdims", "welldims"],
+    "GRID": ["grid", "permeability", "porosity", "perm", "poro", "geometry", "corner point", "cell", "depth",
+             "tops", "fault", "thickness", "net to gross"],
+    "EDIT": ["edit", "transmissibility", "pore volume"],
+    "PROPS": ["props", "relative permeability", "relperm", "pvt", "capillary", "fluid", "density", "viscosity",
+              "compressibility", "saturation", "table"],
+    "REGIONS": ["region", "satnum", "pvtnum", "eqlnum", "fipnum"],
+    "SOLUTION": ["solution", "initial", "initialisation", "initialization", "equilibrium",
+                 "equilibration", "contact", "owc", "goc", "woc", "init"],
+    "SUMMARY": ["summary", "output", "vector", "report"],
+    "SCHEDULE": ["schedule", "well", "production", "producer", "injection", "injector", "rate", "control",
+                 "completion", "perforation", "perforated", "time step", "timestep", "date", "bhp", "group", "history"],
+}
+# Phrases removed before matching the hints ("as well" is not about wells)
+NOT_SECTION_HINTS = re.compile(r"\bas well\b")
+# Questions about the uploaded deck itself rather than about the simulator in general
+DECK_QUESTION_PATTERN = re.compile(r"\b(my|our|this|uploaded|attached)\s+(input\s+)?(deck|data file)\b",
+                                   re.IGNORECASE)
+KEYWORD_MATCH_SCORE = 10
+SECTION_MATCH_SCORE = 3
+RUNSPEC_SCORE = 1  # model dimensions and phases help with almost any question
+
+_section_patterns = {section: re.compile(r"\b(?:" + "|".join(re.escape(hint) for hint in [section.lower()] + hints)
+                                         + r")(?:s|es)?\b")
+                     for section, hints in SECTION_HINTS.items()}
+
+
+class DeckBlock:
+    def __init__(self, name, section, text, tokens):
+        self.name = name
+        self.section = section
+        self.text = text
+        self.tokens = tokens
+
+
+class DeckSummary:
+    def __init__(self, name, outline, blocks, original_tokens):
+        self.name = name
+        self.outline = outline
+        self.blocks = blocks
+        self.original_tokens = original_tokens
+
+    def to_dict(self):
+        # JSON form, for sending decks to the API server (api_server.py)
+        return {'name': self.name, 'outline': self.outline, 'original_tokens': self.original_tokens,
+                'blocks': [vars(block) for block in self.blocks]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['outline'], [DeckBlock(**block) for block in data['blocks']],
+                   data['original_tokens'])
+
+
+def array_stub(keyword):
+    values = np.asarray(keyword.values)
+    lines = [keyword.name, f"-- {len(values)} values ({values.dtype}), summarised"]
+    finite = values[np.isfinite(values)] if values.dtype.kind == 'f' else values
+    if len(finite) < len(values):
+        lines.append(f"-- {len(values) - len(finite)} defaulted")
+    if len(finite):
+        if values.dtype.kind == 'i':
+            distinct, counts = np.unique(finite, return_counts=True)
+            if len(distinct) <= MAX_DISTINCT_LISTED:
+                listed = ", ".join(f"{value}: {count}" for value, count in zip(distinct, counts))
+                lines.append(f"-- value counts {listed}")
+                return "\n".join(lines)
+        lines.append(f"-- min {finite.min():g}, max {finite.max():g}, mean {finite.mean():g}")
+    return "\n".join(lines)
+
+
+def table_stub(keyword):
+    lines = [keyword.name, f"-- columns {' '.join(TABLE_COLUMNS[keyword.name])}"]
+    for i, table in enumerate(keyword.tables(), 1):
+        ranges = ", ".join(f"{column} {np.nanmin(table[:, j]):g}..{np.nanmax(table[:, j]):g}"
+                           for j, column in enumerate(TABLE_COLUMNS[keyword.name]))
+        lines.append(f"-- table {i}: {len(table)} rows, {ranges}")
+    return "\n".join(lines)
+
+
+def records_excerpt(keyword):
+    lines = [keyword.name]
+    for record in keyword.records[:STUB_RECORDS]:
+        lines.append(" ".join([format_item(item) for item in record] + ["/"]))
+    lines.append(f"-- {len(keyword.records) - STUB_RECORDS} more records")
+    lines.append("/")
+    return "\n".join(lines)
+
+
+def summarize_keyword(keyword):
+    # Returns the text to show and whether it is a summary rather than the full keyword
+    if keyword.is_numeric:
+        if keyword.name in TABLE_COLUMNS:
+            if sum(len(table) for table in keyword.tables()) > STUB_TABLE_ROWS:
+                return table_stub(keyword), True
+        elif len(keyword.values) > STUB_VALUES:
+            return array_stub(keyword), True
+    elif len(keyword.records) > STUB_RECORDS:
+        return records_excerpt(keyword), True
+    return keyword_to_text(keyword), False
+
+
+def summarize_deck(deck, model=None):
+    blocks = []
+    original_tokens = 0
+    for keyword in deck.keywords:
+        if keyword.name in SECTIONS:
+            continue
+        text, summarised = summarize_keyword(keyword)
+        tokens = count_tokens(text, model)
+        blocks.append(DeckBlock(keyword.name, keyword.section, text, tokens))
+        # What the full keyword would have cost, estimated rather than rendering huge arrays
+        original_tokens += len(keyword) * TOKENS_PER_VALUE if summarised else tokens
+
+    outline = [f"Deck {deck.name} outline (keywords per section):"]
+    by_section = {}
+    for block in blocks:
+        by_section.setdefault(block.section or "NO SECTION", []).append(block.name)
+    for section, names in by_section.items():
+        outline.append(f"{section}: {' '.join(dict.fromkeys(names))}")
+    if deck.missing_includes:
+        outline.append(f"INCLUDE files not uploaded: {' '.join(deck.missing_includes)}")
+    return DeckSummary(deck.name, "\n".join(outline), blocks, original_tokens)
+
+
+def question_sections(question):
+    text = NOT_SECTION_HINTS.sub(" ", question.lower())
+    return {section for section, pattern in _section_patterns.items() if pattern.search(text)}
+
+
+def question_keywords(question):
+    return {token.upper() for token in re.findall(r"[A-Za-z][A-Za-z0-9_+-]{1,7}", question)}
+
+
+def is_deck_question(question):
+    return DECK_QUESTION_PATTERN.search(question) is not None
+
+
+def select_deck_context(summaries, question, model=None, max_tokens=None):
+    # Returns (context text, tokens used, tokens of the full decks)
+    if max_tokens is None:
+        max_tokens = DECK_CONTEXT_TOKENS.get(model, DEFAULT_DECK_CONTEXT_TOKENS)
+    keywords = question_keywords(question)
+    sections = question_sections(question)
+
+    parts = []
+    used = 0
+    original = 0
+    for summary in summaries:
+        original += summary.original_tokens
+        outline_tokens = count_tokens(summary.outline, model)
+        if used + outline_tokens > max_tokens:
+            break
+        used += outline_tokens
+
+        scored = []
+        for position, block in enumerate(summary.blocks):
+            score = 0
+            if block.name in keywords:
+                score += KEYWORD_MATCH_SCORE
+            if block.section in sections:
+                score += SECTION_MATCH_SCORE
+            if block.section == "RUNSPEC":
+                score += RUNSPEC_SCORE
+            scored.append((-score, position, block))
+        # Best blocks first; without any match this is simply deck order
+        chosen = []
+        for _, position, block in sorted(scored, key=lambda item: item[:2]):
+            if used + block.tokens > max_tokens:
+                continue
+            chosen.append((position, block))
+            used += block.tokens
+
+        lines = [summary.outline, f"Selected keywords from {summary.name}:"]
+        section = None
+        for _, block in sorted(chosen, key=lambda item: item[0]):
+            if block.section != section and block.section:
+                section = block.section
+                lines.append(section)
+            lines.append(block.text)
+        omitted = len(summary.blocks) - len(chosen)
+        if omitted:
+            lines.append(f"-- {omitted} keywords omitted")
+        parts.append("\n".join(lines))
+    return "\n\n".join(parts), used, original
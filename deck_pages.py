@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+
+# Manual pages of the keywords used in a session's uploads (FileProcessResult.keywords), looked
+# up once per session: the keyword index chunks of each page, which retrieval favours (see
+# HybridRetriever), and the full pages for small-to-big expansion. They are fetched when an
+# upload is stored, or on the first question that sends the keywords (API server).
+DECK_PAGE_SESSIONS = 256
+
+
+class DeckPages:
+    def __init__(self):
+        self.chunks = {}  # keyword -> keyword index rows of its page(s)
+        self.pages = {}  # parent -> full page text
+
+    def chunk_set(self, keywords):
+        return {i for keyword in keywords for i in self.chunks.get(keyword, ())}
+
+    def load_page(self, parent, page_store):
+        text = self.pages.get(parent)
+        return text if text is not None else page_store.get(parent)
+
+
+class DeckPageCache:
+    def __init__(self, max_sessions=DECK_PAGE_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session id -> DeckPages, least recently used first
+        self._lock = threading.Lock()
+
+    def prefetch(self, session_id, keywords, index, page_store=None):
+        # The session's pages, with those of `keywords` added if they are not there yet
+        with self._lock:
+            pages = self._sessions.get(session_id)
+            if pages is None:
+                pages = self._sessions[session_id] = DeckPages()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            missing = [keyword for keyword in keywords if keyword not in pages.chunks]
+            for keyword in missing:
+                pages.chunks[keyword] = list(index.by_title.get(keyword, ()))
+        if page_store is not None:
+            parents = {index.metadatas[i].get('parent') for keyword in missing for i in pages.chunks[keyword]}
+            for parent in parents - {None}:
+                text = page_store.get(parent)
+                if text is not None:
+                    pages.pages[parent] = text
+        return pages
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
@@ -0,0 +1,434 @@
+import io
+import os
+import re
+from array import array
+
+import numpy as np
+
+# Streaming parser for ECLIPSE/OPM Flow input decks. Lines are consumed one at a time, so
+# the deck text is never held in memory; numeric keyword data (grid arrays, saturation and
+# PVT tables) is accumulated in compact float arrays and exposed as NumPy arrays.
+SECTIONS = ["RUNSPEC", "GRID", "EDIT", "PROPS", "REGIONS", "SOLUTION", "SUMMARY", "SCHEDULE"]
+
+# Column names of the table keywords, in file order
+TABLE_COLUMNS = {
+    "SWOF": ["SW", "KRW", "KROW", "PCOW"],
+    "SGOF": ["SG", "KRG", "KROG", "PCOG"],
+    "SLGOF": ["SL", "KRG", "KROG", "PCOG"],
+    "SGWFN": ["SG", "KRG", "KRW", "PCGW"],
+    "SWFN": ["SW", "KRW", "PCOW"],
+    "SGFN": ["SG", "KRG", "PCOG"],
+    "SOF2": ["SO", "KRO"],
+    "SOF3": ["SO", "KROW", "KROG"],
+    "PVDG": ["P", "BG", "MUG"],
+    "PVDO": ["P", "BO", "MUO"],
+    "PVTW": ["PREF", "BW", "CW", "MUW", "CVW"],
+    "PVCDO": ["PREF", "BO", "CO", "MUO", "CVO"],
+    "ROCK": ["PREF", "CR"],
+    "DENSITY": ["OIL", "WATER", "GAS"],
+    # Live oil / wet gas: each record is the outer value followed by rows of the inner columns,
+    # and an empty record ends a table. Rows are flattened with the outer value repeated.
+    "PVTO": ["RS", "P", "BO", "MUO"],
+    "PVTG": ["PG", "RV", "BG", "MUG"],
+}
+NESTED_TABLES = {"PVTO", "PVTG"}
+
+# Keywords whose single data line is not terminated by a slash
+UNTERMINATED_KEYWORDS = {"TITLE"}
+
+MAX_INCLUDE_DEPTH = 10
+NUMERIC_FLUSH_TOKENS = 100000  # numeric tokens converted in bulk, bounding the pending list
+LARGE_ARRAY_VALUES = 100000
+
+KEYWORD_LINE_PATTERN = re.compile(r"^([A-Z][A-Z0-9_+-]{0,7})\s*$")
+TOKEN_PATTERN = re.compile(r"'[^']*'|\"[^\"]*\"|/|[^\s/'\"]+")
+REPEAT_PATTERN = re.compile(r"^(\d+)\*(.*)$")
+NUMERIC_LINE_PATTERN = re.compile(r"^[\d.eE+\-\s]+$")
+
+
+class DeckKeyword:
+    def __init__(self, name, section, file_name, line_number):
+        self.name = name
+        self.section = section
+        self.file_name = file_name
+        self.line_number = line_number
+        self.values = array('d')  # numeric data, NaN for defaulted items
+        self.record_ends = []  # offsets into values where each record ends
+        self.records = None  # token lists, once the keyword turns out not to be purely numeric
+        self._record = None  # open (not yet terminated) record in token list mode
+        self._pending = []  # numeric tokens not yet converted
+        self._record_open = False
+        self.terminated = False  # ended by an empty record
+
+    @property
+    def is_numeric(self):
+        return self.records is None
+
+    @property
+    def between_records(self):
+        return not self._record_open
+
+    def __len__(self):
+        return len(self.values) if self.is_numeric else sum(len(record) for record in self.records)
+
+    def add_tokens(self, tokens):
+        for token in tokens:
+            if token == '/':
+                self.end_record()
+                continue
+            self._record_open = True
+            if self.records is None:
+                if _is_plain_number(token):
+                    self._pending.append(token)
+                    if len(self._pending) >= NUMERIC_FLUSH_TOKENS:
+                        self._flush()
+                    continue
+                value = parse_value(token)
+                if isinstance(value, tuple) and (value[1] is None or isinstance(value[1], float)):
+                    self._flush()
+                    count, repeated = value
+                    self.values.extend([np.nan if repeated is None else repeated] * count)
+                    continue
+                self._to_records()
+            self._record.extend(expand_value(parse_value(token)))
+
+    def add_numeric_line(self, tokens):
+        # Fast path for lines of plain numbers inside a numeric keyword
+        self._record_open = True
+        self._pending.extend(tokens)
+        if len(self._pending) >= NUMERIC_FLUSH_TOKENS:
+            self._flush()
+
+    def end_record(self):
+        if self.records is None:
+            self._flush()
+            self.record_ends.append(len(self.values))
+        elif self._record_open:
+            self.records.append(self._record)
+            self._record = []
+        else:
+            # An empty record only terminates the keyword; it carries data for numeric tables only
+            self.terminated = True
+        self._record_open = False
+
+    def finish(self):
+        if self.records is None:
+            self._flush()
+            if self._record_open:
+                self.record_ends.append(len(self.values))
+            values = np.frombuffer(self.values, dtype=np.float64) if len(self.values) else np.zeros(0)
+            self.values = _compact(values)
+        elif self._record_open:
+            self.records.append(self._record)
+        self._record = None
+        self._record_open = False
+        self._pending = []
+
+    def _flush(self):
+        if self._pending:
+            try:
+                values = np.asarray(self._pending, dtype=np.float64)
+            except ValueError:
+                # A malformed number slipped through the fast path; treat it as defaulted
+                values = np.array([float(token) if _is_plain_number(token) else np.nan for token in self._pending])
+            self.values.frombytes(values.tobytes())
+            self._pending = []
+
+    def _to_records(self):
+        # A string item: this keyword is not an array, keep its records as token lists
+        self._flush()
+        values = [None if np.isnan(v) else v for v in self.values]
+        starts = [0] + self.record_ends
+        self.records = [values[start:end] for start, end in zip(starts, self.record_ends)]
+        self._record = values[starts[-1]:]
+        self.values = array('d')
+        self.record_ends = []
+
+    def record_arrays(self):
+        if not self.is_numeric:
+            return []
+        starts = [0] + self.record_ends[:-1]
+        return [self.values[start:end] for start, end in zip(starts, self.record_ends)]
+
+    def tables(self):
+        # Table keywords as a list of 2D arrays (rows x TABLE_COLUMNS[name]), one per table
+        columns = TABLE_COLUMNS.get(self.name)
+        if columns is None or not self.is_numeric:
+            return []
+        width = len(columns)
+        if self.name not in NESTED_TABLES:
+            return [record[:len(record) - len(record) % width].reshape(-1, width)
+                    for record in self.record_arrays() if len(record)]
+        tables, rows = [], []
+        for record in self.record_arrays():
+            if not len(record):
+                if rows:
+                    tables.append(np.vstack(rows))
+                rows = []
+                continue
+            inner = record[1:len(record) - (len(record) - 1) % (width - 1)].reshape(-1, width - 1)
+            rows.append(np.column_stack([np.full(len(inner), record[0]), inner]))
+        if rows:
+            tables.append(np.vstack(rows))
+        return tables
+
+    def table_dicts(self):
+        columns = TABLE_COLUMNS.get(self.name, [])
+        return [{column: table[:, i] for i, column in enumerate(columns)} for table in self.tables()]
+
+
+class Deck:
+    def __init__(self, name):
+        self.name = name
+        self.keywords = []
+        self.includes = []
+        self.missing_includes = []
+
+    def __iter__(self):
+        return iter(self.keywords)
+
+    def __contains__(self, name):
+        return any(keyword.name == name for keyword in self.keywords)
+
+    def __getitem__(self, name):
+        return [keyword for keyword in self.keywords if keyword.name == name]
+
+    def keyword_names(self):
+        return list(dict.fromkeys(keyword.name for keyword in self.keywords))
+
+    def sections(self):
+        return [keyword.name for keyword in self.keywords if keyword.name in SECTIONS]
+
+    def tables(self, name):
+        return [table for keyword in self[name] for table in keyword.table_dicts()]
+
+
+def _is_plain_number(token):
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+def _compact(values):
+    # Integer-valued arrays (ACTNUM, SATNUM, ...) are stored as int32, large grid property
+    # arrays as float32; tables keep full precision
+    if len(values) and np.isfinite(values).all() and (values == np.round(values)).all() \
+            and np.abs(values).max() < 2 ** 31:
+        return values.astype(np.int32)
+    if len(values) > LARGE_ARRAY_VALUES:
+        return values.astype(np.float32)
+    return values.copy()
+
+
+def parse_value(token):
+    # Numbers become floats, quoted strings lose their quotes, N*value is (N, value) and
+    # N* (defaulted items) is (N, None)
+    if token[0] in "'\"":
+        return token[1:-1]
+    match = REPEAT_PATTERN.match(token)
+    if match:
+        count, repeated = int(match.group(1)), match.group(2)
+        return count, (parse_value(repeated) if repeated else None)
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def expand_value(value):
+    if isinstance(value, tuple):
+        return [value[1]] * value[0]
+    return [value]
+
+
+def strip_comment(line):
+    if "--" not in line:
+        return line
+    if "'" not in line and '"' not in line:
+        return line.split("--", 1)[0]
+    # Only strip comments outside quoted strings
+    quote = None
+    for i, char in enumerate(line):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif line.startswith("--", i):
+            return line[:i]
+    return line
+
+
+def tokenize_line(line):
+    # Everything after a record terminator on the same line is a comment
+    tokens = TOKEN_PATTERN.findall(line)
+    if '/' in tokens:
+        tokens = tokens[:tokens.index('/') + 1]
+    return tokens
+
+
+def parse_deck(lines, name="deck", open_include=None):
+    # `lines` is any iterable of text lines. `open_include(path)` returns an iterable of lines
+    # for an INCLUDE'd file, or None if it is not available.
+    deck = Deck(name)
+    state = {'section': None, 'keyword': None}
+    _parse_lines(deck, lines, name, open_include, state, depth=0, active=set())
+    if state['keyword'] is not None:
+        state['keyword'].finish()
+    return deck
+
+
+def _parse_lines(deck, lines, file_name, open_include, state, depth, active):
+    active = active | {file_name}
+    for line_number, line in enumerate(lines, 1):
+        line = strip_comment(line).strip()
+        if not line:
+            continue
+        keyword = state['keyword']
+
+        match = KEYWORD_LINE_PATTERN.match(line)
+        # A section name always starts a new keyword, even if the previous record lacks its slash
+        if match and (keyword is None or keyword.between_records or match.group(1) in SECTIONS):
+            if keyword is not None:
+                keyword.finish()
+            name = match.group(1)
+            if name in SECTIONS:
+                state['section'] = name
+            keyword = DeckKeyword(name, state['section'], file_name, line_number)
+            deck.keywords.append(keyword)
+            state['keyword'] = keyword
+            continue
+
+        if keyword is None:
+            continue  # text before the first keyword
+        if keyword.name in UNTERMINATED_KEYWORDS:
+            keyword.add_tokens(tokenize_line(line) + ['/'])
+            continue
+        if keyword.is_numeric and NUMERIC_LINE_PATTERN.match(line):
+            keyword.add_numeric_line(line.split())
+        else:
+            keyword.add_tokens(tokenize_line(line))
+            if keyword.name == "INCLUDE" and keyword.between_records:
+                keyword.finish()
+                _include(deck, keyword, open_include, state, depth, active)
+
+
+def _include(deck, keyword, open_include, state, depth, active):
+    # INCLUDE is resolved as soon as its record is complete; the included keywords take its place
+    if deck.keywords and deck.keywords[-1] is keyword:
+        deck.keywords.pop()
+    state['keyword'] = None
+    path = next((item for record in keyword.records or [] for item in record if isinstance(item, str)), None)
+    if path is None:
+        return
+    lines = open_include(path) if open_include and depth < MAX_INCLUDE_DEPTH and path not in active else None
+    if lines is None:
+        deck.missing_includes.append(path)
+        return
+    deck.includes.append(path)
+    _parse_lines(deck, lines, path, open_include, state, depth + 1, active)
+    if state['keyword'] is not None:
+        state['keyword'].finish()
+        state['keyword'] = None
+
+
+def format_values(values, max_items=None):
+    # Run-length encode numeric data with the deck's own repeat syntax (N*value, N* for defaults)
+    values = np.asarray(values)
+    if not len(values):
+        return []
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    counts = np.diff(np.append(starts, len(values)))
+    items = []
+    for start, count in zip(starts[:max_items], counts[:max_items]):
+        value = values[start]
+        text = '' if np.isnan(value) else f"{value:g}"
+        items.append(f"{count}*{text}" if count > 1 or not text else text)
+    return items
+
+
+def format_item(item):
+    if item is None or item != item:
+        return '1*'
+    if isinstance(item, str):
+        return f"'{item}'"
+    return f"{item:g}"
+
+
+def keyword_to_text(keyword, max_items=None):
+    lines = [keyword.name]
+    if keyword.name in UNTERMINATED_KEYWORDS:
+        lines.extend(" ".join(str(item) for item in record) for record in keyword.records or [])
+    elif keyword.name in TABLE_COLUMNS and keyword.name not in NESTED_TABLES and keyword.is_numeric:
+        # One table row per line, under a comment naming the columns
+        lines.append("-- " + " ".join(TABLE_COLUMNS[keyword.name]))
+        for table in keyword.tables()[:max_items]:
+            lines.extend(" ".join(format_item(float(value)) for value in row) for row in table)
+            lines[-1] += " /"
+    elif keyword.is_numeric:
+        for record in keyword.record_arrays():
+            lines.append(" ".join(format_values(record, max_items) + ["/"]))
+    else:
+        for record in keyword.records:
+            lines.append(" ".join([format_item(item) for item in record[:max_items]] + ["/"]))
+        if keyword.terminated:
+            lines.append("/")
+    return "\n".join(lines)
+
+
+def deck_to_text(deck, max_words):
+    # Rebuild a compact deck text from the parsed keywords, stopping at whole keywords once
+    # the word budget is spent
+    parts = []
+    words = 0
+    for i, keyword in enumerate(deck.keywords):
+        text = keyword_to_text(keyword, max_items=max(max_words - words, 1))
+        keyword_words = len(text.split())
+        if words + keyword_words > max_words and parts:
+            remaining = dict.fromkeys(k.name for k in deck.keywords[i:])
+            parts.append(f"-- deck truncated, {len(deck.keywords) - i} more keywords: {' '.join(remaining)}")
+            break
+        parts.append(text)
+        words += keyword_words
+    return "\n".join(parts)
+
+
+def iter_text_lines(data):
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='replace')
+
+
+def include_name(path):
+    # Uploads are matched by file name only
+    return os.path.basename(path.replace('\\', '/')).lower()
+
+
+def include_names(data):
+    # File names of the INCLUDE statements of a deck, without parsing its keywords
+    names = []
+    in_include = False
+    for line in iter_text_lines(data):
+        line = strip_comment(line).strip()
+        if not line:
+            continue
+        if in_include:
+            tokens = tokenize_line(line)
+            if tokens and tokens[0] != '/':
+                names.append(include_name(tokens[0].strip('\'"')))
+            in_include = False
+        else:
+            in_include = line == "INCLUDE"
+    return names
+
+
+def parse_deck_bytes(data, name, files=None):
+    # Parse an uploaded deck; INCLUDE paths are resolved by file name among `files`
+    # (a mapping of uploaded file name to bytes)
+    by_name = {include_name(file_name): content for file_name, content in (files or {}).items()}
+
+    def open_include(path):
+        content = by_name.get(include_name(path))
+        return iter_text_lines(content) if content is not None else None
+
+    return parse_deck(iter_text_lines(data), name, open_include)
@@ -0,0 +1,284 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# Embedding providers, selected by a model spec "provider:name":
+#   openai:text-embedding-3-small       OpenAI API (the default provider when no prefix is given)
+#   onnx:all-MiniLM-L6-v2               local CPU ONNX model shipped with chromadb
+#   sentence-transformers:<model name>  local model, needs the sentence-transformers package
+#   hashing:512                         feature hashing, no model files (see local_models.py)
+# Every provider is wrapped in an on-disk cache of vectors keyed by (model, text hash), so
+# repeated texts and queries are not embedded twice, across processes and restarts.
+EMBEDDING_MODEL = os.getenv("OPM_EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_CACHE_DIRECTORY = "./cache/embeddings"
+LOCAL_EMBEDDING_BATCH_SIZE = 64
+CACHE_INITIAL_ROWS = 1024
+EMBEDDING_CACHE_MAX_ROWS = 100000  # then the least recently used rows are dropped
+
+
+def parse_model_spec(spec):
+    provider, _, name = spec.partition(':')
+    if not name:
+        return 'openai', spec
+    return provider, name
+
+
+def model_slug(spec):
+    # For file and collection names
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', spec)
+
+
+class OnnxEmbeddings:
+    # chromadb's bundled ONNX MiniLM model; the model files are downloaded once to ~/.cache/chroma
+    def __init__(self, name, batch_size=LOCAL_EMBEDDING_BATCH_SIZE):
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+        if name != ONNXMiniLM_L6_V2.MODEL_NAME:
+            raise ValueError(f"Unknown ONNX embedding model {name}, available: {ONNXMiniLM_L6_V2.MODEL_NAME}")
+        self.model = ONNXMiniLM_L6_V2()
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.model(texts[start:start + self.batch_size])
+            vectors.extend(np.asarray(vector, dtype=np.float32).tolist() for vector in batch)
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class SentenceTransformerEmbeddings:
+    def __init__(self, name, batch_size=LOCAL_EMBEDDING_BATCH_SIZE, device='cpu'):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(name, device=device)
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        return self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True,
+                                 convert_to_numpy=True).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class EmbeddingCache:
+    # Vectors of one model in a memory-mapped float32 file; a SQLite table maps text hashes to
+    # rows. Rows are allocated inside a SQLite write transaction, so several processes can
+    # share the cache. The file grows by doubling. When a write would take it past max_rows,
+    # the most recently used rows are copied to a new file of the next generation and the rest
+    # are dropped. Readers look up rows and read vectors in one read transaction, which the
+    # compaction's commit waits for, so the file of the generation they read stays in place.
+    def __init__(self, directory, max_rows=EMBEDDING_CACHE_MAX_ROWS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS rows (hash TEXT PRIMARY KEY, row INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            if 'used' not in [column[1] for column in self._db.execute("PRAGMA table_info(rows)")]:
+                # Caches from before the row limit
+                self._db.execute("ALTER TABLE rows ADD COLUMN used REAL NOT NULL DEFAULT 0")
+            self._db.execute("COMMIT")
+        self.dimensions = self._meta('dimensions')
+        self._vectors = None
+        self._generation = None
+
+    def _meta(self, name):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def vectors_path(self, generation):
+        name = 'vectors.f32' if not generation else f'vectors.{generation}.f32'
+        return os.path.join(self.directory, name)
+
+    def _capacity(self, generation):
+        path = self.vectors_path(generation)
+        return os.path.getsize(path) // (4 * self.dimensions) if os.path.exists(path) else 0
+
+    def _map(self, rows_needed, generation):
+        # (Re)open the memory map when another process compacted the cache, or another process
+        # or a write made the file larger
+        if self._vectors is None or self._generation != generation or len(self._vectors) < rows_needed:
+            rows = self._capacity(generation)
+            self._vectors = np.memmap(self.vectors_path(generation), dtype=np.float32, mode='r+',
+                                      shape=(rows, self.dimensions)) if rows else None
+            self._generation = generation
+        return self._vectors
+
+    def get(self, hashes):
+        # hash -> vector for the hashes in the cache
+        if not hashes:
+            return {}
+        found = {}
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                # Written by another process since this cache was opened
+                self.dimensions = self.dimensions or self._meta('dimensions')
+                generation = self._meta('generation') or 0
+                for start in range(0, len(hashes), 500):
+                    batch = hashes[start:start + 500]
+                    found.update(self._db.execute(
+                        f"SELECT hash, row FROM rows WHERE hash IN ({','.join('?' * len(batch))})", batch).fetchall())
+                if found:
+                    vectors = self._map(max(found.values()) + 1, generation)
+                    rows = np.fromiter(found.values(), dtype=np.int64, count=len(found))
+                    matrix = np.array(vectors[rows])
+            finally:
+                self._db.execute("COMMIT")
+            if not found:
+                return {}
+            hits = list(found)
+            for start in range(0, len(hits), 500):
+                batch = hits[start:start + 500]
+                self._db.execute(f"UPDATE rows SET used = ? WHERE hash IN ({','.join('?' * len(batch))})",
+                                 [time.time(), *batch])
+        return dict(zip(found, matrix))
+
+    def _compact(self, generation, rows, keep):
+        # Copies the keep most recently used of the rows to the start of a new file; returns its
+        # generation and the number of rows kept
+        kept = self._db.execute("SELECT hash, row, used FROM rows ORDER BY used DESC LIMIT ?", (keep,)).fetchall()
+        capacity = min(max(2 * len(kept), CACHE_INITIAL_ROWS), self.max_rows)
+        path = self.vectors_path(generation + 1)
+        with open(path, 'wb') as f:
+            f.truncate(capacity * 4 * self.dimensions)
+        if kept:
+            old = self._map(rows, generation)
+            vectors = np.memmap(path, dtype=np.float32, mode='r+', shape=(capacity, self.dimensions))
+            vectors[:len(kept)] = old[np.fromiter((row for _, row, _ in kept), dtype=np.int64, count=len(kept))]
+            vectors.flush()
+            del vectors
+        self._db.execute("DELETE FROM rows")
+        self._db.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                             [(hash_, row, used) for row, (hash_, _, used) in enumerate(kept)])
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation + 1,))
+        print(f"Compacted the embedding cache {self.directory} to {len(kept)} of {rows} rows")
+        return generation + 1, len(kept)
+
+    def put(self, hashes, vectors):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if not len(matrix):
+            return
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            generation = None
+            try:
+                if self.dimensions is None:
+                    self.dimensions = self._meta('dimensions') or matrix.shape[1]
+                    self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dimensions', ?)", (self.dimensions,))
+                if matrix.shape[1] != self.dimensions:
+                    raise ValueError(f"Vectors of dimension {matrix.shape[1]} in a cache of dimension {self.dimensions}")
+                existing = set()
+                for start in range(0, len(hashes), 500):
+                    batch = hashes[start:start + 500]
+                    existing.update(row[0] for row in self._db.execute(
+                        f"SELECT hash FROM rows WHERE hash IN ({','.join('?' * len(batch))})", batch))
+                new = [i for i, hash_ in enumerate(hashes) if hash_ not in existing]
+                new = list({hashes[i]: i for i in new}.values())  # duplicates within the batch
+                new = new[:self.max_rows]
+                if new:
+                    generation = old_generation = self._meta('generation') or 0
+                    first = self._meta('rows') or 0
+                    if first + len(new) > self.max_rows:
+                        # Keeping half of the limit, so that compactions are rare
+                        keep = min(first, self.max_rows // 2, self.max_rows - len(new))
+                        generation, first = self._compact(old_generation, first, keep)
+                    needed = first + len(new)
+                    capacity = self._capacity(generation)
+                    if needed > capacity:
+                        capacity = max(needed, min(max(2 * capacity, CACHE_INITIAL_ROWS), self.max_rows))
+                        with open(self.vectors_path(generation), 'ab') as f:
+                            f.truncate(capacity * 4 * self.dimensions)
+                    vectors = self._map(needed, generation)
+                    vectors[first:needed] = matrix[new]
+                    vectors.flush()
+                    now = time.time()
+                    self._db.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                                         [(hashes[i], first + j, now) for j, i in enumerate(new)])
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rows', ?)", (needed,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                if generation is not None and generation != old_generation:
+                    self._vectors = None
+                    os.remove(self.vectors_path(generation))
+                raise
+            if generation is not None and generation != old_generation:
+                os.remove(self.vectors_path(old_generation))
+
+    def __len__(self):
+        return self._meta('rows') or 0
+
+
+class CachedEmbeddings:
+    # Embeddings interface (embed_documents/embed_query) over a provider and an EmbeddingCache
+    def __init__(self, base, model, cache):
+        self.base = base
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        cached = self.cache.get(list(dict.fromkeys(hashes)))
+        missing = list(dict.fromkeys(hash_ for hash_ in hashes if hash_ not in cached))
+        if missing:
+            first_text = dict(zip(hashes, texts))
+            vectors = self.base.embed_documents([first_text[hash_] for hash_ in missing])
+            self.cache.put(missing, vectors)
+            cached.update(zip(missing, np.asarray(vectors, dtype=np.float32)))
+        return [cached[hash_].tolist() for hash_ in hashes]
+
+    def embed_query(self, text):
+        hash_ = text_hash(text)
+        cached = self.cache.get([hash_])
+        if hash_ in cached:
+            return cached[hash_].tolist()
+        vector = self.base.embed_query(text)
+        self.cache.put([hash_], [vector])
+        return vector
+
+
+def cache_directory(model, directory=EMBEDDING_CACHE_DIRECTORY):
+    return os.path.join(directory, model_slug(model))
+
+
+def create_provider(model, api_key=None, http_client=None):
+    provider, name = parse_model_spec(model)
+    if provider == 'openai':
+        from langchain_openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(model=name, api_key=api_key, http_client=http_client)
+    if provider == 'onnx':
+        return OnnxEmbeddings(name)
+    if provider == 'sentence-transformers':
+        return SentenceTransformerEmbeddings(name)
+    if provider == 'hashing':
+        from local_models import HashingEmbeddings
+
+        return HashingEmbeddings(int(name))
+    raise ValueError(f"Unknown embedding provider {provider!r} in {model!r}")
+
+
+def create_embeddings(model, api_key=None, directory=EMBEDDING_CACHE_DIRECTORY, http_client=None,
+                      max_rows=EMBEDDING_CACHE_MAX_ROWS):
+    return CachedEmbeddings(create_provider(model, api_key, http_client), model,
+                            EmbeddingCache(cache_directory(model, directory), max_rows))
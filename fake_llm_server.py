@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from local_models import FakeChatModel, HashingEmbeddings
+
+# OpenAI-compatible stand-in for the chat and embedding endpoints, answering with the models of
+# local_models.py, to run the app or api_server.py offline and load-test them:
+#   python fake_llm_server.py --port 9000 --latency 0.5 --token-delay 0.02
+#   OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake python api_server.py --workers 4
+# Delays are asynchronous, so many slow requests are served concurrently, as by a remote model.
+LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))
+TOKEN_DELAY = float(os.getenv("FAKE_LLM_TOKEN_DELAY", "0"))
+EMBEDDING_DIMENSIONS = int(os.getenv("FAKE_LLM_EMBEDDING_DIMENSIONS", "1536"))  # text-embedding-3-small
+
+_chat_model = FakeChatModel()
+
+
+def to_messages(messages):
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+    classes = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+    return [classes.get(message['role'], HumanMessage)(content=message.get('content') or '') for message in messages]
+
+
+def completion_chunk(completion_id, model, delta, finish_reason=None):
+    return {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+
+async def chat_completions(request):
+    body = await request.json()
+    model = body.get('model', 'fake')
+    answer = _chat_model._respond(to_messages(body['messages']))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    await asyncio.sleep(LATENCY)
+
+    if not body.get('stream'):
+        return JSONResponse({
+            'id': completion_id, 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    async def chunks():
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n"
+        for i, piece in enumerate(re.findall(r"\S+\s*", answer)):
+            if i:
+                await asyncio.sleep(TOKEN_DELAY)
+            yield f"data: {json.dumps(completion_chunk(completion_id, model, {'content': piece}))}\n\n"
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type='text/event-stream')
+
+
+async def embeddings(request):
+    body = await request.json()
+    inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+    # langchain_openai may send token ids instead of text; they are hashed like words
+    texts = [text if isinstance(text, str) else " ".join(f"t{token}" for token in text) for text in inputs]
+    vectors = HashingEmbeddings(body.get('dimensions') or EMBEDDING_DIMENSIONS).embed_documents(texts)
+    return JSONResponse({
+        'object': 'list', 'model': body.get('model', 'fake'),
+        'data': [{'object': 'embedding', 'index': i, 'embedding': vector} for i, vector in enumerate(vectors)],
+        'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+    })
+
+
+async def models(request):
+    return JSONResponse({'object': 'list', 'data': [
+        {'id': model, 'object': 'model', 'created': 0, 'owned_by': 'fake'}
+        for model in ('gpt-4o-mini', 'gpt-4o', 'text-embedding-3-small')]})
+
+
+app = Starlette(routes=[
+    Route('/v1/chat/completions', chat_completions, methods=['POST']),
+    Route('/v1/embeddings', embeddings, methods=['POST']),
+    Route('/v1/models', models),
+])
+
+
+def main():
+    global LATENCY, TOKEN_DELAY, EMBEDDING_DIMENSIONS
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI-compatible fake chat and embedding server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="delay before the first token (s)")
+    parser.add_argument("--token-delay", type=float, default=TOKEN_DELAY, help="delay between tokens (s)")
+    parser.add_argument("--embedding-dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    args = parser.parse_args()
+    LATENCY, TOKEN_DELAY, EMBEDDING_DIMENSIONS = args.latency, args.token_delay, args.embedding_dimensions
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,24 +3,41 @@ import sys
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
+import chromadb
+import argparse
+import hashlib
 import os
 import json
 import re
 from dotenv import load_dotenv
+from embeddings import EMBEDDING_MODEL, create_embeddings
+from keyword_chunker import PageStore, chunk_manual, page_store_path
+from keyword_index import KeywordIndex, keyword_index_path
+from manual_sections import section_metadata, source_section
+from batch_embed import (EMBED_BATCH_SIZE, EMBED_MAX_WORKERS, EMBED_REQUESTS_PER_MINUTE, RateLimiter,
+                         iter_embedded_batches)
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
+TXT_DIRECTORY = "./opm-reference-manual/txt_parts/chapters/subsections"
+HTML_DIRECTORY = "./opm-reference-manual/html_parts/chapters/subsections"
+PERSIST_DIRECTORY = "./chroma_langchain_db"
+COLLECTION_NAME = "KEYWORDS_cleaned"
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 200
+# Bumped when the chunk metadata changes; the metadata of existing chunks is then rewritten
+# without embedding them again
+METADATA_VERSION = 2
+
 
 def parse_txt_files(directory):
     documents = []
     for root, _, files in os.walk(directory):
         for file in files:
             if file.endswith('.txt') and not file.startswith('index'):
-                file_path = os.path.join(root, file)
+                file_path = os.path.normpath(os.path.join(root, file))
 
                 with open(file_path, 'r', encoding='utf-8-sig') as f:
                     content = f.read()
@@ -33,38 +50,213 @@ def parse_txt_files(directory):
                 content = re.sub(r' {2,}', ' ', content)
                 # Remove leading and trailing whitespace
                 content = content.strip()
-                doc = Document(page_content=content, metadata={'title': keyword_name, 'source': file_path})
+                metadata = {'title': keyword_name, 'source': file_path,
+                            **section_metadata(keyword_name, source_section(file_path))}
+                doc = Document(page_content=content, metadata=metadata)
                 documents.append(doc)
     return documents
 
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def manifest_path(persist_directory=PERSIST_DIRECTORY, collection_name=COLLECTION_NAME):
+    return os.path.join(persist_directory, f"manifest_{collection_name}.json")
+
+
+def load_manifest(persist_directory=PERSIST_DIRECTORY, collection_name=COLLECTION_NAME):
+    path = manifest_path(persist_directory, collection_name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, persist_directory=PERSIST_DIRECTORY, collection_name=COLLECTION_NAME):
+    # The collection version changes whenever the set of chunks does; caches built on top
+    # of the collection use it to detect a rebuild
+    all_ids = sorted(chunk_id for entry in manifest['files'].values() for chunk_id in entry['chunks'])
+    manifest['collection_version'] = content_hash(manifest['embedding_model'], *all_ids)[:16]
+    path = manifest_path(persist_directory, collection_name)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def split_document(document, text_splitter):
+    return assign_chunk_ids(text_splitter.split_documents([document]))
+
+
+def assign_chunk_ids(splits):
+    # Chunk ids are derived from the source and the chunk text, so unchanged chunks keep their id
+    # (and their embedding) when other parts of the same page change
+    chunks = []
+    seen = {}
+    for split in splits:
+        chunk_id = content_hash(split.metadata['source'], split.page_content)[:32]
+        seen[chunk_id] = seen.get(chunk_id, 0) + 1
+        if seen[chunk_id] > 1:
+            chunk_id = f"{chunk_id}-{seen[chunk_id] - 1}"
+        chunks.append((chunk_id, split))
+    return chunks
+
+
+def html_documents_and_chunks(directory):
+    # Structure-aware chunks of the HTML pages (see keyword_chunker.py); the page documents
+    # carry the full page text, for the file hashes and the page store
+    pages = chunk_manual(directory)
+    documents = [Document(page_content=page.text(), metadata={'title': page.title, 'source': page.source})
+                 for page, _ in pages]
+    chunks = {page.source: assign_chunk_ids(page_chunks) for page, page_chunks in pages}
+    return [page for page, _ in pages], documents, chunks
+
+
+def plan_update(documents, manifest, split):
+    # Compare file and chunk hashes against the manifest and work out what to embed and delete.
+    # split(document) returns the document's [(chunk_id, chunk)]
+    old_files = manifest['files']
+    new_files = {}
+    to_add = []
+    for document in documents:
+        source = document.metadata['source']
+        file_hash = content_hash(document.page_content)
+        old_entry = old_files.get(source)
+        if old_entry and old_entry['hash'] == file_hash:
+            new_files[source] = old_entry
+            continue
+        chunks = split(document)
+        old_ids = set(old_entry['chunks']) if old_entry else set()
+        to_add.extend((chunk_id, split) for chunk_id, split in chunks if chunk_id not in old_ids)
+        new_files[source] = {'hash': file_hash, 'chunks': [chunk_id for chunk_id, _ in chunks]}
+
+    kept_ids = {chunk_id for entry in new_files.values() for chunk_id in entry['chunks']}
+    old_ids = {chunk_id for entry in old_files.values() for chunk_id in entry['chunks']}
+    to_delete = sorted(old_ids - kept_ids)
+    return new_files, to_add, to_delete
+
+
+def refresh_metadata(collection, chunks, batch_size):
+    for start in range(0, len(chunks), batch_size):
+        batch = chunks[start:start + batch_size]
+        collection.update(ids=[chunk_id for chunk_id, _ in batch], metadatas=[split.metadata for _, split in batch])
+    print(f"Updated the metadata of {len(chunks)} chunks")
+
+
+def update_collection(collection, embeddings, to_add, to_delete, batch_size, max_workers, requests_per_minute):
+    if to_delete:
+        for start in range(0, len(to_delete), batch_size):
+            collection.delete(ids=to_delete[start:start + batch_size])
+        print(f"Deleted {len(to_delete)} stale chunks")
+
+    # Chunks already present (e.g. from an interrupted run) do not need to be embedded again
+    ids = [chunk_id for chunk_id, _ in to_add]
+    existing = set()
+    for start in range(0, len(ids), batch_size):
+        existing.update(collection.get(ids=ids[start:start + batch_size], include=[])['ids'])
+    to_add = [(chunk_id, split) for chunk_id, split in to_add if chunk_id not in existing]
+    if not to_add:
+        return
+
+    texts = [split.page_content for _, split in to_add]
+    rate_limiter = RateLimiter(requests_per_minute)
+    for start, vectors in iter_embedded_batches(embeddings, texts, batch_size=batch_size,
+                                                max_workers=max_workers, rate_limiter=rate_limiter):
+        batch = to_add[start:start + len(vectors)]
+        collection.upsert(
+            ids=[chunk_id for chunk_id, _ in batch],
+            embeddings=vectors,
+            documents=[split.page_content for _, split in batch],
+            metadatas=[split.metadata for _, split in batch],
+        )
+        print(f"Embedded {start + len(batch)}/{len(to_add)} chunks")
+
+
 def main():
-    txt_directory = "/home/jakob/code/opm-assistant/opm-reference-manual/txt_parts/chapters/subsections"
-    documents = parse_txt_files(txt_directory)
+    parser = argparse.ArgumentParser(description="Incrementally build the keyword vector database")
+    parser.add_argument("--source", choices=["html", "txt"], default="html",
+                        help="html: chunk the HTML pages by their structure; txt: split the TXT export by characters")
+    parser.add_argument("--html-directory", default=HTML_DIRECTORY)
+    parser.add_argument("--txt-directory", default=TXT_DIRECTORY)
+    parser.add_argument("--rebuild", action="store_true", help="drop the collection and embed everything again")
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL,
+                        help="e.g. text-embedding-3-small or onnx:all-MiniLM-L6-v2, see embeddings.py")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--max-workers", type=int, default=EMBED_MAX_WORKERS)
+    parser.add_argument("--requests-per-minute", type=float, default=EMBED_REQUESTS_PER_MINUTE)
+    parser.add_argument("--dump-json", action="store_true", help="dump parsed and split documents to JSON")
+    args = parser.parse_args()
+
+    pages = []
+    if args.source == 'html':
+        pages, documents, page_chunks = html_documents_and_chunks(args.html_directory)
+        split = lambda document: page_chunks[document.metadata['source']]
+    else:
+        documents = parse_txt_files(args.txt_directory)
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        split = lambda document: split_document(document, text_splitter)
+
+    if args.dump_json:
+        with open('original_documents_cleaned.json', 'w') as f:
+            json.dump([doc.dict() for doc in documents], f, indent=2)
+        print(f"Original documents dumped to 'original_documents_cleaned.json'")
+
+        splits = [chunk for document in documents for _, chunk in split(document)]
+        with open('split_documents_cleaned.json', 'w') as f:
+            json.dump([split.dict() for split in splits], f, indent=2)
+        print(f"Split documents dumped to 'split_documents_cleaned.json'")
 
-    # Dump original documents to JSON
-    with open('original_documents_cleaned.json', 'w') as f:
-        json.dump([doc.dict() for doc in documents], f, indent=2)
+    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+    manifest = load_manifest()
+    existing = None
+    if COLLECTION_NAME in [c if isinstance(c, str) else c.name for c in client.list_collections()]:
+        existing = client.get_collection(COLLECTION_NAME)
+    # Vectors of another embedding model cannot be reused. A collection of the same model without a
+    # manifest is kept: it is left by an interrupted first build, and its chunks are not embedded again
+    existing_model = (existing.metadata or {}).get('embedding_model') if existing is not None else None
+    if existing is not None and (args.rebuild or existing_model != args.embedding_model):
+        client.delete_collection(COLLECTION_NAME)
+        existing = None
+    if args.rebuild or manifest is None or manifest.get('embedding_model') != args.embedding_model:
+        manifest = {'embedding_model': args.embedding_model, 'metadata_version': METADATA_VERSION, 'files': {}}
+    # The app embeds queries with the model recorded here
+    collection = client.get_or_create_collection(COLLECTION_NAME, metadata={'embedding_model': args.embedding_model})
+    if (collection.metadata or {}).get('embedding_model') != args.embedding_model:
+        collection.modify(metadata={'embedding_model': args.embedding_model})
 
-    print(f"Original documents dumped to 'original_documents.json'")
+    new_files, to_add, to_delete = plan_update(documents, manifest, split)
+    if existing is not None and not manifest['files']:
+        # Without a manifest, chunks of the interrupted build that are no longer wanted are found by id
+        kept_ids = {chunk_id for entry in new_files.values() for chunk_id in entry['chunks']}
+        to_delete = sorted(set(collection.get(include=[])['ids']) - kept_ids)
+    print(f"{len(documents)} keyword files: {len(to_add)} chunks to embed, {len(to_delete)} to delete")
 
-    # Split documents
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=200)
-    splits = text_splitter.split_documents(documents)
+    embeddings = create_embeddings(args.embedding_model, openai_api_key)
+    update_collection(collection, embeddings, to_add, to_delete,
+                      args.batch_size, args.max_workers, args.requests_per_minute)
 
-    # Dump splits to JSON
-    with open('split_documents_cleaned.json', 'w') as f:
-        json.dump([split.dict() for split in splits], f, indent=2)
+    if manifest.get('metadata_version') != METADATA_VERSION:
+        refresh_metadata(collection, [chunk for document in documents for chunk in split(document)], args.batch_size)
+        manifest['metadata_version'] = METADATA_VERSION
+    manifest['files'] = new_files
+    save_manifest(manifest)
+    print(f"Collection {COLLECTION_NAME} now holds {collection.count()} chunks")
 
-    print(f"Split documents dumped to 'split_documents.json'")
+    # The lexical index is cheap to build, so always rebuild it from the collection contents
+    keyword_index = KeywordIndex.from_collection(collection)
+    keyword_index.save(keyword_index_path(PERSIST_DIRECTORY, COLLECTION_NAME))
+    print(f"Keyword index with {len(keyword_index)} chunks saved")
 
-    # Create and persist vector store
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-    vector_store = Chroma.from_documents(
-        documents=splits,
-        embedding=embeddings,
-        persist_directory="./chroma_langchain_db",
-        collection_name="KEYWORDS_cleaned"
-    )
+    # Full pages for small-to-big retrieval, looked up by the chunks' 'parent'
+    if pages:
+        page_store = PageStore(page_store_path(PERSIST_DIRECTORY, COLLECTION_NAME))
+        page_store.put(pages)
+        page_store.delete_missing([page.source for page in pages])
+        print(f"Page store with {len(pages)} pages saved")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,38 +1,177 @@
+import argparse
+import json
 import os
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 
 # git clone git@github.com:OPM/opm-reference-manual.git
 
 source_directory = "./opm-reference-manual/parts/chapters/subsections"
 html_target_directory = "./opm-reference-manual/html_parts/chapters/subsections"
 txt_target_directory = "./opm-reference-manual/txt_parts/chapters/subsections"
+journal_path = "./opm-reference-manual/conversion_journal.jsonl"
 
-def convert_to_html(source_path, target_path):
-    os.makedirs(os.path.dirname(target_path), exist_ok=True)
-    subprocess.run([
-        "libreoffice",
-        "--headless",
-        "--convert-to", "html",
-        source_path,
-        "--outdir", os.path.dirname(target_path)
-    ])
-    
-def convert_to_txt(source_path, target_path):
-    os.makedirs(os.path.dirname(target_path), exist_ok=True)
-    subprocess.run([
-        "libreoffice",
-        "--headless",
-        "--convert-to", "txt",
-        source_path,
-        "--outdir", os.path.dirname(target_path)
-    ])
-
-for root, dirs, files in os.walk(source_directory):
-    for filename in files:
-        if filename.endswith(".fodt"):
+# Converter executable; override with OPM_SOFFICE (e.g. a stub script for testing)
+CONVERTER = os.getenv("OPM_SOFFICE", "libreoffice")
+BATCH_SIZE = 50  # files converted per soffice invocation
+CONVERT_TIMEOUT = 30 * 60  # seconds per batch
+
+
+class ConversionJournal:
+    # Append-only JSON lines log of converted and failed files. A rerun skips every
+    # (source, format) that was converted from the same source modification time.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partially written line from an interrupted run
+                    key = (entry['source'], entry['format'], entry['source_mtime'])
+                    if entry['status'] == 'done':
+                        self.done.add(key)
+                    else:
+                        self.done.discard(key)
+
+    def is_done(self, source, fmt, source_mtime):
+        return (source, fmt, source_mtime) in self.done
+
+    def record(self, source, fmt, source_mtime, status, error=None):
+        entry = {'source': source, 'format': fmt, 'source_mtime': source_mtime,
+                 'status': status, 'time': time.time()}
+        if error:
+            entry['error'] = error
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            if status == 'done':
+                self.done.add((source, fmt, source_mtime))
+
+
+def collect_jobs(source_dir, targets, journal, force=False):
+    # Group the files that need converting by (format, output directory), because
+    # soffice takes a single --outdir per invocation
+    jobs = defaultdict(list)
+    skipped = 0
+    for root, dirs, files in os.walk(source_dir):
+        for filename in sorted(files):
+            if not filename.endswith(".fodt"):
+                continue
             source_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(source_path, source_directory)
-            html_target_path = os.path.join(html_target_directory, relative_path)
-            txt_target_path = os.path.join(txt_target_directory, relative_path)
-            convert_to_html(source_path, html_target_path)
-            convert_to_txt(source_path, txt_target_path)
\ No newline at end of file
+            source_mtime = os.path.getmtime(source_path)
+            relative_dir = os.path.relpath(root, source_dir)
+            for fmt, target_dir in targets.items():
+                outdir = os.path.normpath(os.path.join(target_dir, relative_dir))
+                target_path = os.path.join(outdir, Path(filename).stem + "." + fmt)
+                exists = os.path.exists(target_path)
+                up_to_date = exists and (os.path.getmtime(target_path) >= source_mtime
+                                         or journal.is_done(source_path, fmt, source_mtime))
+                if up_to_date and not force:
+                    skipped += 1
+                    continue
+                jobs[(fmt, outdir)].append((source_path, source_mtime, target_path))
+    return jobs, skipped
+
+
+def make_batches(jobs, batch_size):
+    batches = []
+    for (fmt, outdir), files in sorted(jobs.items()):
+        for start in range(0, len(files), batch_size):
+            batches.append((fmt, outdir, files[start:start + batch_size]))
+    return batches
+
+
+def convert_batch(converter, profile_dir, fmt, outdir, files, journal):
+    # Each worker uses its own user profile: concurrent soffice processes sharing
+    # a profile would attach to the same instance and serialise (or fail)
+    os.makedirs(outdir, exist_ok=True)
+    command = [
+        converter,
+        f"-env:UserInstallation={Path(profile_dir).resolve().as_uri()}",
+        "--headless",
+        "--convert-to", fmt,
+        "--outdir", outdir,
+        *[source_path for source_path, _, _ in files],
+    ]
+    error = None
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=CONVERT_TIMEOUT)
+        if result.returncode != 0:
+            error = f"exit code {result.returncode}: {result.stderr.strip()[-500:]}"
+    except (OSError, subprocess.TimeoutExpired) as e:
+        error = str(e)
+
+    converted = 0
+    for source_path, source_mtime, target_path in files:
+        if os.path.exists(target_path) and os.path.getmtime(target_path) >= source_mtime:
+            journal.record(source_path, fmt, source_mtime, 'done')
+            converted += 1
+        else:
+            journal.record(source_path, fmt, source_mtime, 'failed', error or "no output produced")
+    return converted, len(files) - converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the OPM reference manual keyword pages to HTML and TXT")
+    parser.add_argument("--source", default=source_directory)
+    parser.add_argument("--html-target", default=html_target_directory)
+    parser.add_argument("--txt-target", default=txt_target_directory)
+    parser.add_argument("--formats", nargs="+", default=["html", "txt"], choices=["html", "txt"])
+    parser.add_argument("--converter", default=CONVERTER)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--journal", default=journal_path)
+    parser.add_argument("--force", action="store_true", help="convert everything, ignoring timestamps and journal")
+    args = parser.parse_args()
+
+    targets = {"html": args.html_target, "txt": args.txt_target}
+    targets = {fmt: targets[fmt] for fmt in args.formats}
+    journal = ConversionJournal(args.journal)
+    jobs, skipped = collect_jobs(args.source, targets, journal, force=args.force)
+    batches = make_batches(jobs, args.batch_size)
+    total = sum(len(files) for _, _, files in batches)
+    print(f"{total} conversions in {len(batches)} batches ({skipped} up to date)")
+    if not batches:
+        return
+
+    profile_root = tempfile.mkdtemp(prefix="opm-soffice-")
+    profiles = queue.Queue()
+    for i in range(args.workers):
+        profiles.put(os.path.join(profile_root, f"profile-{i}"))
+
+    def run(batch):
+        profile_dir = profiles.get()
+        try:
+            return convert_batch(args.converter, profile_dir, *batch, journal)
+        finally:
+            profiles.put(profile_dir)
+
+    converted = failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(run, batch) for batch in batches]
+            for future in as_completed(futures):
+                ok, bad = future.result()
+                converted += ok
+                failed += bad
+                print(f"Converted {converted}/{total}, {failed} failed")
+    finally:
+        shutil.rmtree(profile_root, ignore_errors=True)
+
+    if failed:
+        print(f"{failed} conversions failed, see {args.journal}; rerun to retry them")
+
+
+if __name__ == "__main__":
+    main()
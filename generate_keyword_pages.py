@@ -0,0 +1,127 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import lxml.html
+
+from keyword_pages import KEYWORD_PAGE_INDEX, KEYWORD_PAGES_DIRECTORY, KEYWORD_PAGES_URL, MANUAL_HTML_DIRECTORY
+
+# Builds the pages shown by the app's keyword buttons from the LibreOffice HTML export:
+# drops the document head, stylesheets and inline styling, moves images to content-addressed
+# static files, minifies the markup and writes a title -> page index.
+html_directory = MANUAL_HTML_DIRECTORY
+
+# Attributes that carry structure rather than LibreOffice styling
+KEEP_ATTRIBUTES = {"href", "src", "alt", "width", "height", "colspan", "rowspan", "bgcolor"}
+# Tags replaced by their content
+UNWRAP_TAGS = {"font", "span", "sdfield", "div"}
+DROP_TAGS = {"col", "colgroup", "meta", "style", "script", "title"}
+IMAGE_DIRECTORY = "img"
+
+DATA_URI_PATTERN = re.compile(r"^data:image/(\w+);base64,(.*)$", re.S)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def save_image(data, extension, output_directory):
+    # Content-addressed, so images shared between pages are stored once and can be cached forever
+    name = f"{hashlib.sha256(data).hexdigest()[:16]}.{extension.lower()}"
+    path = os.path.join(output_directory, IMAGE_DIRECTORY, name)
+    if not os.path.exists(path):
+        # Pages sharing the image may be built at the same time, each writing its own temporary file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return f"{KEYWORD_PAGES_URL}/{IMAGE_DIRECTORY}/{name}"
+
+
+def image_url(src, page_directory, output_directory):
+    match = DATA_URI_PATTERN.match(src)
+    if match:
+        return save_image(base64.b64decode(match.group(2)), match.group(1), output_directory)
+    path = os.path.join(page_directory, src)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return save_image(f.read(), os.path.splitext(src)[1].lstrip('.') or 'bin', output_directory)
+
+
+def clean_page(path, output_directory):
+    with open(path, 'rb') as f:
+        root = lxml.html.fromstring(f.read())
+    body = root.find('body')
+    if body is None:
+        body = root
+    page_directory = os.path.dirname(path)
+
+    for element in list(body.iter()):
+        if not isinstance(element.tag, str):  # comments and processing instructions
+            element.drop_tree()
+            continue
+        tag = element.tag.lower()
+        if tag in DROP_TAGS:
+            element.drop_tree()
+            continue
+        if tag == 'img':
+            url = image_url(element.get('src', ''), page_directory, output_directory)
+            if url is None:
+                element.drop_tree()
+                continue
+            element.set('src', url)
+        for name in list(element.attrib):
+            if name not in KEEP_ATTRIBUTES:
+                del element.attrib[name]
+        if tag == 'a' and not element.get('href', '').startswith('http'):
+            # In-document links point to other parts of the full manual
+            element.drop_tag()
+        elif tag in UNWRAP_TAGS:
+            element.drop_tag()
+
+    html = "".join(lxml.html.tostring(child, encoding='unicode') for child in body)
+    text = (body.text or '').strip()
+    return WHITESPACE_PATTERN.sub(' ', text + html).replace('> <', '><').strip()
+
+
+def build_page(path, html_directory, output_directory):
+    relative = os.path.relpath(path, html_directory)
+    target = os.path.join(output_directory, relative)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    html = clean_page(path, output_directory)
+    with open(target, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return relative.replace(os.sep, '/'), os.path.getsize(path), len(html.encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the minified keyword pages and their index")
+    parser.add_argument("--html-directory", default=html_directory)
+    parser.add_argument("--output", default=KEYWORD_PAGES_DIRECTORY)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.output, IMAGE_DIRECTORY), exist_ok=True)
+    paths = sorted(os.path.join(root, file) for root, _, files in os.walk(args.html_directory)
+                   for file in files if file.endswith('.html') and not file.startswith('index'))
+
+    index = {}
+    original_size = built_size = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = pool.map(build_page, paths, [args.html_directory] * len(paths), [args.output] * len(paths))
+        for relative, original, built in results:
+            chapter, file = relative.split('/')[-2:]
+            index.setdefault(os.path.splitext(file)[0].upper(), {})[chapter] = relative
+            original_size += original
+            built_size += built
+
+    with open(os.path.join(args.output, KEYWORD_PAGE_INDEX), 'w', encoding='utf-8') as f:
+        json.dump(index, f, sort_keys=True)
+    print(f"Built {len(paths)} pages for {len(index)} keywords: {original_size / 1e6:.1f} MB of HTML "
+          f"reduced to {built_size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
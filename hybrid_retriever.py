@@ -0,0 +1,125 @@
+import hashlib
+from typing import Any, Callable, List, Optional, Set
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from keyword_index import reciprocal_rank_fusion
+
+TITLE_MATCH_WEIGHT = 2.0
+LEXICAL_WEIGHT = 1.0
+VECTOR_WEIGHT = 1.0
+SESSION_WEIGHT = 1.0
+DECK_WEIGHT = 1.0
+SECTION_WEIGHT = 1.0
+
+
+def document_key(doc):
+    # Chroma returns the chunk id; fall back to the content for stores that do not
+    if getattr(doc, 'id', None):
+        return doc.id
+    return hashlib.sha256((doc.metadata.get('source', '') + doc.page_content).encode('utf-8')).hexdigest()
+
+
+def same_model(embeddings, other):
+    # CachedEmbeddings (embeddings.py) know their model; other embeddings only match themselves
+    model = getattr(embeddings, 'model', None)
+    return embeddings is other or (model is not None and model == getattr(other, 'model', None))
+
+
+class HybridRetriever(BaseRetriever):
+    # Fuses an exact keyword-title lookup, BM25 over the keyword chunks and dense vector
+    # search with reciprocal rank fusion. When the keyword pages named in the question
+    # already fill k results, the vector search (and its embedding request) is skipped.
+    # Chunks of the session's uploaded files, if any, are fused in with up to session_k extra slots.
+    # Given the deck sections a question points to, the BM25 ranking of the chunks of those
+    # sections is fused in as well, so they are favoured without hiding the rest of the manual.
+    # This only re-ranks: the searches still cover the whole manual, and the section ranking
+    # reuses the scores of the full BM25 search.
+    # Given the chunks of the manual pages of the keywords in the session's decks (deck_pages.py),
+    # those are ranked by BM25 and fused in as well. A question about the deck itself then gets
+    # deck_k results, and skips the vector search if the deck and title hits already fill them,
+    # unless it names keywords whose pages are not among the deck hits.
+    vector_store: Any
+    load_keyword_index: Callable[[], Any]
+    load_session_store: Optional[Callable[[], Any]] = None
+    k: int = 4
+    fetch_k: int = 10
+    session_k: int = 2
+    deck_k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.retrieve(query)
+
+    def retrieve(self, query, embedding: Optional[List[float]] = None, session_id: Optional[str] = None,
+                 sections: Optional[List[str]] = None, deck_chunks: Optional[Set[int]] = None,
+                 deck_question: bool = False):
+        index = self.load_keyword_index()
+        documents = {}
+        rankings = []
+        weights = []
+        if index is not None and not index.has_sections():
+            sections = None
+
+        deck_hits = index.search(query, self.fetch_k, chunks=deck_chunks) if index is not None and deck_chunks else []
+        title_hits = index.title_chunks(query) if index is not None else []
+        # A deck question that names keywords the deck does not use is answered like any other
+        deck_question = deck_question and bool(deck_hits) and (not title_hits or bool(set(title_hits) & set(deck_hits)))
+        base_k = min(self.k, self.deck_k) if deck_question else self.k
+        k = base_k
+
+        session_store = self.load_session_store() if self.load_session_store and session_id else None
+        if session_store is not None and session_store.has_session(session_id):
+            # The uploads may be embedded with another model than the keyword collection (whose
+            # model `embedding` is from); a query vector is only shared between stores of one model
+            shared = same_model(session_store.embeddings, self.vector_store.embeddings)
+            session_embedding = embedding if shared else None
+            if session_embedding is None:
+                session_embedding = session_store.embeddings.embed_query(query)
+                if shared:
+                    embedding = session_embedding
+            ranking = []
+            for doc in session_store.search(session_id, session_embedding, self.fetch_k):
+                documents[doc.id] = doc
+                ranking.append(doc.id)
+            rankings.append(ranking)
+            weights.append(SESSION_WEIGHT)
+            k += self.session_k
+
+        if index is not None:
+            if len(title_hits) >= base_k and not rankings:
+                return [self._index_document(index, i) for i in title_hits[:base_k]]
+            lexical_hits, section_hits = index.section_search(query, self.fetch_k, sections)
+            for weight, hits in ((TITLE_MATCH_WEIGHT, title_hits), (DECK_WEIGHT, deck_hits),
+                                 (LEXICAL_WEIGHT, lexical_hits), (SECTION_WEIGHT, section_hits)):
+                ranking = []
+                for i in hits:
+                    doc = self._index_document(index, i)
+                    documents[doc.id] = doc
+                    ranking.append(doc.id)
+                rankings.append(ranking)
+                weights.append(weight)
+
+            if deck_question and len(set(title_hits) | set(deck_hits)) >= base_k:
+                # The pages of the deck's keywords answer it; no query embedding needed
+                return [documents[key] for key in reciprocal_rank_fusion(rankings, weights)[:k]]
+
+        ranking = []
+        for doc in self._vector_search(query, embedding):
+            key = document_key(doc)
+            documents.setdefault(key, doc)
+            ranking.append(key)
+        rankings.append(ranking)
+        weights.append(VECTOR_WEIGHT)
+
+        return [documents[key] for key in reciprocal_rank_fusion(rankings, weights)[:k]]
+
+    def _vector_search(self, query, embedding):
+        if embedding is None:
+            return self.vector_store.similarity_search(query, k=self.fetch_k)
+        return self.vector_store.similarity_search_by_vector(embedding, k=self.fetch_k)
+
+    @staticmethod
+    def _index_document(index, i):
+        return Document(id=index.ids[i], page_content=index.texts[i], metadata=dict(index.metadatas[i]))
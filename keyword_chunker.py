@@ -0,0 +1,268 @@
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import lxml.html
+
+from manual_sections import chapter_section, section_metadata
+
+# Chunks the keyword pages of the HTML manual by their structure instead of by character
+# count: the description, the item table (whole item rows, never split), notes, and the
+# examples with the text that introduces them. Every chunk starts with the keyword heading and
+# its part, and points to its page ('parent'), whose full text is kept in a PageStore for
+# small-to-big retrieval (see context_packer.expand_to_parents).
+CHUNK_CHARS = 1500  # item rows and example lines are never split
+SECTION_NUMBER_PATTERN = re.compile(r"^[\d.]+\s*")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+NAVIGATION = ["RUNSPEC", "GRID", "EDIT", "PROPS", "REGIONS", "SOLUTION", "SUMMARY", "SCHEDULE"]
+CODE_CLASSES = {"@example-western", "@code-western"}
+HEADINGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+CONTAINERS = {"div", "dl", "dd", "dt", "ol", "ul", "center", "section", "blockquote"}
+EXAMPLE_HEADINGS = {"example", "examples"}
+LINE_BREAK = "\ue000"  # marks <br> while the source line breaks are collapsed
+
+
+def clean(text):
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def code_text(element):
+    # Example lines keep their spacing and <br> line breaks; line breaks of the HTML source do not
+    for br in element.iter('br'):
+        br.tail = LINE_BREAK + (br.tail or "")
+    text = re.sub(r"[ \t]*\n\s*", " ", element.text_content().replace('\xa0', ' '))
+    return "\n".join(line.rstrip() for line in text.split(LINE_BREAK)).strip("\n")
+
+
+def split_lines(text, max_chars):
+    # An oversized unit (a long example or table) in pieces of whole lines
+    pieces, current, size = [], [], 0
+    for line in text.split("\n"):
+        if current and size + len(line) > max_chars:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    pieces.append("\n".join(current))
+    return pieces
+
+
+def cell_texts(row):
+    return [clean(cell.text_content()) for cell in row if cell.tag in ('td', 'th')]
+
+
+def table_block(table):
+    # ('items', [(number, lines)], notes) for keyword item tables, ('table', lines) otherwise,
+    # None for the section navigation bar
+    rows = [cells for cells in (cell_texts(row) for row in table.iter('tr')) if any(cells)]
+    if not rows or rows[0] == NAVIGATION:
+        return None
+    if rows[0][:2] != ["No.", "Name"]:
+        return ('table', [" | ".join(cells) for cells in rows])
+    items, notes = [], []
+    for cells in rows[1:]:
+        if cells in (["Field", "Metric", "Laboratory"],):
+            continue
+        if len(cells) == 1 or cells[0].lower().startswith("note"):
+            notes.append(" ".join(cells))
+        elif re.match(r"^\d", cells[0]) and len(cells) >= 3:
+            number, name, description = cells[:3]
+            line = f"Item {number} {name}: {description}"
+            if len(cells) > 3 and cells[3]:
+                line += f" Default: {cells[3]}."
+            items.append((number, [line]))
+        elif items:
+            # Units row of the previous item
+            units = list(dict.fromkeys(cell for cell in cells if cell))
+            if units:
+                items[-1][1].append(f"Units: {' / '.join(units)}")
+        else:
+            notes.append(" ".join(cells))
+    return ('items', items, notes)
+
+
+def walk(element, blocks):
+    # Block-level content in document order: (kind, ...) tuples
+    for child in element:
+        if not isinstance(child.tag, str):
+            continue
+        tag = child.tag.lower()
+        if tag in HEADINGS:
+            blocks.append(('heading', tag, clean(child.text_content())))
+        elif tag == 'table':
+            block = table_block(child)
+            if block is not None:
+                blocks.append(block)
+        elif tag == 'p' and child.get('class') in CODE_CLASSES:
+            blocks.append(('code', code_text(child)))
+        elif tag in ('p', 'li', 'pre'):
+            text = clean(child.text_content())
+            if text:
+                blocks.append(('text', text))
+        elif tag in CONTAINERS:
+            walk(child, blocks)
+
+
+class KeywordPage:
+    def __init__(self, title, source, chapter, heading, parts):
+        self.title = title
+        self.source = source
+        self.chapter = chapter
+        self.heading = heading
+        self.parts = parts  # [(part, [(kind, payload)])] in page order
+
+    def text(self):
+        # The whole page as one text, for the parent store and file hashes
+        lines = [self.heading]
+        for part, blocks in self.parts:
+            lines.append(part.capitalize())
+            for kind, payload in blocks:
+                lines.extend(payload if kind == 'items' else [payload])
+        return "\n".join(lines)
+
+
+def parse_page(path):
+    with open(path, 'rb') as f:
+        root = lxml.html.fromstring(f.read())
+    body = root.find('body')
+    if body is None:
+        body = root
+    blocks = []
+    walk(body, blocks)
+
+    title = os.path.splitext(os.path.basename(path))[0].upper()
+    heading = title
+    parts = []
+    part = 'description'
+    seen_items = False
+
+    def add(kind, payload):
+        if not parts or parts[-1][0] != part:
+            parts.append((part, []))
+        parts[-1][1].append((kind, payload))
+
+    for block in blocks:
+        kind = block[0]
+        if kind == 'heading':
+            text = SECTION_NUMBER_PATTERN.sub("", block[2])
+            if block[1] in ('h1', 'h2', 'h3'):
+                heading = text or heading
+            elif text.lower() in EXAMPLE_HEADINGS:
+                part = 'example'
+            elif text.lower() != 'description' and text:
+                part = text.lower()
+        elif kind == 'items':
+            part = 'items'
+            seen_items = True
+            for number, lines in block[1]:
+                add('items', lines)
+            part = 'notes'
+            for note in block[2]:
+                add('text', note)
+        elif kind == 'table':
+            for line in block[1]:
+                add('code', line)
+        else:
+            add(kind, block[1])
+        if part == 'description' and seen_items:
+            part = 'notes'
+    return KeywordPage(title, os.path.normpath(path), os.path.basename(os.path.dirname(path)), heading, parts)
+
+
+def groups(part, blocks):
+    # The units that are never split: an item row with its units, a run of example lines with
+    # the text before it, or a paragraph
+    units = []
+    for kind, payload in blocks:
+        if kind == 'items':
+            units.append(("\n".join(payload), payload[0].split(":")[0].split()[1]))
+        elif kind == 'code' and units and units[-1][1] in ('code', 'intro'):
+            units[-1] = (units[-1][0] + "\n" + payload, 'code')
+        elif kind == 'text' and part == 'example':
+            units.append((payload, 'intro'))
+        else:
+            units.append((payload, kind))
+    return units
+
+
+def chunk_page(page, max_chars=CHUNK_CHARS):
+    from langchain_core.documents import Document
+
+    chunks = []
+    page_metadata = {'title': page.title, 'source': page.source, 'parent': page.source,
+                     **section_metadata(page.title, chapter_section(page.chapter))}
+    for part, blocks in page.parts:
+        current, items = [], []
+
+        def flush():
+            if not current:
+                return
+            label = part.capitalize()
+            if items:
+                label = f"Items {items[0]}-{items[-1]}" if len(items) > 1 else f"Item {items[0]}"
+            metadata = {**page_metadata, 'part': part, 'chunk_index': len(chunks)}
+            if items:
+                metadata['items'] = f"{items[0]}-{items[-1]}"
+            text = f"{page.heading}\n{label}\n" + "\n".join(current)
+            chunks.append(Document(page_content=text, metadata=metadata))
+            current.clear()
+            items.clear()
+
+        size = 0
+        for unit, kind in groups(part, blocks):
+            for text in split_lines(unit, max_chars) if len(unit) > max_chars else [unit]:
+                if current and size + len(text) > max_chars:
+                    flush()
+                    size = 0
+                current.append(text)
+                size += len(text) + 1
+                if part == 'items' and kind not in items:
+                    items.append(kind)
+        flush()
+    if not chunks:
+        chunks.append(Document(page_content=page.heading, metadata={**page_metadata, 'part': 'description',
+                                                                    'chunk_index': 0}))
+    return chunks
+
+
+def page_paths(directory):
+    return sorted(os.path.join(root, file) for root, _, files in os.walk(directory)
+                  for file in files if file.endswith('.html') and not file.startswith('index'))
+
+
+def _chunk_path(path):
+    page = parse_page(path)
+    return page, chunk_page(page)
+
+
+def chunk_manual(directory, workers=None):
+    # [(page, chunks)] for every keyword page, in path order
+    paths = page_paths(directory)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        return list(pool.map(_chunk_path, paths, chunksize=16))
+
+
+def page_store_path(persist_directory, collection_name):
+    return os.path.join(persist_directory, f"pages_{collection_name}.sqlite3")
+
+
+class PageStore:
+    # Full page texts by parent id
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (parent TEXT PRIMARY KEY, title TEXT, text TEXT)")
+
+    def put(self, pages):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                                 [(page.source, page.title, page.text()) for page in pages])
+
+    def delete_missing(self, parents):
+        existing = {row[0] for row in self._db.execute("SELECT parent FROM pages")}
+        with self._db:
+            self._db.executemany("DELETE FROM pages WHERE parent = ?", [(parent,) for parent in existing - set(parents)])
+
+    def get(self, parent):
+        row = self._db.execute("SELECT text FROM pages WHERE parent = ?", (parent,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,159 @@
+import gzip
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+# Lexical (BM25) index over the same chunks as the keyword Chroma collection, plus an
+# exact lookup from keyword title (e.g. COMPDAT) to the chunks of its manual page(s).
+# Built by generate_database.py next to the collection and loaded lazily at query time.
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60  # reciprocal rank fusion constant
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+# Deck keywords are upper case, up to 8 characters, e.g. COMPDAT, WCONPROD, SGWFN
+DECK_KEYWORD_PATTERN = re.compile(r"\b[A-Z][A-Z0-9_]{1,7}\b")
+
+
+def keyword_index_path(persist_directory, collection_name):
+    return os.path.join(persist_directory, f"keyword_index_{collection_name}.json.gz")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def best_chunks(scores, k, candidates=None):
+    # The k best scored chunks, optionally among the candidates only
+    ranked = scores if candidates is None else [i for i in scores if i in candidates]
+    return sorted(ranked, key=lambda i: -scores[i])[:k]
+
+
+class KeywordIndex:
+    def __init__(self, ids, texts, metadatas):
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        # Postings are rebuilt on load; that is faster than deserialising them from JSON
+        postings, lengths = self._build_postings(texts)
+        self.postings = postings  # term -> [(chunk index, term frequency), ...]
+        self.lengths = lengths
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+        self.by_title = defaultdict(list)
+        self.by_section = defaultdict(set)
+        for i, metadata in enumerate(metadatas):
+            self.by_title[metadata.get('title', '')].append(i)
+            if 'section' in metadata:
+                self.by_section[metadata['section']].add(i)
+
+    @staticmethod
+    def _build_postings(texts):
+        postings = defaultdict(list)
+        lengths = []
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                postings[term].append((i, count))
+        return dict(postings), lengths
+
+    @classmethod
+    def from_collection(cls, collection):
+        data = collection.get(include=["documents", "metadatas"])
+        return cls(data['ids'], data['documents'], [m or {} for m in data['metadatas']])
+
+    def save(self, path):
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            json.dump({'ids': self.ids, 'texts': self.texts, 'metadatas': self.metadatas}, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['ids'], data['texts'], data['metadatas'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def scores(self, query, candidates=None):
+        # BM25 score per chunk index, optionally restricted to a set of candidate chunks
+        n = len(self.ids)
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                if candidates is not None and i not in candidates:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / self.average_length)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def has_sections(self):
+        # Collections indexed before section metadata was recorded cannot be filtered by section
+        return bool(self.by_section)
+
+    def section_chunks(self, sections):
+        return set().union(*(self.by_section.get(section, ()) for section in sections))
+
+    def search(self, query, k, sections=None, chunks=None):
+        # Optionally restricted to chunks of the given sections and/or the given chunks
+        candidates = self.section_chunks(sections) if sections else None
+        if chunks is not None:
+            candidates = set(chunks) if candidates is None else candidates & set(chunks)
+        return best_chunks(self.scores(query, candidates), k)
+
+    def section_search(self, query, k, sections):
+        # The best chunks overall and the best of the given sections, from one scoring pass
+        scores = self.scores(query)
+        in_sections = self.section_chunks(sections) if sections else set()
+        return best_chunks(scores, k), best_chunks(scores, k, in_sections) if in_sections else []
+
+    def query_titles(self, query):
+        # Upper case tokens in the query that are keyword titles, in order of appearance
+        titles = []
+        for token in DECK_KEYWORD_PATTERN.findall(query):
+            if token in self.by_title and token not in titles:
+                titles.append(token)
+        return titles
+
+    def title_chunks(self, query):
+        # Chunks of the pages named in the query. Within a page chunks are ranked by BM25 against
+        # the query (so "COMPDAT item 7" finds the item table), then pages are interleaved so
+        # every named keyword is represented near the top.
+        titles = self.query_titles(query)
+        if not titles:
+            return []
+        candidates = {i for title in titles for i in self.by_title[title]}
+        scores = self.scores(query, candidates)
+        per_page = defaultdict(list)
+        for title in titles:
+            for i in self.by_title[title]:
+                per_page[self.metadatas[i].get('source', title)].append(i)
+        ranked_pages = [sorted(chunks, key=lambda i: -scores.get(i, 0.0)) for chunks in per_page.values()]
+        ranked = []
+        for position in range(max(len(chunks) for chunks in ranked_pages)):
+            ranked.extend(chunks[position] for chunks in ranked_pages if position < len(chunks))
+        return ranked
+
+
+def load_keyword_index(path):
+    if not os.path.exists(path):
+        print(f"Keyword index {path} not found, using vector retrieval only")
+        return None
+    return KeywordIndex.load(path)
+
+
+def reciprocal_rank_fusion(rankings, weights=None, k=RRF_K):
+    # rankings: lists of hashable ids, best first. Returns ids ordered by fused score.
+    weights = weights or [1.0] * len(rankings)
+    scores = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking):
+            scores[item] += weight / (k + rank + 1)
+    return sorted(scores, key=lambda item: -scores[item])
@@ -0,0 +1,103 @@
+import json
+import os
+import re
+from functools import lru_cache
+
+# Keyword manual pages as shown in the app: minified HTML built by generate_keyword_pages.py,
+# with images served by Streamlit as static files (server.enableStaticServing)
+KEYWORD_PAGES_DIRECTORY = "./static/keyword_pages"
+KEYWORD_PAGES_URL = "app/static/keyword_pages"
+KEYWORD_PAGE_INDEX = "index.json"
+# The LibreOffice export the pages are built from, shown as it is if they have not been built
+MANUAL_HTML_DIRECTORY = "./opm-reference-manual/html_parts/chapters/subsections"
+KEYWORD_PAGE_CACHE_SIZE = 64
+# Deck keyword names (see deck_parser.KEYWORD_LINE_PATTERN) wherever they stand in a text
+KEYWORD_TOKEN_PATTERN = re.compile(r"(?<![A-Za-z0-9_+-])[A-Z][A-Z0-9_+-]{1,7}(?![A-Za-z0-9_+-])")
+
+# Replaces the LibreOffice stylesheets and inline styles stripped at build time
+KEYWORD_PAGE_CSS = (
+    "body{font-family:'Gill Sans MT',sans-serif;font-size:10pt;margin:8px}"
+    "table{border-collapse:collapse;margin:4px 0}"
+    "td,th{border:1px solid #000;padding:2px 4px;vertical-align:top}"
+    "td p,th p{margin:0}"
+    "dl,dd{margin-left:0}"
+    "img{vertical-align:middle}"
+)
+
+
+def keyword_page_index_path(directory=KEYWORD_PAGES_DIRECTORY):
+    return os.path.join(directory, KEYWORD_PAGE_INDEX)
+
+
+def manual_page_index(html_directory=MANUAL_HTML_DIRECTORY):
+    # title -> {chapter: absolute page path} of the unprocessed export
+    index = {}
+    for root, _, files in os.walk(html_directory):
+        for file in sorted(files):
+            if file.endswith('.html') and not file.startswith('index'):
+                path = os.path.abspath(os.path.join(root, file))
+                index.setdefault(os.path.splitext(file)[0].upper(), {})[os.path.basename(root)] = path
+    return index
+
+
+@lru_cache(maxsize=1)
+def load_keyword_page_index(directory=KEYWORD_PAGES_DIRECTORY, html_directory=MANUAL_HTML_DIRECTORY):
+    # title -> {chapter: page path relative to the pages directory}; without the built pages,
+    # the pages of the export (absolute paths)
+    path = keyword_page_index_path(directory)
+    if not os.path.exists(path):
+        index = manual_page_index(html_directory)
+        if index:
+            print(f"Keyword page index {path} not found, showing the unprocessed pages of {html_directory}; "
+                  f"run generate_keyword_pages.py to build them")
+        else:
+            print(f"Keyword page index {path} not found and no manual in {html_directory}, no keyword pages "
+                  f"can be shown; run generate_keyword_files.py and generate_keyword_pages.py")
+        return index
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=1)
+def manual_titles(directory=KEYWORD_PAGES_DIRECTORY, html_directory=MANUAL_HTML_DIRECTORY):
+    # Titles of the pages of the export, or of the built pages where the export is not shipped
+    # (the Docker image). Without either no upload would be linked to the manual, so that is an error.
+    titles = frozenset(manual_page_index(html_directory))
+    if not titles and os.path.exists(keyword_page_index_path(directory)):
+        titles = frozenset(load_keyword_page_index(directory))
+    if not titles:
+        raise FileNotFoundError(f"No keyword pages in {html_directory} or {keyword_page_index_path(directory)}, "
+                                f"run generate_keyword_files.py and generate_keyword_pages.py")
+    return titles
+
+
+def manual_keywords(names, directory=KEYWORD_PAGES_DIRECTORY, html_directory=MANUAL_HTML_DIRECTORY):
+    # The names that have a page in the manual, in the given order
+    titles = manual_titles(directory, html_directory)
+    return [name for name in dict.fromkeys(names) if name in titles]
+
+
+def scan_keywords(text, directory=KEYWORD_PAGES_DIRECTORY, html_directory=MANUAL_HTML_DIRECTORY):
+    # Manual keywords used in a text, in order of first use, in one pass over its upper case tokens
+    return manual_keywords(KEYWORD_TOKEN_PATTERN.findall(text), directory, html_directory)
+
+
+def keyword_page_path(title, source='', directory=KEYWORD_PAGES_DIRECTORY):
+    # Keywords appear in several sections (e.g. END); prefer the chapter the chunk came from
+    pages = load_keyword_page_index(directory).get(title)
+    if not pages:
+        return None
+    source_parts = source.replace('\\', '/').split('/')
+    for chapter, path in pages.items():
+        if chapter in source_parts:
+            return path
+    return next(iter(pages.values()))
+
+
+@lru_cache(maxsize=KEYWORD_PAGE_CACHE_SIZE)
+def render_keyword_page(path, directory=KEYWORD_PAGES_DIRECTORY):
+    with open(os.path.join(directory, path), 'r', encoding='utf-8') as f:
+        body = f.read()
+    if os.path.isabs(path):
+        return body  # a page of the export, with its own head and styles
+    return f"<html><head><meta charset=\"utf-8\"/><style>{KEYWORD_PAGE_CSS}</style></head><body>{body}</body></html>"
@@ -0,0 +1,88 @@
+import hashlib
+import re
+import time
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Deterministic, offline stand-ins for the OpenAI chat and embedding models, used by
+# benchmark.py to measure the pipeline without network access or API costs
+HASHING_DIMENSIONS = 512
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+KEYWORD_PATTERN = re.compile(r"\b[A-Z][A-Z0-9_]{2,7}\b")
+
+
+def _bucket(feature, dimensions):
+    digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+    value = int.from_bytes(digest, 'little')
+    return value % dimensions, 1.0 if value >> 63 else -1.0
+
+
+class HashingEmbeddings(Embeddings):
+    # Feature hashing of lower-cased words and word bigrams into a fixed number of dimensions,
+    # L2 normalised. Upper-case tokens (deck keywords) get extra weight, as with real queries
+    # naming a keyword.
+    def __init__(self, dimensions=HASHING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        tokens = TOKEN_PATTERN.findall(text)
+        words = [token.lower() for token in tokens]
+        for token, word in zip(tokens, words):
+            index, sign = _bucket(word, self.dimensions)
+            vector[index] += sign * (3.0 if token.isupper() and len(token) > 1 else 1.0)
+        for first, second in zip(words, words[1:]):
+            index, sign = _bucket(first + ' ' + second, self.dimensions)
+            vector[index] += sign * 0.5
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    # Answers contextualization prompts with the question plus the keywords named earlier in
+    # the conversation, and QA prompts with the keyword titles found in the retrieved context.
+    # `latency` is added before the first token and `token_delay` between streamed words,
+    # to approximate a remote model.
+    latency: float = 0.0
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _respond(self, messages):
+        system = " ".join(m.content for m in messages if isinstance(m, SystemMessage))
+        question = next((m.content for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+        if "standalone question" in system:
+            history = " ".join(m.content for m in messages[1:-1] if isinstance(m, HumanMessage))
+            named = [keyword for keyword in dict.fromkeys(KEYWORD_PATTERN.findall(history)) if keyword not in question]
+            return f"{question} ({', '.join(named[-3:])})" if named else question
+        titles = list(dict.fromkeys(KEYWORD_PATTERN.findall(system)))[:5]
+        return f"Based on the manual, see {', '.join(titles) or 'the reference manual'} for: {question}"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                  **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._respond(messages)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for i, piece in enumerate(re.findall(r"\S+\s*", self._respond(messages))):
+            if i:
+                time.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
@@ -0,0 +1,92 @@
+import os
+import re
+
+# Deck section and keyword family of the manual's keyword pages. The chapter subsections of the
+# manual hold the keywords of one section each; chapter 4.3 holds the keywords that are valid in
+# every section. Both are stored as chunk metadata at indexing time, and retrieval favours the
+# sections a question points to (see HybridRetriever).
+CHAPTER_SECTIONS = {
+    "4.3": "GLOBAL",
+    "5.3": "RUNSPEC",
+    "6.3": "GRID",
+    "7.3": "EDIT",
+    "8.3": "PROPS",
+    "9.3": "REGIONS",
+    "10.3": "SOLUTION",
+    "11.3": "SUMMARY",
+    "12.3": "SCHEDULE",
+}
+# Favoured with any section a question points to: keywords valid everywhere, and the model dimensions and
+# phases that constrain the keywords of all other sections
+ALWAYS_SEARCHED = ["GLOBAL", "RUNSPEC"]
+
+# (sections or None for any, family, title pattern); the first match wins
+KEYWORD_FAMILIES = [
+    (None, "dimensions", r"DIMS$|^DIMENS$"),
+    (None, "array_operation", r"^(ADD|ADDREG|BOX|ENDBOX|COPY|COPYBOX|COPYREG|EQUALS|EQUALREG|MAXVALUE|MINVALUE|"
+                              r"MULTIPLY|MULTIREG|OPERATE|OPERATER)$"),
+    (None, "report", r"^RPT|^(INIT|GRIDFILE|NOSIM|RUNSUM|EXCEL|SEPARATE)$"),
+    (None, "aquifer", r"^AQU"),
+    (None, "phase", r"^(OIL|WATER|GAS|DISGAS|VAPOIL|VAPWAT|SOLVENT|POLYMER|BRINE|CO2STORE|H2STORE|TEMP|THERMAL)$"),
+    (None, "units", r"^(METRIC|FIELD|LAB|PVT-M)$"),
+    (["GRID", "EDIT"], "fault", r"^(FAULTS|MULTFLT|THPRESFT)$"),
+    (["GRID", "EDIT"], "geometry", r"^(COORD|ZCORN|SPECGRID|TOPS|D[XYZ]V?|DEPTH|COORDSYS|MAPAXES|ACTNUM|MINPV.*|PINCH.*)$"),
+    (["GRID", "EDIT"], "transmissibility", r"^(MULT|TRAN|NNC|EDITNNC|PORV)"),
+    (["GRID", "EDIT"], "cell_property", r"^(PERM|PORO|NTG)"),
+    (["PROPS"], "saturation_function", r"^(S[WGO][A-Z0-9]*(OF|FN|F[23])|SOF[23]|SLGOF|I?KR|I?S[WGO](L|CR|U|LPC)|ENKR|ENPT|"
+                                       r"EHYSTR|SCAL|STONE|SATOPTS)"),
+    (["PROPS"], "pvt", r"^(PVT|PVD|PVC|PVZ|DENSITY|GRAVITY|ROCK|RSCONST|RVCONST|STCOND)"),
+    (["PROPS"], "equation_of_state", r"^(EOS|ZCRIT|TCRIT|PCRIT|ACF|MW|BIC|VCRIT|NCOMPS|CNAMES)"),
+    (["REGIONS"], "region_number", r"NUM$"),
+    (["SOLUTION"], "equilibration", r"^(EQUIL|RSVD|RVVD|RVWVD|PBVD|PDVD|TEMPVD|SALTVD|APIVD|THPRES)"),
+    (["SOLUTION"], "initial_state", r"^(PRESSURE|SWAT|SGAS|SOIL|RS|RV|PBUB|PDEW|TEMPI|SALT|RESTART)$"),
+    (["SCHEDULE"], "action", r"^(ACTION|UDQ|UDA|PYACTION|ENDACTIO)"),
+    (["SCHEDULE"], "time_stepping", r"^(DATES|TSTEP|TUNING[A-Z]*|NEXT[A-Z]*)$"),
+    (None, "vfp_table", r"^VFP"),
+    (["SCHEDULE"], "network", r"^(BRAN|NODE|NET|GNET|NETBALAN)"),
+    (["SCHEDULE"], "well_segments", r"^(WSEG|COMPSEG|WELSEGS)"),
+    (["SCHEDULE"], "group", r"^(G|GRUP)"),
+    (["SCHEDULE"], "well", r"^(W|COMP)"),
+]
+OTHER_FAMILY = "other"
+
+_compiled_families = [(sections, family, re.compile(pattern)) for sections, family, pattern in KEYWORD_FAMILIES]
+
+
+def chapter_section(chapter):
+    # Section of a chapter subsection directory such as '12.3', None for other directories
+    return CHAPTER_SECTIONS.get(chapter)
+
+
+def source_section(source):
+    return chapter_section(os.path.basename(os.path.dirname(source)))
+
+
+def keyword_family(title, section=None):
+    for sections, family, pattern in _compiled_families:
+        if (sections is None or section in sections) and pattern.search(title):
+            return family
+    return OTHER_FAMILY
+
+
+def section_metadata(title, section):
+    # Chroma metadata cannot hold None, so pages outside the keyword chapters get no section
+    metadata = {'family': keyword_family(title, section)}
+    if section:
+        metadata['section'] = section
+    return metadata
+
+
+def query_sections(question, deck_summaries=None):
+    # Sections the question points to, by its wording and by the keywords of the uploaded decks
+    # it names, plus ALWAYS_SEARCHED; [] when it points nowhere in particular
+    from deck_context import question_keywords, question_sections
+
+    sections = question_sections(question)
+    keywords = question_keywords(question)
+    for summary in deck_summaries or []:
+        sections.update(block.section for block in summary.blocks if block.name in keywords and block.section)
+    if not sections:
+        return []
+    return sorted(sections | set(ALWAYS_SEARCHED))
+
@@ -0,0 +1,219 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# Page-by-page text extraction of uploaded PDFs. Pages are extracted in order, in a process pool
+# for long documents, and extraction stops as soon as the word budget is reached, so a manual of
+# hundreds of pages costs about as much as the pages that are used. Pages that are mostly images
+# (scans, figures) or tables of numbers are skipped. Extracted pages are cached on disk by the
+# document's content hash, for re-uploads and other sessions.
+PDF_WORKERS = 4
+PDF_PAGES_PER_TASK = 8
+PARALLEL_MIN_PAGES = 16  # fewer uncached pages are extracted in this process
+PDF_EXTRACT_TIMEOUT = 60  # seconds; what is extracted by then is returned
+MIN_TEXT_WORDS = 30  # a page with an image and fewer words than this is an image page
+NUMERIC_PAGE_RATIO = 0.6  # a page with more numeric words than this is a table of numbers
+PDF_PAGE_CACHE = "./cache/pdf_pages.sqlite3"
+PDF_PAGE_CACHE_MAX_PAGES = 100000
+
+NUMBER_PATTERN = re.compile(r"[-+]?(\d+[.,]?\d*|\.\d+)([eE][-+]?\d+)?%?")
+
+_worker_reader = None
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class PdfPage:
+    def __init__(self, number, text):
+        self.number = number  # 0-based, as in PyPDFLoader metadata
+        self.text = text
+
+
+class PdfExtract:
+    def __init__(self, pages, words, page_count, truncated, skipped):
+        self.pages = pages  # PdfPage for the pages with text, in page order
+        self.words = words
+        self.page_count = page_count
+        self.truncated = truncated  # stopped at the word budget or the timeout
+        self.skipped = skipped  # image and number pages
+
+
+def has_images(page):
+    resources = page.get('/Resources')
+    if resources is None:
+        return False
+    xobjects = resources.get_object().get('/XObject')
+    if not xobjects:
+        return False
+    return any(xobject.get_object().get('/Subtype') == '/Image' for xobject in xobjects.get_object().values())
+
+
+def classify(text, images):
+    # 'text', 'image' or 'numeric'
+    words = text.split()
+    if images and len(words) < MIN_TEXT_WORDS:
+        return 'image'
+    if words and sum(1 for word in words if NUMBER_PATTERN.fullmatch(word)) > NUMERIC_PAGE_RATIO * len(words):
+        return 'numeric'
+    return 'text' if words else 'image'
+
+
+def extract_page(page):
+    try:
+        text = page.extract_text() or ''
+    except Exception as e:
+        # A damaged page should not fail the whole upload
+        print(f"Could not extract a PDF page: {e!r}")
+        text = ''
+    return text, classify(text, has_images(page))
+
+
+def _open_reader(content):
+    from pypdf import PdfReader
+
+    return PdfReader(io.BytesIO(content))
+
+
+def _init_worker(content):
+    # The document is sent to each worker once, not with every task
+    global _worker_reader
+    _worker_reader = _open_reader(content)
+
+
+def _extract_pages(numbers):
+    return [(number, *extract_page(_worker_reader.pages[number])) for number in numbers]
+
+
+class PageCache:
+    # (document hash, page) -> extracted text and kind, shared by the processes of the server
+    def __init__(self, path=PDF_PAGE_CACHE, max_pages=PDF_PAGE_CACHE_MAX_PAGES):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (document TEXT, page INTEGER, text TEXT, kind TEXT, "
+                         "used REAL, PRIMARY KEY (document, page))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS documents (document TEXT PRIMARY KEY, page_count INTEGER)")
+
+    def get(self, document):
+        # (page count or None, {page: (text, kind)})
+        with self._lock:
+            row = self._db.execute("SELECT page_count FROM documents WHERE document = ?", (document,)).fetchone()
+            rows = self._db.execute("SELECT page, text, kind FROM pages WHERE document = ?", (document,)).fetchall()
+            if rows:
+                with self._db:
+                    self._db.execute("UPDATE pages SET used = ? WHERE document = ?", (time.time(), document))
+        return row[0] if row else None, {page: (text, kind) for page, text, kind in rows}
+
+    def put(self, document, page_count, pages):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?)", (document, page_count))
+            self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                                 [(document, page, text, kind, now) for page, text, kind in pages])
+            count = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            if count > self.max_pages:
+                self._db.execute("DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages ORDER BY used LIMIT ?)",
+                                 (count - self.max_pages,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_page_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PageCache()
+    return _cache
+
+
+def page_batches(numbers, size=PDF_PAGES_PER_TASK):
+    return [numbers[start:start + size] for start in range(0, len(numbers), size)]
+
+
+def extract_pdf(content, max_words, workers=PDF_WORKERS, cache=None, timeout=PDF_EXTRACT_TIMEOUT):
+    # Text pages in order until max_words; the page that crosses the budget is cut at a word
+    cache = cache or get_page_cache()
+    document = hashlib.sha256(content).hexdigest()
+    page_count, cached = cache.get(document)
+    reader = None
+    if page_count is None:
+        reader = _open_reader(content)
+        page_count = len(reader.pages)
+    uncached = [number for number in range(page_count) if number not in cached]
+
+    pool, max_in_flight = None, 0
+    workers = min(workers, available_cpus(), len(uncached) // PDF_PAGES_PER_TASK + 1)
+    if len(uncached) >= PARALLEL_MIN_PAGES and workers > 1:
+        max_in_flight = 2 * workers  # bounds the extracted text held ahead of the budget check
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(content,))
+    batches = deque(page_batches(uncached))
+    in_flight = deque()  # futures of batches, in page order
+    extracted = {}
+    deadline = time.monotonic() + timeout
+
+    def submit():
+        while pool is not None and batches and len(in_flight) < max_in_flight:
+            in_flight.append(pool.submit(_extract_pages, batches.popleft()))
+
+    def next_batch():
+        # Extracts the next batch of uncached pages, in the pool or here
+        nonlocal reader
+        if pool is None:
+            reader = reader or _open_reader(content)
+            results = [(number, *extract_page(reader.pages[number])) for number in batches.popleft()]
+        else:
+            submit()
+            results = in_flight.popleft().result(timeout=max(deadline - time.monotonic(), 0))
+            submit()
+        cache.put(document, page_count, results)
+        for number, text, kind in results:
+            extracted[number] = (text, kind)
+
+    pages, words, skipped, truncated = [], 0, 0, False
+    try:
+        for number in range(page_count):
+            if number in cached:
+                text, kind = cached[number]
+            else:
+                while number not in extracted:
+                    if time.monotonic() > deadline:
+                        raise FutureTimeoutError()
+                    next_batch()
+                text, kind = extracted.pop(number)
+            if kind != 'text':
+                skipped += 1
+                continue
+            page_words = text.split()
+            if words + len(page_words) > max_words:
+                remaining = max_words - words
+                if remaining > 0:
+                    pages.append(PdfPage(number, " ".join(page_words[:remaining])))
+                    words = max_words
+                truncated = True
+                break
+            pages.append(PdfPage(number, text))
+            words += len(page_words)
+    except FutureTimeoutError:
+        print(f"PDF extraction stopped after {timeout} s at page {number + 1} of {page_count}")
+        truncated = True
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    return PdfExtract(pages, words, page_count, truncated, skipped)
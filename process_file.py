@@ -1,201 +1,153 @@
-__import__('pysqlite3')
-import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
-
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import matplotlib.pyplot as plt
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
-import streamlit as st
+from deck_parser import include_name, include_names, parse_deck_bytes
+from deck_context import summarize_deck
+from keyword_pages import manual_keywords, scan_keywords
+from table_store import TableStore
 
 # Define word count limits
 MAX_CONTEXT_WORDS = 10000  # for most files
-MAX_DATA_CONTEXT_WORDS = 10000  # for .data files (input decks)
 MAX_DATABASE_WORDS = 30000  # for database storage
+DECK_EXTENSIONS = ['data', 'inc', 'sch']  # parsed as OPM input decks
 
 class FileProcessResult:
-    def __init__(self, add_to_context=False, content='', data=None):
+    # Parsing (parse_file) produces everything but the retrieval store entries, which are left
+    # in database_texts/database_metadatas for store_result, so parsing can run in another process
+    def __init__(self, add_to_context=False, content='', data=None, deck=None, deck_summary=None,
+                 database_texts=None, database_metadatas=None, keywords=None):
         self.add_to_context = add_to_context
         self.content = content
         self.data = data
+        self.deck = deck
+        self.deck_summary = deck_summary
+        self.database_texts = database_texts or []
+        self.database_metadatas = database_metadatas or []
+        self.keywords = keywords or []  # manual keywords used in the file, see deck_pages.py
 
 def count_words(text):
     return len(text.split())
 
-def add_to_database(content, file_name, session_id):
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002", api_key=st.session_state.api_key)
-
-    # Create a combined collection name
-    collection_name = f"COMBINED_{session_id}"
-
-    vector_store = Chroma(
-        collection_name=collection_name,
-        embedding_function=embeddings,
-        persist_directory="./chroma_combined_db",
-    )
-
-    # Split the content into chunks
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = text_splitter.split_text(content)
-
-    # Add chunks to the database
-    vector_store.add_texts(chunks, metadatas=[{"source": file_name, "session_id": session_id} for _ in chunks])
-
-    return len(chunks)
-
-def process_text_file(content, file_extension, file_name, session_id):
+def add_to_database(texts, metadatas, session_id, api_key):
+    # Chunks go into the shared uploads store, tagged with the session; embeddings of chunks
+    # seen before (in any session) are reused. With an API server the server stores them.
+    # Runs in the upload threads, so the session's API key is passed in rather than read from
+    # the Streamlit session state
+    from api_client import API_URL
+
+    if API_URL:
+        from api_client import add_documents
+
+        return add_documents(session_id, texts, metadatas, api_key)
+
+    from rag_chain import get_session_store
+
+    return get_session_store(api_key).add_documents(session_id, texts, metadatas)
+
+def included_deck_files(files):
+    # Names of the uploaded deck files that are INCLUDEd, directly or through other included
+    # files, by an uploaded deck that nothing includes; they are parsed as part of that deck
+    decks = {include_name(name): content for name, content in (files or {}).items()
+             if name.split('.')[-1].lower() in DECK_EXTENSIONS}
+    includes = {name: [included for included in include_names(content) if included in decks and included != name]
+                for name, content in decks.items()}
+    roots = set(decks) - {included for names in includes.values() for included in names}
+    included = set()
+    pending = [included for root in roots for included in includes[root]]
+    while pending:
+        name = pending.pop()
+        if name not in included and name not in roots:
+            included.add(name)
+            pending.extend(includes[name])
+    return included
+
+def process_deck_file(content, file_extension, file_name, files=None):
+    # Parse the deck (resolving INCLUDEs among the uploaded files) and summarise it per keyword;
+    # the parts relevant to each question are selected when it is asked (see deck_context.py).
+    # Saturation and PVT tables are kept as arrays for validation and plotting
+    deck = parse_deck_bytes(content, file_name, files)
+    summary = summarize_deck(deck)
+    tables = TableStore.from_deck(deck)
+    print(f"Deck {file_name} with {len(deck.keywords)} keywords added to context "
+          f"(~{summary.original_tokens} tokens in full, {sum(block.tokens for block in summary.blocks)} summarised, "
+          f"{len(tables)} tables)")
+    return FileProcessResult(add_to_context=True, data=tables or None, deck=deck, deck_summary=summary,
+                             keywords=manual_keywords(deck.keyword_names()))
+
+def process_text_file(content, file_extension, file_name):
 
     word_count = count_words(content)
-
-    # Special handling for tables.inc
-    if file_name == "tables.inc":
-        # Split the content into tables
-        tables = content.split('/')[:-1]  # Exclude the last empty element
-
-        all_data = []
-        for table in tables:
-            lines = table.strip().split('\n')
-            header = lines[0].strip('-- ').split()
-            data = [line.split() for line in lines[2:] if line and not line.startswith('SGWFN')]
-            table_data = {col: [float(row[i]) for row in data] for i, col in enumerate(header)}
-            all_data.append(table_data)
-        return FileProcessResult(add_to_context=False, data=all_data)
+    keywords = scan_keywords(content)
 
     # Add to context if file is small enough
-    max_words = MAX_DATA_CONTEXT_WORDS if file_extension == 'data' else MAX_CONTEXT_WORDS
-    if word_count <= max_words:
+    if word_count <= MAX_CONTEXT_WORDS:
         print(f"File with {word_count} words added to context")
-        return FileProcessResult(add_to_context=True, content=content)
-    #elif word_count <= MAX_DATABASE_WORDS:
-    #    chunks_added = add_to_database(content, file_name, session_id)
-    #    print(f"File with {word_count} words added to database in {chunks_added} chunks for retrieval")
-    #    return FileProcessResult(add_to_context=False, content=f"File {file_name} added to database for retrieval")
+        return FileProcessResult(add_to_context=True, content=content, keywords=keywords)
+    elif word_count <= MAX_DATABASE_WORDS:
+        print(f"File with {word_count} words to be added to database for retrieval")
+        return FileProcessResult(add_to_context=False, content=f"File {file_name} added to database for retrieval",
+                                 database_texts=[content], database_metadatas=[{"source": file_name}],
+                                 keywords=keywords)
     else:
-        truncated_content = ' '.join(content.split()[:max_words])
-        #chunks_added = add_to_database(truncated_content, file_name, session_id)
-        #print(f"File truncated to {MAX_DATABASE_WORDS} words and added to database in {chunks_added} chunks")
-        print(f"File with {word_count} words added to context")
-        return FileProcessResult(add_to_context=True, content=truncated_content)
-
-def add_pdf_to_database(pages, session_id, file_name):
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002", api_key=st.session_state.api_key)
-
-    # Create a combined collection name
-    collection_name = f"COMBINED_{session_id}"
-
-    vector_store = Chroma(
-        collection_name=collection_name,
-        embedding_function=embeddings,
-        persist_directory="./chroma_combined_db",
-    )
-
-    # Split the text into chunks
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
-    )
-    chunks = text_splitter.split_documents(pages)
-
-    # Add chunks to the database with metadata
-    texts = [chunk.page_content for chunk in chunks]
-    metadatas = [{"source": file_name, "session_id": session_id, "page": chunk.metadata["page"]} for chunk in chunks]
-    vector_store.add_texts(texts, metadatas=metadatas)
-
-    return len(chunks)
-
-def process_pdf_file(file, session_id):
-    # Create a temporary file to save the uploaded PDF
-    import tempfile
-    import os
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(file.getvalue())
-        temp_file_path = temp_file.name
-
-    try:
-        # Use PyPDFLoader to load the PDF
-        loader = PyPDFLoader(temp_file_path)
-        pages = loader.load()
-
-        # Combine all page contents into a single string
-        content = "\n".join([page.page_content for page in pages])
-        word_count = count_words(content)
-
-        # Check word count and handle accordingly
-        if word_count <= MAX_CONTEXT_WORDS:
-            print(f"PDF content with {word_count} words added to context")
-            return FileProcessResult(add_to_context=True, content=content)
-        #elif word_count <= MAX_DATABASE_WORDS:
-        #    chunks_added = add_pdf_to_database(pages, session_id, file.name)
-        #    print(f"PDF content with {word_count} words added to database in {chunks_added} chunks for retrieval")
-        #    return FileProcessResult(add_to_context=False, content=f"PDF file {file.name} added to database for retrieval")
-        else:
-            average_words_per_page = word_count / len(pages)
-            truncated_pages = pages[:int(MAX_CONTEXT_WORDS // average_words_per_page)]
-            #chunks_added = add_pdf_to_database(truncated_pages, session_id, file.name)
-            #print(f"PDF content truncated to {MAX_DATABASE_WORDS} words and added to database in {chunks_added} chunks")
-            #return FileProcessResult(add_to_context=False, content=f"PDF file {file.name} truncated and added to database for retrieval")
-            truncated_content = "\n".join([page.page_content for page in truncated_pages])
-            print(f"PDF content truncated to {MAX_CONTEXT_WORDS} words and added to context")
-            return FileProcessResult(add_to_context=True, content=truncated_content)
-    finally:
-        # Clean up the temporary file
-        os.unlink(temp_file_path)
-
-def process_file(file, session_id):
-    file_extension = file.name.split('.')[-1].lower()
-    file_name = file.name.lower()
-
-    # Read file content
-    content = file.read()
+        truncated_content = ' '.join(content.split()[:MAX_DATABASE_WORDS])
+        print(f"File truncated to {MAX_DATABASE_WORDS} words to be added to database")
+        return FileProcessResult(add_to_context=False,
+                                 content=f"File {file_name} truncated and added to database for retrieval",
+                                 database_texts=[truncated_content], database_metadatas=[{"source": file_name}],
+                                 keywords=keywords)
+
+def pdf_database_result(pages, file_name, content):
+    return FileProcessResult(add_to_context=False, content=content,
+                             database_texts=[page.text for page in pages],
+                             database_metadatas=[{"source": file_name, "page": page.number} for page in pages])
+
+def process_pdf_file(content, file_name):
+    # Pages are extracted in order until the database budget is reached (see pdf_extract.py)
+    from pdf_extract import extract_pdf
+
+    extract = extract_pdf(content, MAX_DATABASE_WORDS)
+    print(f"PDF {file_name}: {len(extract.pages)} of {extract.page_count} pages with {extract.words} words extracted, "
+          f"{extract.skipped} image or number pages skipped")
+
+    if extract.words <= MAX_CONTEXT_WORDS and not extract.truncated:
+        print(f"PDF content with {extract.words} words added to context")
+        return FileProcessResult(add_to_context=True, content="\n".join(page.text for page in extract.pages))
+    elif not extract.truncated:
+        print(f"PDF content with {extract.words} words to be added to database for retrieval")
+        return pdf_database_result(extract.pages, file_name, f"PDF file {file_name} added to database for retrieval")
+    else:
+        print(f"PDF content truncated to {extract.words} words to be added to database")
+        return pdf_database_result(extract.pages, file_name,
+                                   f"PDF file {file_name} truncated and added to database for retrieval")
+
+def parse_file(name, content, files=None):
+    # `files` maps the names of all uploaded files to their content, for resolving INCLUDEs
+    file_extension = name.split('.')[-1].lower()
+    file_name = name.lower()
+
+    if file_extension in DECK_EXTENSIONS:
+        if include_name(name) in included_deck_files(files):
+            # Already summarised with the deck that includes it
+            print(f"Deck file {file_name} is included by another uploaded deck")
+            return FileProcessResult()
+        return process_deck_file(content, file_extension, file_name, files)
 
     # Decode content if it's a text file
-    if file_extension in ['data', 'dbg', 'sch', 'inc', 'txt']:
+    if file_extension in ['dbg', 'txt']:
         try:
             content = content.decode('utf-8')
         except UnicodeDecodeError:
             return FileProcessResult(add_to_context=True, content=f"File {file_name} could not be decoded")
 
-        return process_text_file(content, file_extension, file_name, session_id)
+        return process_text_file(content, file_extension, file_name)
 
     elif file_extension == 'pdf':
-        return process_pdf_file(file, session_id)
+        return process_pdf_file(content, name)
     else:
         return FileProcessResult(add_to_context=True, content=f"Unsupported file type: {file_extension}")
 
-def plot_sgwfn_data(dataframes):
-    if not dataframes:
-        return plt.figure()  # Return an empty figure if no data
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    fig.suptitle('SGWFN Data')
-
-    data = dataframes[0]  # We'll only plot the first dataset
-
-    # Determine the correct column names
-    sg_col = next((col for col in data.keys() if col.lower().startswith('s')), None)
-    krg_col = next((col for col in data.keys() if col.lower().startswith('krg')), None)
-    krw_col = next((col for col in data.keys() if col.lower().startswith('krw')), None)
-    pcgw_col = next((col for col in data.keys() if col.lower().startswith('pc')), None)
-
-    if sg_col and krg_col and krw_col and pcgw_col:
-        ax.plot(data[sg_col], data[krg_col], label='KRG')
-        ax.plot(data[sg_col], data[krw_col], label='KRW')
-        ax.set_xlabel(sg_col)
-        ax.set_ylabel('Relative Permeability')
-
-        ax2 = ax.twinx()
-        ax2.plot(data[sg_col], data[pcgw_col], 'r--', label='PCGW')
-        ax2.set_ylabel('Capillary Pressure')
-
-        # Combine legends from both axes
-        lines1, labels1 = ax.get_legend_handles_labels()
-        lines2, labels2 = ax2.get_legend_handles_labels()
-        ax.legend(lines1 + lines2, labels1 + labels2, loc='center right')
-    else:
-        ax.text(0.5, 0.5, 'Insufficient data', ha='center', va='center')
+def store_result(result, session_id, api_key):
+    if result.database_texts:
+        chunks_added = add_to_database(result.database_texts, result.database_metadatas, session_id, api_key)
+        print(f"{chunks_added} chunks added to database for retrieval")
+    return result
 
-    plt.tight_layout()
-    return fig
+def process_file(file, session_id, api_key, files=None):
+    return store_result(parse_file(file.name, file.read(), files), session_id, api_key)
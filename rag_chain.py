@@ -1,27 +1,447 @@
-__import__('pysqlite3')
+import json
+import os
+import re
 import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from chat_history import CHAT_HISTORY_BACKEND, compress_history
+from context_packer import expand_to_parents, pack_context
+from contextualize import needs_contextualization, normalize_question
+from embeddings import EMBEDDING_MODEL, model_slug
+from manual_sections import query_sections
+from resource_cache import ResourceKey, hash_api_key, resource_cache
+from timing import timed
+from tokens import count_tokens
+from tracing import LOG_CONTEXT, document_ids, start_trace
 
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_chroma import Chroma
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+KEYWORD_COLLECTION = "KEYWORDS_cleaned"
+KEYWORD_PERSIST_DIRECTORY = "./chroma_langchain_db"
+# Collections built before the model was recorded in their metadata
+LEGACY_EMBEDDING_MODEL = "text-embedding-3-small"
+# Chunks retrieved per question; context_packer keeps those that fit the model's token budget
+CONTEXT_CANDIDATES = 8
+# One HTTP connection pool per process for all OpenAI clients (chat and embeddings, any key).
+# OPENAI_BASE_URL points them at another server, e.g. fake_llm_server.py
+LLM_MAX_CONNECTIONS = int(os.getenv("OPM_LLM_MAX_CONNECTIONS", "32"))
+LLM_TIMEOUT = 120  # seconds
 
+_collection_versions = {}  # manifest path -> (modification time, collection version)
 
-store = {}
 
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
+def use_pysqlite3():
+    # chromadb needs a newer sqlite3 than some system Pythons ship; swap in pysqlite3
+    # the first time a Chroma handle is needed instead of at import time
+    if getattr(sys.modules.get('sqlite3'), '__name__', None) != 'pysqlite3':
+        __import__('pysqlite3')
+        sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 
+def get_http_client():
+    key = ResourceKey("http_client", None, None, None)
+    return resource_cache.get_or_create(key, _create_http_client)
 
-def create_conversational_rag_chain(model, api_key):
+
+def get_llm(model, api_key):
+    key = ResourceKey("llm", model, hash_api_key(api_key), None)
+    return resource_cache.get_or_create(key, lambda: _create_llm(model, api_key))
+
+
+def get_embeddings(api_key, model=EMBEDDING_MODEL):
+    key = ResourceKey("embeddings", model, hash_api_key(api_key), None)
+    return resource_cache.get_or_create(key, lambda: _create_embeddings(model, api_key))
+
+
+def get_vector_store(api_key, collection_name=KEYWORD_COLLECTION):
+    # Queries are embedded with the model the collection was built with, see _create_vector_store
+    key = ResourceKey("vector_store", None, hash_api_key(api_key), collection_name)
+    return resource_cache.get_or_create(key, lambda: _create_vector_store(api_key, collection_name))
+
+
+def get_conversational_rag_chain(model, api_key, collection_name=KEYWORD_COLLECTION):
+    key = ResourceKey("rag_chain", model, hash_api_key(api_key), collection_name)
+    return resource_cache.get_or_create(
+        key, lambda: create_conversational_rag_chain(model, api_key, collection_name))
+
+
+def get_session_store(api_key, model=EMBEDDING_MODEL):
+    key = ResourceKey("session_store", model, hash_api_key(api_key), None)
+    return resource_cache.get_or_create(key, lambda: _create_session_store(api_key, model))
+
+
+def get_history_store(backend=CHAT_HISTORY_BACKEND):
+    # Shared by every chain in the process; with the SQLite backend also across processes
+    key = ResourceKey("chat_history", None, None, backend)
+    return resource_cache.get_or_create(key, lambda: _create_history_store(backend))
+
+
+def clear_session_history(session_id):
+    # Also drops the session's prefetched deck keyword pages
+    get_history_store().clear(session_id)
+    get_deck_page_cache().clear(session_id)
+
+
+def get_keyword_index(collection_name=KEYWORD_COLLECTION):
+    # Loaded on first retrieval, not when the chain is built; a missing index is cached as False
+    key = ResourceKey("keyword_index", None, None, collection_name)
+    index = resource_cache.get_or_create(key, lambda: _load_keyword_index(collection_name))
+    return index or None
+
+
+def get_page_store(collection_name=KEYWORD_COLLECTION):
+    # Full keyword pages for small-to-big retrieval; missing for collections built from the TXT export
+    key = ResourceKey("page_store", None, None, collection_name)
+    return resource_cache.get_or_create(key, lambda: _open_page_store(collection_name)) or None
+
+
+def get_deck_page_cache(collection_name=KEYWORD_COLLECTION):
+    key = ResourceKey("deck_pages", None, None, collection_name)
+    return resource_cache.get_or_create(key, lambda: _create_deck_page_cache())
+
+
+def prefetch_deck_pages(session_id, keywords, collection_name=KEYWORD_COLLECTION):
+    # Manual pages of the keywords used in the session's uploads; called when an upload is
+    # stored, so its first question finds them ready
+    index = get_keyword_index(collection_name)
+    if index is None or not keywords:
+        return None
+    return get_deck_page_cache(collection_name).prefetch(session_id, keywords, index, get_page_store(collection_name))
+
+
+def get_answer_cache(collection_name=KEYWORD_COLLECTION):
+    key = ResourceKey("answer_cache", None, None, collection_name)
+    return resource_cache.get_or_create(key, lambda: _create_answer_cache(collection_name))
+
+
+def collection_version(collection_name=KEYWORD_COLLECTION):
+    # Written by generate_database.py; changes whenever the collection is rebuilt or updated.
+    # The manifest is only read again when its modification time changes
+    path = os.path.join(KEYWORD_PERSIST_DIRECTORY, f"manifest_{collection_name}.json")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return ''
+    cached = _collection_versions.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'r', encoding='utf-8') as f:
+        version = json.load(f).get('collection_version', '')
+    _collection_versions[path] = (mtime, version)
+    return version
+
+
+def invalidate_resources(**fields):
+    # e.g. invalidate_resources(collection=KEYWORD_COLLECTION) after the keyword database is rebuilt
+    return resource_cache.invalidate(**fields)
+
+
+def _create_http_client():
+    import httpx
+
+    limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+    return httpx.Client(limits=limits, timeout=LLM_TIMEOUT)
+
+
+def _create_llm(model, api_key):
+    with timed("import langchain_openai"):
+        from langchain_openai import ChatOpenAI
+    with timed(f"create ChatOpenAI ({model})"):
+        return ChatOpenAI(model=model, temperature=0, api_key=api_key, http_client=get_http_client())
+
+
+def _create_embeddings(model, api_key):
+    from embeddings import create_embeddings
+
+    with timed(f"create embeddings ({model})"):
+        return create_embeddings(model, api_key, http_client=get_http_client())
+
+
+def _load_keyword_index(collection_name):
+    from keyword_index import keyword_index_path, load_keyword_index
+
+    with timed(f"load keyword index {collection_name}"):
+        return load_keyword_index(keyword_index_path(KEYWORD_PERSIST_DIRECTORY, collection_name)) or False
+
+
+def _create_session_store(api_key, model):
+    with timed("import chromadb"):
+        use_pysqlite3()
+        from session_store import SESSION_COLLECTION, SessionStore
+    with timed("open session store"):
+        # One collection per embedding model, as vectors of different models cannot be mixed
+        return SessionStore(get_embeddings(api_key, model), model, collection_name=f"{SESSION_COLLECTION}_{model_slug(model)}")
+
+
+def _create_history_store(backend):
+    from chat_history import create_history_store
+
+    with timed(f"open chat history store ({backend})"):
+        return create_history_store(backend)
+
+
+def _open_page_store(collection_name):
+    from keyword_chunker import PageStore, page_store_path
+
+    path = page_store_path(KEYWORD_PERSIST_DIRECTORY, collection_name)
+    return PageStore(path) if os.path.exists(path) else False
+
+
+def _create_deck_page_cache():
+    from deck_pages import DeckPageCache
+
+    return DeckPageCache()
+
+
+def _create_answer_cache(collection_name):
+    from answer_cache import AnswerCache
+
+    with timed("open answer cache"):
+        return AnswerCache(f"./cache/answer_cache_{collection_name}.sqlite3", lambda: collection_version(collection_name))
+
+
+def _create_vector_store(api_key, collection_name):
+    # The compact index of the Docker image if there is one (see compact_index.py), else the Chroma collection
+    from compact_index import compact_index_directory, open_compact_index
+
+    with timed(f"open compact index {collection_name}"):
+        store = open_compact_index(compact_index_directory(KEYWORD_PERSIST_DIRECTORY, collection_name),
+                                   collection_version(collection_name), lambda model: _query_embeddings(api_key, model),
+                                   lambda: get_keyword_index(collection_name))
+    if store is not None:
+        return store
+    with timed("import chromadb and langchain_chroma"):
+        use_pysqlite3()
+        import chromadb
+        from langchain_chroma import Chroma
+    with timed(f"open Chroma collection {collection_name}"):
+        client = chromadb.PersistentClient(path=KEYWORD_PERSIST_DIRECTORY)
+        metadata = client.get_or_create_collection(collection_name).metadata or {}
+    return Chroma(
+        client=client,
+        collection_name=collection_name,
+        embedding_function=_query_embeddings(api_key, metadata.get('embedding_model', LEGACY_EMBEDDING_MODEL)),
+    )
+
+
+def _query_embeddings(api_key, model):
+    if model != EMBEDDING_MODEL:
+        print(f"Collection was built with {model}, using it for queries instead of {EMBEDDING_MODEL}")
+    return get_embeddings(api_key, model)
+
+
+def file_prompt(question, file_context=None):
+    # The question as the model sees it and as the history keeps it: after the uploaded files' text
+    return f"{file_context}\n\n{question}" if file_context else question
+
+
+class ConversationalRAG:
+    # History-aware retrieval chain with an answer cache in front of retrieval and generation.
+    # Keeps the streaming interface of the RunnableWithMessageHistory chain it replaces:
+    # stream() yields {'context': documents} once, then {'answer': token} chunks, and finally
+    # {'timings': {stage: seconds}} for the turn. Older turns of long conversations are folded
+    # into a running summary after the answer, off the response path.
+    def __init__(self, model, contextualize_chain, retriever, question_answer_chain, embeddings, answer_cache=None,
+                 history_store=None, summarize_chain=None, load_page_store=None, load_deck_pages=None):
+        self.model = model
+        self.contextualize_chain = contextualize_chain
+        self.retriever = retriever
+        self.question_answer_chain = question_answer_chain
+        self.embeddings = embeddings
+        self.answer_cache = answer_cache
+        self.history_store = history_store or get_history_store()
+        self.summarize_chain = summarize_chain
+        self.load_page_store = load_page_store
+        self.load_deck_pages = load_deck_pages
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        self._compressing = set()  # sessions with a compression queued or running
+        self._compressing_lock = threading.Lock()
+
+    def _summarize(self, summary, messages):
+        conversation = "\n".join(f"{'User' if m.role == 'human' else 'Assistant'}: {m.content}" for m in messages)
+        return self.summarize_chain.invoke({"summary": summary or "(none)", "conversation": conversation})
+
+    def _compress_history(self, session_id):
+        try:
+            if compress_history(self.history_store, session_id, self._summarize,
+                                lambda text: count_tokens(text, self.model)):
+                print(f"Summarized older turns of session {session_id}")
+        except Exception as e:
+            # The hard per-session message cap still bounds the history
+            print(f"Chat history summary failed: {e}")
+        finally:
+            with self._compressing_lock:
+                self._compressing.discard(session_id)
+
+    def _record_turn(self, session_id, question, answer):
+        self.history_store.append(session_id, [(role, text, count_tokens(text, self.model))
+                                               for role, text in (('human', question), ('ai', answer))])
+        if self.summarize_chain is not None:
+            # One compression per session at a time; turns added meanwhile are folded after the next turn
+            with self._compressing_lock:
+                if session_id in self._compressing:
+                    return
+                self._compressing.add(session_id)
+            self._executor.submit(self._compress_history, session_id)
+
+    def _retrieve(self, question, embedding, session_id, deck_summaries, deck_chunks, trace, prefix=""):
+        # Favouring the deck sections the question (or the deck keywords it names) points to,
+        # and biased towards the manual pages of the keywords used in the session's decks
+        from deck_context import is_deck_question
+
+        sections = query_sections(question, deck_summaries)
+        deck_question = bool(deck_chunks) and is_deck_question(question)
+        with trace.stage(prefix + "retrieve", sections=sections, deck_question=deck_question) as span:
+            context = self.retriever.retrieve(question, embedding=embedding, session_id=session_id, sections=sections,
+                                              deck_chunks=deck_chunks, deck_question=deck_question)
+            span.set(chunk_ids=document_ids(context))
+        return context
+
+    def _embed_and_retrieve(self, question, use_cache, trace, session_id, deck_summaries, deck_chunks, prefix=""):
+        embedding = None
+        if use_cache:
+            with trace.stage(prefix + "embed"):
+                embedding = self.embeddings.embed_query(question)
+        return embedding, self._retrieve(question, embedding, session_id, deck_summaries, deck_chunks, trace, prefix)
+
+    def stream(self, inputs, config=None):
+        session_id = ((config or {}).get("configurable") or inputs.get("configurable") or {})["session_id"]
+        trace = start_trace("chat", model=self.model, session_id=session_id)
+        try:
+            yield from self._stream(inputs, session_id, trace)
+        except GeneratorExit:
+            trace.finish("cancelled")
+            raise
+        except Exception:
+            trace.finish("error")
+            raise
+
+    def _stream(self, inputs, session_id, trace):
+        # The user's question, and the text of files uploaded with it: only the question is
+        # classified, rewritten and retrieved for; the model and the history get both
+        question = inputs["input"]
+        prompt = file_prompt(question, inputs.get("file_context"))
+        deck_summaries = inputs.get("deck_summaries") or []
+        deck_keywords = inputs.get("deck_keywords") or []
+        chat_history = self.history_store.load(session_id).to_messages()
+        use_cache = self.answer_cache is not None and inputs.get("use_answer_cache", True)
+        trace.set(history_messages=len(chat_history), decks=len(deck_summaries))
+
+        deck_pages = deck_chunks = None
+        if deck_keywords and self.load_deck_pages is not None:
+            with trace.stage("deck_pages") as span:
+                deck_pages = self.load_deck_pages(session_id, deck_keywords)
+                deck_chunks = deck_pages.chunk_set(deck_keywords) if deck_pages is not None else None
+                span.set(keywords=len(deck_keywords), chunks=len(deck_chunks or ()))
+
+        # Reformulate follow-up questions so they can be understood without the chat history.
+        # Self-contained questions skip the rewrite; otherwise retrieval for the raw question runs
+        # while the rewrite is in flight and is used if the rewrite leaves the question unchanged.
+        standalone_question = question
+        embedding = context = None
+        if chat_history and needs_contextualization(question, chat_history):
+            speculative = self._executor.submit(self._embed_and_retrieve, question, use_cache, trace, session_id,
+                                               deck_summaries, deck_chunks, "speculative_")
+            with trace.stage("contextualize") as span:
+                standalone_question = self.contextualize_chain.invoke({"input": question, "chat_history": chat_history})
+                span.set(question_tokens=count_tokens(question, self.model),
+                         standalone_tokens=count_tokens(standalone_question, self.model))
+            if normalize_question(standalone_question) == normalize_question(question):
+                embedding, context = speculative.result()
+            else:
+                speculative.cancel()
+        elif chat_history:
+            trace.record("contextualize_skipped", 0.0)
+            trace.event("contextualize_skipped")
+
+        if use_cache:
+            if embedding is None:
+                with trace.stage("embed"):
+                    embedding = self.embeddings.embed_query(standalone_question)
+            with trace.stage("answer_cache") as span:
+                cached = self.answer_cache.lookup(standalone_question, embedding, self.model)
+                span.set(cache_hit=cached is not None)
+            if cached is not None:
+                yield {"context": cached.documents}
+                trace.mark("first_token")
+                for piece in re.findall(r"\S+\s*|\s+", cached.answer):
+                    yield {"answer": piece}
+                self._record_turn(session_id, prompt, cached.answer)
+                yield {"timings": trace.finish()}
+                return
+
+        if context is None:
+            context = self._retrieve(standalone_question, embedding, session_id, deck_summaries, deck_chunks, trace)
+
+        # Replace several chunks of a short page by the page, merge overlapping chunks, drop
+        # near-duplicates and keep what fits the model's budget
+        with trace.stage("pack_context") as span:
+            page_store = self.load_page_store() if self.load_page_store else None
+            expanded = 0
+            if page_store is not None:
+                load_page = page_store.get
+                if deck_pages is not None:
+                    load_page = lambda parent: deck_pages.load_page(parent, page_store)
+                context, expanded = expand_to_parents(context, load_page, self.model)
+            packed = pack_context(context, self.model)
+            span.set(packed_tokens=packed.packed_tokens, saved_tokens=packed.saved_tokens, merged=packed.merged,
+                     dropped=packed.dropped, expanded_pages=expanded)
+        context = packed.documents
+        yield {"context": context}
+
+        # Parts of the uploaded decks relevant to this question, selected under a token budget
+        deck_context = ""
+        if deck_summaries:
+            from deck_context import select_deck_context
+
+            with trace.stage("deck_context") as span:
+                selected, used, full = select_deck_context(deck_summaries, standalone_question, self.model)
+                span.set(deck_tokens=used, full_deck_size=full)
+            deck_context = "\n\nUploaded simulation deck:\n" + selected
+
+        answer = ""
+        with trace.stage("generate") as span:
+            for piece in self.question_answer_chain.stream(
+                    {"input": prompt, "chat_history": chat_history, "context": context,
+                     "deck_context": deck_context}):
+                if not answer:
+                    trace.mark("first_token")
+                    trace.event("first_token")
+                answer += piece
+                yield {"answer": piece}
+            span.set(context_tokens=packed.packed_tokens, completion_tokens=count_tokens(answer, self.model))
+
+        self._record_turn(session_id, prompt, answer)
+        if use_cache and answer:
+            self.answer_cache.store(standalone_question, embedding, self.model, answer, context)
+        if LOG_CONTEXT:
+            trace.set(question=question, standalone_question=standalone_question, answer=answer,
+                      context=[document.page_content for document in context])
+        yield {"timings": trace.finish()}
+
+
+def create_conversational_rag_chain(model, api_key, collection_name=KEYWORD_COLLECTION):
+    vector_store = get_vector_store(api_key, collection_name)
+    return build_conversational_rag_chain(
+        model,
+        llm=get_llm(model, api_key),
+        embeddings=vector_store.embeddings,
+        vector_store=vector_store,
+        load_keyword_index=lambda: get_keyword_index(collection_name),
+        answer_cache=get_answer_cache(collection_name),
+        load_session_store=lambda: get_session_store(api_key),
+        load_page_store=lambda: get_page_store(collection_name),
+        load_deck_pages=lambda session_id, keywords: prefetch_deck_pages(session_id, keywords, collection_name),
+    )
+
+
+def build_conversational_rag_chain(model, llm, embeddings, vector_store, load_keyword_index, answer_cache=None,
+                                   load_session_store=None, history_store=None, load_page_store=None,
+                                   load_deck_pages=None):
+    # Assembles the chain from its parts; benchmark.py passes local stand-ins for the OpenAI models
+    with timed("import langchain chains"):
+        from langchain.chains.combine_documents import create_stuff_documents_chain
+        from langchain_core.output_parsers import StrOutputParser
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+        from hybrid_retriever import HybridRetriever
 
     # Construct QA prompt from system prompt and chat history
     system_prompt = (
@@ -30,6 +450,7 @@ def create_conversational_rag_chain(model, api_key):
         "the question."
         "\n\n"
         "{context}"
+        "{deck_context}"
     )
 
     qa_prompt = ChatPromptTemplate.from_messages(
@@ -55,31 +476,43 @@ def create_conversational_rag_chain(model, api_key):
             ("human", "{input}"),
         ]
     )
-    
-    llm = ChatOpenAI(model=model, temperature=0, api_key=api_key)
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small", api_key=api_key)
 
-
-    vector_store = Chroma(
-        collection_name="KEYWORDS_cleaned",
-        embedding_function=embeddings,
-        persist_directory="./chroma_langchain_db",
+    # Fold older turns into a running summary once the history exceeds its token budget
+    summarize_system_prompt = (
+        "Summarize the conversation between a reservoir engineer and an assistant so it can be "
+        "continued without the full transcript. Extend the existing summary with the new turns. "
+        "Keep keyword names, units, numbers and file names exactly; be brief.\n\n"
+        "Existing summary: {summary}"
+    )
+    summarize_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", summarize_system_prompt),
+            ("human", "{conversation}"),
+        ]
     )
 
-    retriever = vector_store.as_retriever()
-
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    # Exact keyword-title hits and BM25 fused with dense similarity, plus the session's uploads
+    retriever = HybridRetriever(
+        k=CONTEXT_CANDIDATES,
+        vector_store=vector_store,
+        load_keyword_index=load_keyword_index,
+        load_session_store=load_session_store,
+    )
 
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    with timed(f"build conversational RAG chain ({model})"):
+        question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+        contextualize_chain = contextualize_q_prompt | llm | StrOutputParser()
 
-    # Create a conversational chain with message history
-    conversational_rag_chain = RunnableWithMessageHistory(
-        rag_chain,
-        get_session_history,
-        input_messages_key="input",
-        history_messages_key="chat_history",
-        output_messages_key="answer",
-    )
-    return conversational_rag_chain
\ No newline at end of file
+        conversational_rag_chain = ConversationalRAG(
+            model,
+            contextualize_chain,
+            retriever,
+            question_answer_chain,
+            embeddings=embeddings,
+            answer_cache=answer_cache,
+            history_store=history_store,
+            load_page_store=load_page_store,
+            load_deck_pages=load_deck_pages,
+            summarize_chain=summarize_prompt | llm | StrOutputParser(),
+        )
+    return conversational_rag_chain
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Process-wide cache for expensive, shareable objects (LLM clients, Chroma handles, chains).
+# Streamlit reruns the whole script on every interaction, but imported modules live
+# for the lifetime of the server process, so anything stored here survives reruns.
+MAX_CACHED_RESOURCES = 16
+RESOURCE_IDLE_TIMEOUT = 60 * 60  # seconds
+
+ResourceKey = namedtuple('ResourceKey', ['kind', 'model', 'api_key_hash', 'collection'])
+
+
+def hash_api_key(api_key):
+    # Never keep raw API keys in cache keys
+    if not api_key:
+        return ''
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+class ResourceCache:
+    def __init__(self, max_size=MAX_CACHED_RESOURCES, idle_timeout=RESOURCE_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._entries = OrderedDict()  # key -> (value, last_used)
+        self._building = {}  # key -> lock, so concurrent sessions build a resource only once
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                value = self._lookup(key)
+                if value is not None:
+                    return value
+            try:
+                value = factory()
+                with self._lock:
+                    self._entries[key] = (value, time.monotonic())
+                    self._evict()
+            finally:
+                # Also after a failed build, so the next call tries again with a fresh lock
+                with self._lock:
+                    self._building.pop(key, None)
+        return value
+
+    def invalidate(self, **fields):
+        # Drop every entry whose key matches all given fields, e.g. invalidate(collection='KEYWORDS_cleaned')
+        with self._lock:
+            stale = [key for key in self._entries
+                     if all(getattr(key, name) == value for name, value in fields.items())]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def _lookup(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        value, last_used = entry
+        if time.monotonic() - last_used > self.idle_timeout:
+            return None
+        # Re-insert to mark as most recently used
+        self._entries[key] = (value, time.monotonic())
+        return value
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, (_, last_used) in self._entries.items() if now - last_used > self.idle_timeout]:
+            del self._entries[key]
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+resource_cache = ResourceCache()
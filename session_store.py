@@ -0,0 +1,199 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from batch_embed import iter_embedded_batches
+
+# Retrieval store for uploads too large for the prompt. All sessions share one Chroma
+# collection, with chunks tagged by session_id; a side database tracks per-session usage for
+# eviction and caches embeddings by chunk hash, so a file uploaded again (in any session)
+# is not embedded twice.
+SESSION_PERSIST_DIRECTORY = "./chroma_combined_db"
+# A Chroma server ("host:port") to use instead of the local directory, so several API server
+# workers see each other's uploads (see api_server.py)
+SESSION_CHROMA_URL = os.getenv("OPM_CHROMA_URL")
+SESSION_COLLECTION = "UPLOADS"
+SESSION_DB_PATH = "./cache/session_store.sqlite3"
+SESSION_IDLE_TIMEOUT = 2 * 60 * 60  # seconds without a query or upload before a session is dropped
+EVICTION_INTERVAL = 5 * 60  # seconds between idle checks on queries, so sessions left alone are dropped too
+SESSION_DISK_QUOTA = 500 * 1024 * 1024  # bytes of chunk text and vectors across all sessions
+EMBEDDING_CACHE_MAX_ENTRIES = 100000
+SESSION_CHUNK_SIZE = 1000
+SESSION_CHUNK_OVERLAP = 200
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class SessionStore:
+    def __init__(self, embeddings, model, persist_directory=SESSION_PERSIST_DIRECTORY,
+                 collection_name=SESSION_COLLECTION, db_path=SESSION_DB_PATH, idle_timeout=SESSION_IDLE_TIMEOUT,
+                 disk_quota=SESSION_DISK_QUOTA, clock=time.time):
+        import chromadb
+
+        self.embeddings = embeddings
+        self.model = model
+        self.idle_timeout = idle_timeout
+        self.disk_quota = disk_quota
+        self.clock = clock
+        self._next_eviction = clock() + EVICTION_INTERVAL  # after the eviction at the end of __init__
+        self._lock = threading.Lock()
+        if SESSION_CHROMA_URL:
+            host, _, port = SESSION_CHROMA_URL.rpartition(':')
+            client = chromadb.HttpClient(host=host, port=int(port))
+        else:
+            client = chromadb.PersistentClient(path=persist_directory)
+        self.collection = client.get_or_create_collection(collection_name, metadata={'embedding_model': model})
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                chunks INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, hash)
+            );
+        """)
+        self.evict()
+
+    def _cached_vectors(self, hashes):
+        vectors = {}
+        now = self.clock()
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                [self.model, *batch]).fetchall()
+            for hash_, vector in rows:
+                vectors[hash_] = np.frombuffer(vector, dtype=np.float32).tolist()
+            self._db.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                                 [(now, self.model, hash_) for hash_, _ in rows])
+        return vectors
+
+    def add_documents(self, session_id, texts, metadatas):
+        # Splits uploaded texts into chunks, each with the metadata of its text, and adds them.
+        # Returns the number of chunks.
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        chunks, chunk_metadatas = [], []
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=SESSION_CHUNK_SIZE,
+                                                       chunk_overlap=SESSION_CHUNK_OVERLAP)
+        for text, metadata in zip(texts, metadatas):
+            for chunk in text_splitter.split_text(text):
+                chunks.append(chunk)
+                chunk_metadatas.append(metadata)
+        embedded = self.add_texts(session_id, chunks, chunk_metadatas)
+        print(f"{len(chunks)} chunks added to the session store, {embedded} newly embedded")
+        return len(chunks)
+
+    def add_texts(self, session_id, texts, metadatas):
+        # Embeds (or reuses embeddings of) the chunks and adds them to the session. Returns the
+        # number of chunks that had to be embedded.
+        hashes = [chunk_hash(text) for text in texts]
+        ids = [f"{session_id}-{hash_}" for hash_ in hashes]
+        with self._lock:
+            vectors = self._cached_vectors(list(dict.fromkeys(hashes)))
+        missing = list(dict.fromkeys(text for text, hash_ in zip(texts, hashes) if hash_ not in vectors))
+        for start, batch_vectors in iter_embedded_batches(self.embeddings, missing):
+            now = self.clock()
+            rows = []
+            for text, vector in zip(missing[start:start + len(batch_vectors)], batch_vectors):
+                vectors[chunk_hash(text)] = vector
+                rows.append((self.model, chunk_hash(text), np.asarray(vector, dtype=np.float32).tobytes(), now))
+            with self._lock:
+                self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+                self._db.commit()
+
+        existing = set(self.collection.get(ids=list(dict.fromkeys(ids)), include=[])['ids'])
+        new = {}
+        for id_, text, hash_, metadata in zip(ids, texts, hashes, metadatas):
+            if id_ not in existing:
+                new[id_] = (text, hash_, {**metadata, 'session_id': session_id, 'hash': hash_})
+        new_ids = list(new)
+        for start in range(0, len(new_ids), 1000):
+            batch = new_ids[start:start + 1000]
+            self.collection.upsert(
+                ids=batch,
+                documents=[new[id_][0] for id_ in batch],
+                embeddings=[vectors[new[id_][1]] for id_ in batch],
+                metadatas=[new[id_][2] for id_ in batch],
+            )
+        size = sum(len(text.encode('utf-8')) + 4 * len(vectors[hash_]) for text, hash_, _ in new.values())
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions (session_id, bytes, chunks, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET bytes = bytes + excluded.bytes, "
+                "chunks = chunks + excluded.chunks, last_used = excluded.last_used",
+                (session_id, size, len(new), self.clock()))
+            self._db.commit()
+        self.evict(keep=session_id)
+        return len(missing)
+
+    def has_session(self, session_id):
+        # Asked for every question with a session, which makes it the tick for idle eviction
+        self.evict_if_due()
+        with self._lock:
+            row = self._db.execute("SELECT chunks FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return bool(row and row[0])
+
+    def search(self, session_id, embedding, k):
+        from langchain_core.documents import Document
+
+        with self._lock:
+            self._db.execute("UPDATE sessions SET last_used = ? WHERE session_id = ?", (self.clock(), session_id))
+            self._db.commit()
+        result = self.collection.query(query_embeddings=[embedding], n_results=k, where={'session_id': session_id},
+                                       include=['documents', 'metadatas'])
+        return [Document(id=id_, page_content=text, metadata=metadata or {})
+                for id_, text, metadata in zip(result['ids'][0], result['documents'][0], result['metadatas'][0])]
+
+    def clear_session(self, session_id):
+        self.collection.delete(where={'session_id': session_id})
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def evict_if_due(self):
+        with self._lock:
+            due = self.clock() >= self._next_eviction
+            if due:
+                self._next_eviction = self.clock() + EVICTION_INTERVAL
+        if due:
+            self.evict()
+
+    def evict(self, keep=None):
+        # Idle sessions first, then least recently used ones until the store is within its quota.
+        # The embedding cache is bounded separately by entry count.
+        with self._lock:
+            rows = self._db.execute("SELECT session_id, bytes, last_used FROM sessions "
+                                    "ORDER BY last_used").fetchall()
+            self._db.execute("DELETE FROM embeddings WHERE rowid NOT IN (SELECT rowid FROM embeddings "
+                             "ORDER BY last_used DESC LIMIT ?)", (EMBEDDING_CACHE_MAX_ENTRIES,))
+            self._db.commit()
+        total = sum(row[1] for row in rows)
+        cutoff = self.clock() - self.idle_timeout
+        for session_id, size, last_used in rows:
+            if session_id == keep or (last_used >= cutoff and total <= self.disk_quota):
+                continue
+            print(f"Evicting uploads of session {session_id} ({size / 1e6:.1f} MB)")
+            self.clear_session(session_id)
+            total -= size
+
+    def usage(self):
+        with self._lock:
+            sessions, size, chunks = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(chunks), 0) FROM sessions").fetchone()
+            cached = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {'sessions': sessions, 'bytes': size, 'chunks': chunks, 'cached_embeddings': cached}
@@ -0,0 +1,74 @@
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Time from launching the app until its health check passes, which is when Docker's HEALTHCHECK
+# marks the container ready. The Streamlit server answers before the app script runs, and the
+# API server before the chain is built; both only import what their routes need at startup.
+#   python startup_check.py               # streamlit run app.py
+#   python startup_check.py --api         # api_server.py
+# Exits with 1 if the median of the runs is over the budget.
+READINESS_BUDGET = 1.5  # seconds
+POLL_INTERVAL = 0.05
+STARTUP_TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_command(api, port):
+    if api:
+        return [sys.executable, "api_server.py", "--port", str(port)], f"http://127.0.0.1:{port}/health"
+    return ([sys.executable, "-m", "streamlit", "run", "app.py", f"--server.port={port}", "--server.headless=true"],
+            f"http://127.0.0.1:{port}/_stcore/health")
+
+
+def measure_readiness(command, url, timeout=STARTUP_TIMEOUT):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"{' '.join(command)} exited with {process.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(POLL_INTERVAL)
+        raise TimeoutError(f"{url} not ready after {timeout} s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the time until the app's health check passes")
+    parser.add_argument("--api", action="store_true", help="measure api_server.py instead of the Streamlit app")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--budget", type=float, default=READINESS_BUDGET, help="seconds")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    seconds = []
+    for run in range(args.runs):
+        command, url = server_command(args.api, free_port())
+        seconds.append(measure_readiness(command, url))
+        print(f"Run {run + 1}: ready in {seconds[-1]:.2f} s")
+    median = statistics.median(seconds)
+    print(f"Median {median:.2f} s, budget {args.budget:.2f} s")
+    if median > args.budget:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from deck_parser import NESTED_TABLES, TABLE_COLUMNS
+
+# Saturation and PVT tables of uploaded decks as NumPy arrays, one Table per keyword and table
+# number (saturation or PVT region). Defaulted values (1*) are filled by linear interpolation
+# along the first column, as the simulator does. Tables are checked column-wise for monotonicity
+# and range, and across keywords for consistent end points; charts are cached by table hash and
+# label so Streamlit reruns do not rebuild them.
+INCREASING, NON_DECREASING, NON_INCREASING, DECREASING = 2, 1, -1, -2
+# Direction of each column along the rows; for the nested tables (PVTO, PVTG) the outer column
+# is checked across the saturated rows and the other columns within each undersaturated block
+MONOTONICITY = {
+    "SWOF": {"SW": INCREASING, "KRW": NON_DECREASING, "KROW": NON_INCREASING, "PCOW": NON_INCREASING},
+    "SGOF": {"SG": INCREASING, "KRG": NON_DECREASING, "KROG": NON_INCREASING, "PCOG": NON_DECREASING},
+    "SLGOF": {"SL": INCREASING, "KRG": NON_INCREASING, "KROG": NON_DECREASING, "PCOG": NON_INCREASING},
+    "SGWFN": {"SG": INCREASING, "KRG": NON_DECREASING, "KRW": NON_INCREASING, "PCGW": NON_DECREASING},
+    "SWFN": {"SW": INCREASING, "KRW": NON_DECREASING, "PCOW": NON_INCREASING},
+    "SGFN": {"SG": INCREASING, "KRG": NON_DECREASING, "PCOG": NON_DECREASING},
+    "SOF2": {"SO": INCREASING, "KRO": NON_DECREASING},
+    "SOF3": {"SO": INCREASING, "KROW": NON_DECREASING, "KROG": NON_DECREASING},
+    "PVDG": {"P": INCREASING, "BG": DECREASING},
+    "PVDO": {"P": INCREASING, "BO": DECREASING},
+    "PVTO": {"RS": INCREASING, "P": INCREASING, "BO": DECREASING},
+    "PVTG": {"PG": INCREASING, "RV": DECREASING},
+}
+SATURATED_MONOTONICITY = {"PVTO": {"P": INCREASING}}
+SATURATION_TABLES = {"SWOF", "SGOF", "SLGOF", "SGWFN", "SWFN", "SGFN", "SOF2", "SOF3"}
+# Plotted against this column instead of the first one
+PLOT_X = {"PVTO": "P"}
+ENDPOINT_TOLERANCE = 1e-6
+CHART_CACHE_SIZE = 32
+
+DIRECTION_NAMES = {INCREASING: "is not increasing", NON_DECREASING: "decreases",
+                   NON_INCREASING: "increases", DECREASING: "is not decreasing"}
+
+_charts = OrderedDict()
+_charts_lock = threading.Lock()
+
+
+def fill_defaults(data):
+    # Defaulted (NaN) values are interpolated linearly in the first column, column by column
+    if not np.isnan(data).any():
+        return data
+    data = data.copy()
+    x = data[:, 0]
+    for j in range(1, data.shape[1]):
+        column = data[:, j]
+        missing = np.isnan(column)
+        if missing.any() and (~missing).sum() >= 2:
+            column[missing] = np.interp(x[missing], x[~missing], column[~missing])
+    return data
+
+
+def direction_violations(values, direction):
+    # Row indices (of the later row) where consecutive values break the expected direction
+    steps = np.diff(values)
+    if direction == INCREASING:
+        bad = steps <= 0
+    elif direction == NON_DECREASING:
+        bad = steps < 0
+    elif direction == NON_INCREASING:
+        bad = steps > 0
+    else:
+        bad = steps >= 0
+    return np.flatnonzero(bad & ~np.isnan(steps)) + 1
+
+
+def format_rows(rows, max_rows=5):
+    # 1-based row numbers as written in the deck
+    listed = ", ".join(str(row + 1) for row in rows[:max_rows])
+    return listed + (f" and {len(rows) - max_rows} more" if len(rows) > max_rows else "")
+
+
+class Table:
+    def __init__(self, keyword, region, data, deck_name=''):
+        self.keyword = keyword
+        self.region = region  # table number, 1-based
+        self.deck_name = deck_name
+        self.columns = TABLE_COLUMNS[keyword]
+        self.data = fill_defaults(np.ascontiguousarray(data, dtype=np.float64))
+        self.hash = hashlib.sha256(keyword.encode('utf-8') + self.data.tobytes()).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def label(self):
+        return f"{self.deck_name} {self.keyword} {self.region}".strip()
+
+    def column(self, name):
+        return self.data[:, self.columns.index(name)]
+
+    def saturated(self):
+        # The first row of each block of a nested table, i.e. the saturated conditions
+        if self.keyword not in NESTED_TABLES:
+            return self.data
+        outer = self.data[:, 0]
+        return self.data[np.r_[True, outer[1:] != outer[:-1]]]
+
+    def interpolate(self, x, column, by=None):
+        # `column` at x (a number or an array) by linear interpolation in `by` (default: the first
+        # column), clamped to the end values; nested tables use their saturated rows
+        rows = self.saturated()
+        xs = rows[:, self.columns.index(by or self.columns[0])]
+        return np.interp(x, xs, rows[:, self.columns.index(column)])
+
+    def scaled(self, low=None, high=None, maxima=None):
+        # Two-point end-point scaling of a saturation table: the saturation column is mapped
+        # linearly onto [low, high] and the columns named in `maxima` are scaled to those maxima
+        if self.keyword not in SATURATION_TABLES:
+            raise ValueError(f"{self.keyword} is not a saturation table")
+        data = self.data.copy()
+        saturation = data[:, 0]
+        first, last = saturation[0], saturation[-1]
+        low = first if low is None else low
+        high = last if high is None else high
+        if last > first:
+            data[:, 0] = low + (saturation - first) * (high - low) / (last - first)
+        for name, maximum in (maxima or {}).items():
+            j = self.columns.index(name)
+            current = np.nanmax(data[:, j])
+            if current > 0:
+                data[:, j] *= maximum / current
+        return Table(self.keyword, self.region, data, self.deck_name)
+
+    def validate(self):
+        issues = []
+        if len(self.data) < 2 and self.keyword in MONOTONICITY:
+            return [f"{self.label}: fewer than two rows"]
+        nested = self.keyword in NESTED_TABLES
+        if nested:
+            outer = self.data[:, 0]
+            same_block = np.r_[False, outer[1:] == outer[:-1]]
+        for name, direction in MONOTONICITY.get(self.keyword, {}).items():
+            j = self.columns.index(name)
+            if nested and j == 0:
+                rows = np.flatnonzero(~same_block)
+                bad = rows[direction_violations(self.data[rows, 0], direction)]
+            else:
+                bad = direction_violations(self.data[:, j], direction)
+                if nested:
+                    bad = bad[same_block[bad]]
+            if len(bad):
+                issues.append(f"{self.label}: {name} {DIRECTION_NAMES[direction]} at rows {format_rows(bad)}")
+        if nested:
+            saturated_rows = np.flatnonzero(~same_block)
+            for name, direction in SATURATED_MONOTONICITY.get(self.keyword, {}).items():
+                bad = direction_violations(self.data[saturated_rows, self.columns.index(name)], direction)
+                if len(bad):
+                    issues.append(f"{self.label}: saturated {name} {DIRECTION_NAMES[direction]} "
+                                  f"at rows {format_rows(saturated_rows[bad])}")
+        if self.keyword in SATURATION_TABLES:
+            kr = [j for j, name in enumerate(self.columns) if j == 0 or name.startswith("KR")]
+            values = self.data[:, kr]
+            bad = np.flatnonzero(((values < 0) | (values > 1)).any(axis=1))
+            if len(bad):
+                issues.append(f"{self.label}: saturations or relative permeabilities outside [0, 1] "
+                              f"at rows {format_rows(bad)}")
+        return issues
+
+
+class TableStore:
+    def __init__(self, tables=None):
+        self.tables = tables or []
+
+    @classmethod
+    def from_deck(cls, deck):
+        tables = []
+        for name in TABLE_COLUMNS:
+            for keyword in deck[name]:
+                tables.extend(Table(name, region, data, deck.name)
+                              for region, data in enumerate(keyword.tables(), 1))
+        return cls(tables)
+
+    @classmethod
+    def merge(cls, stores):
+        return cls([table for store in stores if store for table in store.tables])
+
+    def __len__(self):
+        return len(self.tables)
+
+    def keywords(self):
+        return list(dict.fromkeys(table.keyword for table in self.tables))
+
+    def plottable_keywords(self):
+        return [keyword for keyword in self.keywords() if keyword in MONOTONICITY]
+
+    def get(self, keyword, regions=None):
+        return [table for table in self.tables
+                if table.keyword == keyword and (regions is None or table.region in regions)]
+
+    def validate(self):
+        issues = [issue for table in self.tables for issue in table.validate()]
+        return issues + self.endpoint_issues()
+
+    def endpoint_issues(self):
+        # Per region: KRW (SWOF) and KRG (SGOF) are zero at the first saturation, SGOF starts at
+        # SG = 0, and KROG at SG = 0 equals KROW at connate water (the oil relative permeability
+        # with only connate water present). Compared for all regions at once.
+        issues = []
+        swof = {(table.deck_name, table.region): table for table in self.get("SWOF")}
+        sgof = {(table.deck_name, table.region): table for table in self.get("SGOF")}
+        for name, tables, column in (("SWOF", swof, "KRW"), ("SGOF", sgof, "KRG")):
+            if not tables:
+                continue
+            first = np.array([table.column(column)[0] for table in tables.values()])
+            for i in np.flatnonzero(np.abs(first) > ENDPOINT_TOLERANCE):
+                issues.append(f"{list(tables.values())[i].label}: {column} is {first[i]:g} at the first saturation, "
+                              f"expected 0")
+        if sgof:
+            first_sg = np.array([table.column("SG")[0] for table in sgof.values()])
+            for i in np.flatnonzero(np.abs(first_sg) > ENDPOINT_TOLERANCE):
+                issues.append(f"{list(sgof.values())[i].label}: the first SG is {first_sg[i]:g}, expected 0")
+        shared = [key for key in sgof if key in swof]
+        if shared:
+            krog = np.array([sgof[key].column("KROG")[0] for key in shared])
+            krow = np.array([swof[key].column("KROW")[0] for key in shared])
+            for i in np.flatnonzero(np.abs(krog - krow) > ENDPOINT_TOLERANCE):
+                issues.append(f"{sgof[shared[i]].label}: KROG at SG = 0 is {krog[i]:g} but KROW at connate water "
+                              f"in {swof[shared[i]].label} is {krow[i]:g}")
+        return issues
+
+
+def chart_groups(keyword):
+    # Relative permeabilities share a chart, as do capillary pressures; other columns get one each
+    columns = [column for column in TABLE_COLUMNS[keyword] if column != PLOT_X.get(keyword, TABLE_COLUMNS[keyword][0])]
+    groups = OrderedDict()
+    for column in columns:
+        group = "Relative permeability" if column.startswith("KR") else \
+            "Capillary pressure" if column.startswith("PC") else column
+        groups.setdefault(group, []).append(column)
+    return groups
+
+
+def _create_chart(tables):
+    import altair as alt
+
+    keyword = tables[0].keyword
+    x = PLOT_X.get(keyword, TABLE_COLUMNS[keyword][0])
+    charts = []
+    for i, (group, columns) in enumerate(chart_groups(keyword).items()):
+        values = []
+        for table in tables:
+            rows = table.saturated()
+            xs = rows[:, table.columns.index(x)]
+            for column in columns:
+                ys = rows[:, table.columns.index(column)]
+                values.extend({x: float(a), 'value': float(b), 'table': table.label, 'column': column}
+                              for a, b in zip(xs, ys))
+        charts.append(alt.Chart(alt.Data(values=values), title=group, height=220).mark_line(point=True).encode(
+            x=alt.X(f"{x}:Q", title=x),
+            y=alt.Y("value:Q", title=" / ".join(columns)),
+            color=alt.Color("table:N", title="Table"),
+            strokeDash=alt.StrokeDash("column:N", title="Column"),
+            tooltip=["table:N", "column:N", f"{x}:Q", "value:Q"],
+        ).interactive(name=f"zoom_{i}"))
+    title = keyword + (" (saturated)" if keyword in NESTED_TABLES else "")
+    return alt.vconcat(*charts, title=title)
+
+
+def table_chart(tables):
+    # Interactive Altair chart of tables of one keyword (several regions or decks), cached by
+    # the tables' hashes and labels (equal tables of two decks or regions are labelled apart)
+    key = tuple((table.hash, table.label) for table in tables)
+    with _charts_lock:
+        chart = _charts.get(key)
+        if chart is not None:
+            _charts.move_to_end(key)
+            return chart
+    chart = _create_chart(tables)
+    with _charts_lock:
+        _charts[key] = chart
+        while len(_charts) > CHART_CACHE_SIZE:
+            _charts.popitem(last=False)
+    return chart
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+# Offline: uploads are embedded with the local hashing model, and nothing is sent to an API server.
+# No trace file in the working directory.
+os.environ.setdefault("OPM_EMBEDDING_MODEL", "hashing:64")
+os.environ.pop("OPM_API_URL", None)
+os.environ["OPM_TRACE_FILE"] = ""
+
+PAGES = {
+    "WCONPROD": "WCONPROD sets the production controls of a producer well: BHP, oil rate, water rate.",
+    "COMPDAT": "COMPDAT defines the connections of a well to the grid cells it is completed in.",
+    "PORO": "PORO gives the porosity of every grid cell.",
+}
+
+
+@pytest.fixture
+def chain():
+    # The chain over a three-page manual, with the local stand-ins for the OpenAI models
+    import chromadb
+    from langchain_chroma import Chroma
+
+    from keyword_index import KeywordIndex
+    from local_models import FakeChatModel, HashingEmbeddings
+    from rag_chain import build_conversational_rag_chain
+
+    embeddings = HashingEmbeddings()
+    ids = list(PAGES)
+    metadatas = [{'title': title, 'source': f"{title}.html"} for title in ids]
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection("test_batch_answer", metadata={'hnsw:space': 'cosine'})
+    collection.upsert(ids=ids, embeddings=embeddings.embed_documents(list(PAGES.values())),
+                      documents=list(PAGES.values()), metadatas=metadatas)
+    index = KeywordIndex(ids, list(PAGES.values()), metadatas)
+    yield build_conversational_rag_chain(
+        "fake",
+        llm=FakeChatModel(),
+        embeddings=embeddings,
+        vector_store=Chroma(client=client, collection_name="test_batch_answer", embedding_function=embeddings),
+        load_keyword_index=lambda: index,
+    )
+    client.delete_collection("test_batch_answer")
@@ -0,0 +1,56 @@
+import time
+
+from langchain_core.documents import Document
+
+from answer_cache import AnswerCache
+
+QUESTION = [1.0, 0.0, 0.0]
+PARAPHRASE = [0.99, 0.05, 0.0]
+OTHER = [0.0, 1.0, 0.0]
+DOCUMENTS = [Document(id="wconprod-0", page_content="WCONPROD sets the producer controls",
+                      metadata={'title': "WCONPROD"})]
+
+
+def test_paraphrases_hit_for_the_same_model(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"))
+    cache.store("How do I control a producer?", QUESTION, "gpt-4o", "With WCONPROD.", DOCUMENTS)
+
+    hit = cache.lookup("How can I control a producer?", PARAPHRASE, "gpt-4o")
+    assert hit.answer == "With WCONPROD." and hit.similarity > 0.95
+    assert [doc.id for doc in hit.documents] == ["wconprod-0"] and hit.documents[0].metadata == DOCUMENTS[0].metadata
+    assert cache.lookup("What is PORO?", OTHER, "gpt-4o") is None
+    assert cache.lookup("How do I control a producer?", QUESTION, "gpt-4o-mini") is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'entries': 1, 'hit_rate': 1 / 3}
+
+
+def test_entries_expire(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), ttl=0.05)
+    cache.store("How do I control a producer?", QUESTION, "gpt-4o", "With WCONPROD.", DOCUMENTS)
+    assert cache.lookup("How do I control a producer?", QUESTION, "gpt-4o") is not None
+    time.sleep(0.1)
+    assert cache.lookup("How do I control a producer?", QUESTION, "gpt-4o") is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entries_are_dropped(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite3"), max_entries=1)
+    cache.store("How do I control a producer?", QUESTION, "gpt-4o", "With WCONPROD.", DOCUMENTS)
+    time.sleep(0.01)
+    cache.store("What is PORO?", OTHER, "gpt-4o", "Porosity.", [])
+    assert cache.lookup("How do I control a producer?", QUESTION, "gpt-4o") is None
+    assert cache.lookup("What is PORO?", OTHER, "gpt-4o").answer == "Porosity."
+
+
+def test_a_new_collection_version_drops_the_answers(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    version = ["v1"]
+    cache = AnswerCache(path, lambda: version[0])
+    cache.store("How do I control a producer?", QUESTION, "gpt-4o", "With WCONPROD.", DOCUMENTS)
+    # Another process opened with the same version shares the answers
+    assert AnswerCache(path, "v1").lookup("How do I control a producer?", QUESTION, "gpt-4o") is not None
+
+    version[0] = "v2"
+    assert cache.lookup("How do I control a producer?", QUESTION, "gpt-4o") is None
+    cache.store("How do I control a producer?", QUESTION, "gpt-4o", "With WCONPROD, item 3.", DOCUMENTS)
+    assert AnswerCache(path, "v2").lookup("How do I control a producer?", QUESTION, "gpt-4o").answer == \
+        "With WCONPROD, item 3."
@@ -0,0 +1,65 @@
+import pytest
+from starlette.testclient import TestClient
+
+import api_client
+import api_server
+import fake_llm_server
+from rag_chain import get_session_store
+
+HEADERS = {'Authorization': 'Bearer fake'}
+
+
+@pytest.fixture
+def fake_llm():
+    with TestClient(fake_llm_server.app) as client:
+        yield client
+
+
+def test_fake_llm_server_streams_chat_completions_to_the_openai_client(fake_llm):
+    from langchain_core.messages import HumanMessage, SystemMessage
+    from langchain_openai import ChatOpenAI
+
+    llm = ChatOpenAI(model="gpt-4o-mini", api_key="fake", base_url="http://testserver/v1", http_client=fake_llm)
+    messages = [SystemMessage("Context: WCONPROD sets producer controls."),
+                HumanMessage("How do I control a producer?")]
+    answer = "".join(chunk.content for chunk in llm.stream(messages))
+    assert answer == "Based on the manual, see WCONPROD for: How do I control a producer?"
+    assert llm.invoke(messages).content == answer
+
+
+def test_fake_llm_server_embeds_like_the_hashing_model(fake_llm):
+    from langchain_openai import OpenAIEmbeddings
+
+    from local_models import HashingEmbeddings
+
+    embeddings = OpenAIEmbeddings(model="text-embedding-3-small", api_key="fake", base_url="http://testserver/v1",
+                                  http_client=fake_llm, check_embedding_ctx_length=False)
+    vectors = embeddings.embed_documents(["porosity of a cell", "WCONPROD"])
+    assert len(vectors) == 2 and len(vectors[0]) == fake_llm_server.EMBEDDING_DIMENSIONS
+    assert vectors[0] == pytest.approx(HashingEmbeddings(fake_llm_server.EMBEDDING_DIMENSIONS).embed_query(
+        "porosity of a cell"))
+
+
+def test_uploads_are_stored_by_the_server_even_with_an_api_url(tmp_path, monkeypatch):
+    # A server started with OPM_API_URL (of itself) set must not post the upload on
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api_client, 'API_URL', "http://127.0.0.1:9")
+    text = "Notes on the water injector. " * 60
+    with TestClient(api_server.app) as client:
+        response = client.post('/sessions/s1/documents', headers=HEADERS,
+                               json={'texts': [text], 'metadatas': [{'source': 'notes.txt'}]})
+        assert response.status_code == 200
+        assert response.json()['chunks'] == 2
+        store = get_session_store('fake')
+        assert store.has_session('s1')
+
+        response = client.delete('/sessions/s1', headers=HEADERS)
+        assert response.json() == {'cleared': 's1'}
+        assert not store.has_session('s1')
+
+
+def test_uploads_need_an_api_key(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    with TestClient(api_server.app) as client:
+        response = client.post('/sessions/s1/documents', json={'texts': ["text"], 'metadatas': [{}]})
+    assert response.status_code == 401
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import batch_answer
+from batch_answer import BatchRunner, load_answered, load_items
+from rag_chain import get_history_store
+
+QUESTIONS = [
+    {"id": "q1", "question": "How do I control a producer with WCONPROD?", "session": "wells"},
+    {"id": "q2", "question": "Which of its items sets the oil rate?", "session": "wells"},
+    {"id": "q3", "question": "What is PORO?"},
+]
+
+
+class RecordingChain:
+    # Passes questions on to the chain, recording each with the chat history it was asked with,
+    # and stops the run like Ctrl-C once `interrupt_after` questions are answered
+    def __init__(self, chain, interrupt_after=None):
+        self.chain = chain
+        self.interrupt_after = interrupt_after
+        self.asked = []
+
+    def stream(self, inputs, config):
+        if self.interrupt_after is not None and len(self.asked) >= self.interrupt_after:
+            raise KeyboardInterrupt
+        session_id = config['configurable']['session_id']
+        history = [message.content for message in get_history_store().load(session_id).to_messages()]
+        self.asked.append((inputs['input'], history))
+        return self.chain.stream(inputs, config=config)
+
+
+def read_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_rerun_skips_answered_questions_and_restores_their_history(chain, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_answer, 'API_URL', None)
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text("".join(json.dumps(item) + "\n" for item in QUESTIONS), encoding='utf-8')
+    output = tmp_path / "answers.jsonl"
+    items = load_items(questions)
+
+    interrupted = RecordingChain(chain, interrupt_after=1)
+    with pytest.raises(KeyboardInterrupt):
+        BatchRunner(interrupted, "fake", output, tmp_path, model="fake").run(items, workers=1)
+    assert [record['id'] for record in read_records(output)] == ["q1"]
+    first_answer = read_records(output)[0]['answer']
+    with open(output, 'a', encoding='utf-8') as f:
+        f.write('{"id": "q2", "status": "o')  # the record being written when the run stopped
+
+    resumed = RecordingChain(chain)
+    done, pending = BatchRunner(resumed, "fake", output, tmp_path, model="fake").run(items, workers=1)
+
+    assert (done, pending) == (2, 2)
+    asked = dict(resumed.asked)
+    assert set(asked) == {QUESTIONS[1]['question'], QUESTIONS[2]['question']}
+    # The follow-up is asked with the turn answered before the interruption
+    assert asked[QUESTIONS[1]['question']] == [QUESTIONS[0]['question'], first_answer]
+    assert asked[QUESTIONS[2]['question']] == []
+    assert sorted(load_answered(output)) == ["q1", "q2", "q3"]
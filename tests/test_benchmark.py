@@ -0,0 +1,25 @@
+from benchmark import regressions, summarize
+
+
+def summary(recall, calibration, retrieve_ms):
+    timings = [{'retrieve': retrieve_ms / 1000, 'total': 2 * retrieve_ms / 1000}] * 3
+    results = [{'recall': recall, 'reciprocal_rank': recall}]
+    return summarize(timings, results, 4, calibration)
+
+
+def test_latency_is_compared_relative_to_the_calibration():
+    baseline = summary(0.8, 10.0, 20.0)
+    # A machine twice as slow: twice the latency is not a regression, three times is
+    assert regressions(summary(0.8, 20.0, 40.0), baseline, 0.02, 0.5) == []
+    problems = regressions(summary(0.8, 20.0, 70.0), baseline, 0.02, 0.5)
+    assert [problem.split()[0] for problem in problems] == ["retrieve", "total"]
+    # Without a calibration in the baseline only quality is gated
+    del baseline['calibration_ms']
+    assert regressions(summary(0.8, 20.0, 400.0), baseline, 0.02, 0.5) == []
+
+
+def test_recall_drop_is_a_regression():
+    baseline = summary(0.8, 10.0, 20.0)
+    assert regressions(summary(0.79, 10.0, 20.0), baseline, 0.02, 0.5) == []
+    assert regressions(summary(0.7, 10.0, 20.0), baseline, 0.02, 0.5) == ["recall@4 0.7 < baseline 0.8"]
+    assert regressions(summarize([], [], 8), baseline, 0.02, 0.5) == ["baseline is for k=4, run with k=8"]
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from chat_history import MemoryHistoryStore, SQLiteHistoryStore, compress_history
+from rag_chain import ConversationalRAG
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryHistoryStore(max_messages=6)
+    return SQLiteHistoryStore(str(tmp_path / "history.sqlite3"), max_messages=6)
+
+
+def add_turns(store, session_id, count, tokens=100):
+    for i in range(count):
+        store.append(session_id, [('human', f"question {i}", tokens), ('ai', f"answer {i}", tokens)])
+
+
+def test_histories_are_kept_per_session_and_capped(store):
+    add_turns(store, "a", 4)
+    add_turns(store, "b", 1)
+    history = store.load("a")
+    assert [message.content for message in history.messages] == [
+        "question 1", "answer 1", "question 2", "answer 2", "question 3", "answer 3"]
+    assert history.tokens == 600
+    assert len(store.load("b").messages) == 2
+    store.clear("a")
+    assert store.load("a").messages == [] and store.load("missing").summary == ''
+
+
+def test_compression_folds_whole_old_turns_into_the_summary(store):
+    add_turns(store, "a", 3)
+    folded = []
+
+    def summarize(summary, messages):
+        folded.append([message.content for message in messages])
+        return "summary of " + " ".join(message.content for message in messages)
+
+    assert compress_history(store, "a", summarize, len, budget=450)
+    assert folded == [["question 0", "answer 0"]]
+    history = store.load("a")
+    assert history.summary == "summary of question 0 answer 0"
+    assert [message.content for message in history.messages][0] == "question 1"
+    assert history.to_messages()[0].content == "Summary of the earlier conversation: summary of question 0 answer 0"
+    assert not compress_history(store, "a", summarize, len, budget=10000)
+
+
+def test_concurrent_compressions_of_a_session_apply_once(store):
+    add_turns(store, "a", 3)
+    both_loaded = threading.Barrier(2)
+
+    def summarize(summary, messages):
+        both_loaded.wait(timeout=5)  # both have read the same history before either writes
+        return f"summary {threading.current_thread().name}"
+
+    results = {}
+    threads = [threading.Thread(target=lambda name=name: results.update(
+        {name: compress_history(store, "a", summarize, len, budget=450)}), name=name) for name in ("x", "y")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results.values()) == [False, True]
+    history = store.load("a")
+    winner = next(name for name, applied in results.items() if applied)
+    assert history.summary == f"summary {winner}"
+    assert len(history.messages) == 4
+
+
+class SlowSummary:
+    # Stands in for the summarize chain, holding the first summary until released
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    def invoke(self, inputs):
+        self.calls += 1
+        self.release.wait(timeout=5)
+        return "summary"
+
+
+def test_one_compression_per_session_is_queued_at_a_time():
+    store = MemoryHistoryStore()
+    add_turns(store, "a", 20)
+    summarize_chain = SlowSummary()
+    chain = ConversationalRAG("fake", None, None, None, None, history_store=store, summarize_chain=summarize_chain)
+    chain._record_turn("a", "question", "answer")
+    chain._record_turn("a", "question", "answer")
+    summarize_chain.release.set()
+    chain._executor.shutdown(wait=True)
+    assert summarize_chain.calls == 1
+    assert store.load("a").summary == "summary"
@@ -0,0 +1,56 @@
+import chromadb
+import numpy as np
+import pytest
+
+from compact_index import build_compact_index, normalize, open_compact_index, quantize
+from keyword_index import KeywordIndex
+from local_models import HashingEmbeddings
+
+PAGES = {
+    "WCONPROD": "WCONPROD sets the production controls of a producer well",
+    "COMPDAT": "COMPDAT defines the connections of a well to the grid cells",
+    "PORO": "PORO gives the porosity of every grid cell",
+    "SWOF": "SWOF is the water-oil relative permeability table",
+}
+
+
+def test_quantize_round_trip():
+    vectors = normalize(np.random.default_rng(0).normal(size=(50, 64)))
+    quantized, scales = quantize(vectors)
+    assert quantized.dtype == np.int8 and np.abs(quantized).max() == 127
+    assert np.abs(quantized * scales[:, None] - vectors).max() <= scales.max() / 2 + 1e-6
+    zero, zero_scales = quantize(np.zeros((1, 4), dtype=np.float32))
+    assert not zero.any() and zero_scales[0] == 1
+
+
+@pytest.fixture
+def collection():
+    embeddings = HashingEmbeddings(64)
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection("test_compact_index", metadata={'hnsw:space': 'cosine'})
+    collection.upsert(ids=list(PAGES), embeddings=embeddings.embed_documents(list(PAGES.values())),
+                      documents=list(PAGES.values()), metadatas=[{'title': title} for title in PAGES])
+    yield collection
+    client.delete_collection("test_compact_index")
+
+
+def test_search_matches_the_collection(tmp_path, collection):
+    embeddings = HashingEmbeddings(64)
+    index = KeywordIndex.from_collection(collection)
+    build_compact_index(collection, index, str(tmp_path), "hashing:64", "v1", batch_size=3)
+    assert open_compact_index(str(tmp_path), "v2", lambda model: embeddings, lambda: index) is None
+
+    store = open_compact_index(str(tmp_path), "v1", lambda model: embeddings, lambda: index)
+    for title, text in PAGES.items():
+        expected = collection.query(query_embeddings=[embeddings.embed_query(text)], n_results=2)['ids'][0]
+        assert [doc.id for doc in store.similarity_search(text, k=2)] == expected
+        assert store.similarity_search(text, k=1)[0].metadata == {'title': title}
+
+
+def test_ids_hash_mismatch_is_an_error(tmp_path, collection):
+    index = KeywordIndex.from_collection(collection)
+    build_compact_index(collection, index, str(tmp_path), "hashing:64")
+    reordered = KeywordIndex(index.ids[::-1], index.texts[::-1], index.metadatas[::-1])
+    store = open_compact_index(str(tmp_path), "", lambda model: HashingEmbeddings(64), lambda: reordered)
+    with pytest.raises(RuntimeError, match="does not match the keyword index"):
+        store.similarity_search("porosity")
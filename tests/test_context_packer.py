@@ -0,0 +1,44 @@
+from langchain_core.documents import Document
+
+from context_packer import expand_to_parents, overlap_merge, pack_context
+from tokens import count_tokens
+
+PAGE = " ".join(f"COMPDAT item {i} sets property p{i * 37 % 101}." for i in range(100))
+
+
+def chunk(text, source="COMPDAT.html", **metadata):
+    return Document(page_content=text, metadata={'source': source, **metadata})
+
+
+def test_overlapping_chunks_of_a_page_are_merged():
+    first, second = PAGE[:600], PAGE[500:1100]
+    assert overlap_merge(first, second) == PAGE[:1100]
+    assert overlap_merge(first, PAGE[700:1100]) is None
+    # The later chunk ranked first: the group keeps its rank and the text is joined in page order
+    packed = pack_context([chunk(second), chunk("PORO gives the porosity.", "PORO.html"), chunk(first)])
+    assert [document.page_content for document in packed.documents] == [PAGE[:1100], "PORO gives the porosity."]
+    assert packed.merged == 1 and packed.saved_tokens > 0
+
+
+def test_near_duplicates_are_dropped_and_the_budget_is_kept():
+    copies = [chunk(PAGE[:800], "chapter4/COMPDAT.html"), chunk(PAGE[:790] + " Note.", "chapter12/COMPDAT.html"),
+              chunk("PORO gives the porosity of every cell.", "PORO.html"), chunk(PAGE[1200:2000], "WELSPECS.html")]
+    budget = count_tokens(PAGE[:800]) + count_tokens(copies[2].page_content)
+    packed = pack_context(copies, max_tokens=budget)
+    assert [document.metadata['source'] for document in packed.documents] == ["chapter4/COMPDAT.html", "PORO.html"]
+    assert packed.dropped == 2 and packed.packed_tokens <= budget
+
+
+def test_best_chunk_over_the_budget_is_cut():
+    packed = pack_context([chunk(PAGE)], max_tokens=300)
+    assert len(packed.documents) == 1 and PAGE.startswith(packed.documents[0].page_content)
+    assert packed.packed_tokens <= 300
+
+
+def test_chunks_of_a_short_page_are_expanded_to_the_page():
+    documents = [chunk("item 1", parent="compdat", part="items"), chunk("PORO", "PORO.html", parent="poro"),
+                 chunk("item 2", parent="compdat", part="items")]
+    expanded, pages = expand_to_parents(documents, {"compdat": "the COMPDAT page", "poro": "the PORO page"}.get)
+    assert [(document.id, document.page_content) for document in expanded] == \
+        [("compdat", "the COMPDAT page"), (None, "PORO")]
+    assert expanded[0].metadata['part'] == 'page' and pages == 1
@@ -0,0 +1,44 @@
+from contextualize import needs_contextualization
+from rag_chain import file_prompt
+
+HISTORY = ["How do I control a producer with WCONPROD?", "With the control mode in item 3."]
+QUESTION = "How do I set the oil rate limit of a producer with WCONPROD?"
+
+
+def test_needs_contextualization():
+    assert not needs_contextualization(QUESTION, [])
+    assert not needs_contextualization(QUESTION, HISTORY)
+    assert needs_contextualization("And for gas?", HISTORY)
+    assert needs_contextualization("Which of its items sets the oil rate?", HISTORY)
+    assert needs_contextualization("Why?", HISTORY)
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def invoke(self, inputs):
+        self.calls.append(inputs)
+        return inputs["input"]
+
+
+def test_file_context_is_not_classified(chain):
+    # The uploaded file is full of pronouns; only the question decides whether to rewrite
+    session_id = "test-file-context"
+    file_context = "The previous run failed. See the log above: it stopped at the same report step again."
+    chain.history_store.clear(session_id)
+    chain.history_store.append(session_id, [('human', HISTORY[0], 10), ('ai', HISTORY[1], 10)])
+    chain.contextualize_chain = Recorder()
+
+    chunks = list(chain.stream({"input": QUESTION, "file_context": file_context, "use_answer_cache": False},
+                               config={"configurable": {"session_id": session_id}}))
+
+    assert chain.contextualize_chain.calls == []
+    assert "contextualize_skipped" in chunks[-1]["timings"]
+    human = chain.history_store.load(session_id).messages[-2]
+    assert human.content == file_prompt(QUESTION, file_context)
+
+    list(chain.stream({"input": "Which of its items sets the water rate?", "use_answer_cache": False},
+                      config={"configurable": {"session_id": session_id}}))
+    assert len(chain.contextualize_chain.calls) == 1
+    chain.history_store.clear(session_id)
@@ -0,0 +1,36 @@
+from deck_context import (DeckSummary, is_deck_question, question_sections, select_deck_context, summarize_deck,
+                          summarize_keyword)
+from deck_parser import parse_deck_bytes
+from tokens import count_tokens
+
+DECK = ("RUNSPEC\nOIL\nWATER\nGRID\nPORO\n  1000*0.2 500*0.25 /\nPROPS\nSWOF\n  0.2 0 1 0\n  1.0 1 0 0 /\n"
+        "SCHEDULE\nWCONPROD\n  'PROD' 'OPEN' 'ORAT' 1000 /\n/\n").encode()
+
+
+def test_bulky_arrays_are_summarised():
+    deck = parse_deck_bytes(DECK, "case.data")
+    text, summarised = summarize_keyword(deck["PORO"][0])
+    assert summarised and "1500 values" in text and "min 0.2, max 0.25" in text
+    assert summarize_keyword(deck["SWOF"][0]) == ("SWOF\n-- SW KRW KROW PCOW\n0.2 0 1 0\n1 1 0 0 /", False)
+
+
+def test_blocks_relevant_to_the_question_are_packed_first():
+    summary = DeckSummary.from_dict(summarize_deck(parse_deck_bytes(DECK, "case.data")).to_dict())
+    assert question_sections("What controls do my producers have, as well as injectors?") == {"SCHEDULE"}
+
+    text, used, original = select_deck_context([summary], "Is the rate of WCONPROD right?", max_tokens=10 ** 6)
+    assert "omitted" not in text and original > used
+    # Room for the outline, the RUNSPEC blocks and WCONPROD, but not for PORO or SWOF as well
+    budget = count_tokens(summary.outline) + sum(block.tokens for block in summary.blocks
+                                                 if block.name in ("OIL", "WATER", "WCONPROD"))
+    text, used, _ = select_deck_context([summary], "Is the rate of WCONPROD right?", max_tokens=budget)
+    selected = text.split("Selected keywords from case.data:\n")[1]
+    assert used == budget and "WCONPROD" in selected and "SWOF" not in selected and "PORO" not in selected
+    assert selected.endswith("-- 2 keywords omitted")
+    # Selected blocks keep deck order, under their section
+    assert text.index("RUNSPEC\nOIL") < text.index("SCHEDULE\nWCONPROD")
+
+
+def test_deck_questions():
+    assert is_deck_question("Why does my deck fail to converge?")
+    assert not is_deck_question("How do I write a deck with WCONPROD?")
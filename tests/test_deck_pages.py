@@ -0,0 +1,59 @@
+from deck_pages import DeckPageCache
+from keyword_index import KeywordIndex
+
+CHUNKS = [
+    ("welspecs-0", "WELSPECS introduces wells", {'title': "WELSPECS", 'parent': "12.3/WELSPECS"}),
+    ("welspecs-1", "WELSPECS item 1 is the well name", {'title': "WELSPECS", 'parent': "12.3/WELSPECS"}),
+    ("compdat-0", "COMPDAT defines well connections", {'title': "COMPDAT", 'parent': "12.3/COMPDAT"}),
+    ("poro-0", "PORO is the porosity", {'title': "PORO", 'parent': "6.3/PORO"}),
+]
+
+
+class PageStore:
+    # keyword_chunker.PageStore's lookup, counting the pages fetched
+    def __init__(self, pages):
+        self.pages = pages
+        self.fetched = []
+
+    def get(self, parent):
+        self.fetched.append(parent)
+        return self.pages.get(parent)
+
+
+def keyword_index():
+    ids, texts, metadatas = zip(*CHUNKS)
+    return KeywordIndex(list(ids), list(texts), list(metadatas))
+
+
+def test_prefetch_only_fetches_the_pages_of_new_keywords():
+    index = keyword_index()
+    page_store = PageStore({"12.3/WELSPECS": "WELSPECS page", "12.3/COMPDAT": "COMPDAT page"})
+    cache = DeckPageCache()
+
+    pages = cache.prefetch("s1", ["WELSPECS", "NOPAGE"], index, page_store)
+    assert pages.chunk_set(["WELSPECS"]) == {0, 1}
+    assert pages.chunk_set(["NOPAGE"]) == set()
+    assert page_store.fetched == ["12.3/WELSPECS"]
+
+    assert cache.prefetch("s1", ["WELSPECS", "COMPDAT"], index, page_store) is pages
+    assert page_store.fetched == ["12.3/WELSPECS", "12.3/COMPDAT"]
+    assert pages.chunk_set(["WELSPECS", "COMPDAT"]) == {0, 1, 2}
+    assert pages.load_page("12.3/COMPDAT", page_store) == "COMPDAT page"
+    assert page_store.fetched == ["12.3/WELSPECS", "12.3/COMPDAT"]  # served from the session's pages
+
+    assert cache.prefetch("s1", ["WELSPECS", "COMPDAT"], index, page_store) is pages
+    assert len(page_store.fetched) == 2
+
+
+def test_least_recently_used_sessions_are_evicted():
+    index = keyword_index()
+    cache = DeckPageCache(max_sessions=2)
+    first = cache.prefetch("s1", ["PORO"], index)
+    cache.prefetch("s2", ["PORO"], index)
+    assert cache.prefetch("s1", [], index) is first  # s1 is now the most recently used
+    cache.prefetch("s3", ["PORO"], index)
+    assert cache.prefetch("s1", [], index) is first
+    assert cache.prefetch("s2", [], index).chunks == {}  # evicted, starts over
+
+    cache.clear("s1")
+    assert cache.prefetch("s1", [], index) is not first
@@ -0,0 +1,72 @@
+import numpy as np
+
+from deck_parser import include_names, parse_deck_bytes
+from process_file import included_deck_files, parse_file
+
+DECK = b"""RUNSPEC
+TITLE
+  Test deck
+GRID
+PORO
+  3*0.2 2*0.25 1* / -- defaulted last cell
+INCLUDE
+  'props/TABLES.INC' /
+SCHEDULE
+INCLUDE
+-- wells
+  'wells.sch' /
+"""
+TABLES = b"""PROPS
+PVTO
+  10  50 1.1 1.0
+      100 1.05 1.2 /
+  20  100 1.2 0.9 /
+/
+SWOF
+  0.2 0 1 0
+  1.0 1 0 0 /
+"""
+WELLS = b"""WCONPROD
+  'PROD' 'OPEN' 'ORAT' 1000 4* 50 /
+/
+"""
+FILES = {"CASE.DATA": DECK, "tables.inc": TABLES, "wells.sch": WELLS}
+
+
+def test_repeat_counts():
+    deck = parse_deck_bytes(DECK, "case.data", FILES)
+    poro = deck["PORO"][0].values
+    np.testing.assert_array_equal(poro[:5], [0.2, 0.2, 0.2, 0.25, 0.25])
+    assert len(poro) == 6 and np.isnan(poro[5])
+    record = deck["WCONPROD"][0].records[0]
+    assert record[:4] == ["PROD", "OPEN", "ORAT", 1000.0]
+    assert record[4:8] == [None] * 4 and record[8] == 50.0
+
+
+def test_includes_are_resolved_by_file_name():
+    deck = parse_deck_bytes(DECK, "case.data", FILES)
+    assert deck.includes == ["props/TABLES.INC", "wells.sch"]
+    assert deck.sections() == ["RUNSPEC", "GRID", "PROPS", "SCHEDULE"]
+    assert deck["SWOF"][0].section == "PROPS" and deck["SWOF"][0].file_name == "props/TABLES.INC"
+    assert parse_deck_bytes(DECK, "case.data", {"CASE.DATA": DECK}).missing_includes == ["props/TABLES.INC",
+                                                                                        "wells.sch"]
+
+
+def test_nested_pvto_tables():
+    deck = parse_deck_bytes(TABLES, "tables.inc")
+    (table,) = deck["PVTO"][0].tables()
+    np.testing.assert_array_equal(table, [[10, 50, 1.1, 1.0], [10, 100, 1.05, 1.2], [20, 100, 1.2, 0.9]])
+    np.testing.assert_array_equal(deck.tables("SWOF")[0]["KRW"], [0, 1])
+
+
+def test_included_files_are_not_summarised_again():
+    assert include_names(DECK) == ["tables.inc", "wells.sch"]
+    assert included_deck_files(FILES) == {"tables.inc", "wells.sch"}
+    # Files including each other, without a deck on top, are all kept
+    assert included_deck_files({"a.inc": b"INCLUDE\n 'b.inc' /\n", "b.inc": b"INCLUDE\n 'a.inc' /\n"}) == set()
+
+    result = parse_file("tables.inc", TABLES, FILES)
+    assert result.deck_summary is None and not result.content and not result.data
+    assert parse_file("tables.inc", TABLES, {"tables.inc": TABLES}).deck_summary is not None
+    summary = parse_file("CASE.DATA", DECK, FILES).deck_summary
+    assert {block.name for block in summary.blocks} >= {"PVTO", "SWOF", "WCONPROD"}
@@ -0,0 +1,51 @@
+import os
+import time
+
+import numpy as np
+
+from embeddings import CachedEmbeddings, EmbeddingCache, text_hash
+from local_models import HashingEmbeddings
+
+
+def vectors(start, count, dimensions=4):
+    return np.arange(start * dimensions, (start + count) * dimensions, dtype=np.float32).reshape(count, dimensions)
+
+
+def test_cache_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put(["a", "b", "a"], vectors(0, 3))
+    assert len(cache) == 2
+    found = cache.get(["a", "b", "c"])
+    assert set(found) == {"a", "b"}
+    np.testing.assert_array_equal(found["b"], vectors(1, 1)[0])
+
+
+def test_cache_keeps_recently_used_rows(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_rows=8)
+    other = EmbeddingCache(str(tmp_path), max_rows=8)  # another process, with the vectors mapped
+    hashes = [f"h{i}" for i in range(6)]
+    cache.put(hashes, vectors(0, 6))
+    assert set(other.get(hashes)) == set(hashes)
+    time.sleep(0.01)
+    cache.get(["h1", "h4"])
+
+    cache.put(["n0", "n1", "n2", "n3"], vectors(10, 4))
+
+    # Half of the limit kept, the least recently used rows dropped, and the old file removed
+    assert len(cache) == 8
+    assert sorted(os.listdir(tmp_path)) == ["index.sqlite3", "vectors.1.f32"]
+    for reader in (cache, other):
+        found = reader.get(hashes + ["n0", "n1", "n2", "n3"])
+        assert len(found) == 8 and {"h1", "h4"} <= set(found)
+        np.testing.assert_array_equal(found["h4"], vectors(4, 1)[0])
+        np.testing.assert_array_equal(found["n3"], vectors(13, 1)[0])
+
+
+def test_cached_embeddings_over_the_limit(tmp_path):
+    base = HashingEmbeddings(16)
+    embeddings = CachedEmbeddings(base, "hashing:16", EmbeddingCache(str(tmp_path), max_rows=4))
+    texts = [f"keyword {i}" for i in range(10)]
+    assert embeddings.embed_documents(texts) == base.embed_documents(texts)
+    assert len(embeddings.cache) <= 4
+    assert embeddings.embed_query(texts[-1]) == base.embed_query(texts[-1])
+    assert text_hash(texts[-1]) in embeddings.cache.get([text_hash(text) for text in texts])
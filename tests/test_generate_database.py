@@ -0,0 +1,49 @@
+import chromadb
+from langchain_core.documents import Document
+
+from generate_database import content_hash, plan_update, update_collection
+from local_models import HashingEmbeddings
+
+
+def page(source, text):
+    return Document(page_content=text, metadata={'source': source, 'title': source.upper()})
+
+
+def split(document):
+    # One chunk per sentence, with ids from the content as in html_documents_and_chunks
+    return [(content_hash(document.metadata['source'], sentence), page(document.metadata['source'], sentence))
+            for sentence in document.page_content.split(". ")]
+
+
+def test_only_changed_pages_are_embedded_and_stale_chunks_deleted():
+    documents = [page("poro", "PORO sets porosity. One value per cell"),
+                 page("permx", "PERMX sets permeability. One value per cell"),
+                 page("gone", "An old page")]
+    files, to_add, to_delete = plan_update(documents, {'files': {}}, split)
+    assert len(to_add) == 5 and to_delete == []
+
+    documents = [documents[0], page("permx", "PERMX sets permeability. In mD")]
+    new_files, to_add, to_delete = plan_update(documents, {'files': files}, split)
+    assert new_files["poro"] is files["poro"]
+    assert [chunk.page_content for _, chunk in to_add] == ["In mD"]
+    assert to_delete == sorted({*files["gone"]['chunks'], files["permx"]['chunks'][1]})
+
+
+def test_chunks_present_after_an_interrupted_run_are_not_embedded_again():
+    class CountingEmbeddings(HashingEmbeddings):
+        texts = []
+
+        def embed_documents(self, texts):
+            self.texts.extend(texts)
+            return super().embed_documents(texts)
+
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection("test_generate_database")
+    embeddings = CountingEmbeddings(16)
+    _, to_add, _ = plan_update([page("poro", "PORO sets porosity. One value per cell")], {'files': {}}, split)
+    update_collection(collection, embeddings, to_add[:1], [], batch_size=10, max_workers=1, requests_per_minute=0)
+    update_collection(collection, embeddings, to_add, [], batch_size=10, max_workers=1, requests_per_minute=0)
+    assert embeddings.texts == ["PORO sets porosity", "One value per cell"]
+    update_collection(collection, embeddings, [], [to_add[0][0]], batch_size=10, max_workers=1, requests_per_minute=0)
+    assert collection.get(include=[])['ids'] == [to_add[1][0]]
+    client.delete_collection("test_generate_database")
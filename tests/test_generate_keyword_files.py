@@ -0,0 +1,88 @@
+import json
+import os
+import stat
+import sys
+import time
+
+import generate_keyword_files
+
+# Stands in for libreoffice: writes <stem>.<format> for each file into --outdir, except for
+# files named BROKEN*, and logs every invocation
+STUB_CONVERTER = """#!{python}
+import json, os, sys
+
+args = sys.argv[1:]
+profile = next(arg for arg in args if arg.startswith("-env:UserInstallation="))
+fmt = args[args.index("--convert-to") + 1]
+outdir = args[args.index("--outdir") + 1]
+files = args[args.index("--outdir") + 2:]
+with open(os.environ["STUB_LOG"], "a") as f:
+    f.write(json.dumps({{"profile": profile, "format": fmt, "files": [os.path.basename(p) for p in files]}}) + "\\n")
+failed = False
+for path in files:
+    name = os.path.splitext(os.path.basename(path))[0]
+    if name.startswith("BROKEN"):
+        failed = True
+        continue
+    with open(os.path.join(outdir, name + "." + fmt), "w") as f:
+        f.write(fmt + " of " + name)
+sys.exit(1 if failed else 0)
+"""
+
+
+def write_stub(tmp_path):
+    path = tmp_path / "soffice"
+    path.write_text(STUB_CONVERTER.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def run(monkeypatch, tmp_path, converter, *options):
+    log = tmp_path / "calls.jsonl"
+    if log.exists():
+        log.unlink()
+    monkeypatch.setenv("STUB_LOG", str(log))
+    monkeypatch.setattr(sys, 'argv', [
+        "generate_keyword_files.py", "--source", str(tmp_path / "parts"), "--html-target", str(tmp_path / "html"),
+        "--txt-target", str(tmp_path / "txt"), "--journal", str(tmp_path / "journal.jsonl"),
+        "--converter", converter, "--workers", "2", "--batch-size", "2", *options])
+    generate_keyword_files.main()
+    if not log.exists():
+        return []
+    with open(log, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_conversion_is_batched_per_worker_profile_and_resumes(tmp_path, monkeypatch):
+    sources = {"5.3": ["DIMENS", "TABDIMS", "BROKEN"], "12.3": ["WCONPROD"]}
+    for chapter, names in sources.items():
+        os.makedirs(tmp_path / "parts" / chapter)
+        for name in names:
+            (tmp_path / "parts" / chapter / f"{name}.fodt").write_text(name)
+    converter = write_stub(tmp_path)
+
+    calls = run(monkeypatch, tmp_path, converter)
+    # One invocation per batch of at most two files of one format and directory
+    assert all(len(call['files']) <= 2 for call in calls)
+    assert sorted(name for call in calls for name in call['files']) == sorted(
+        f"{name}.fodt" for names in sources.values() for name in names for _ in ("html", "txt"))
+    assert len({call['profile'] for call in calls}) <= 2
+    for chapter, names in sources.items():
+        for name in names:
+            for fmt in ("html", "txt"):
+                assert (tmp_path / fmt / chapter / f"{name}.{fmt}").exists() == (name != "BROKEN")
+    with open(tmp_path / "journal.jsonl", 'r', encoding='utf-8') as f:
+        failed = [entry for entry in map(json.loads, f) if entry['status'] == 'failed']
+    assert sorted(os.path.basename(entry['source']) for entry in failed) == ["BROKEN.fodt", "BROKEN.fodt"]
+
+    # A rerun only retries the failures, and a changed source is converted again
+    assert sorted(name for call in run(monkeypatch, tmp_path, converter) for name in call['files']) == [
+        "BROKEN.fodt", "BROKEN.fodt"]
+    now = time.time()
+    for fmt in ("html", "txt"):
+        os.utime(tmp_path / fmt / "12.3" / f"WCONPROD.{fmt}", (now - 100, now - 100))
+    os.utime(tmp_path / "parts" / "12.3" / "WCONPROD.fodt", (now - 50, now - 50))
+    (tmp_path / "parts" / "5.3" / "BROKEN.fodt").unlink()
+    calls = run(monkeypatch, tmp_path, converter)
+    assert sorted(name for call in calls for name in call['files']) == ["WCONPROD.fodt", "WCONPROD.fodt"]
+    assert run(monkeypatch, tmp_path, converter) == []
@@ -0,0 +1,35 @@
+import base64
+import json
+import os
+import sys
+
+import generate_keyword_pages
+from generate_keyword_pages import IMAGE_DIRECTORY
+
+# A 1x1 GIF, padded so that writing it takes long enough for the workers to overlap
+IMAGE = base64.b64decode("R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw==") + bytes(1 << 20)
+PAGE = ('<html><head><style>p{{color:red}}</style></head><body>'
+        '<p style="margin:0"><span>{title}</span> <img src="data:image/gif;base64,{image}"/>'
+        '<img src="missing.png"/></p></body></html>')
+
+
+def test_pages_sharing_an_image_are_built_by_several_workers(tmp_path, monkeypatch):
+    titles = [f"KEYWORD{i}" for i in range(64)]
+    for i, title in enumerate(titles):
+        chapter = tmp_path / "html" / ("5.3" if i % 2 else "12.3")
+        chapter.mkdir(parents=True, exist_ok=True)
+        (chapter / f"{title}.html").write_text(PAGE.format(title=title, image=base64.b64encode(IMAGE).decode()))
+    output = tmp_path / "pages"
+    monkeypatch.setattr(sys, 'argv', ["generate_keyword_pages.py", "--html-directory", str(tmp_path / "html"),
+                                      "--output", str(output), "--workers", "4"])
+    generate_keyword_pages.main()
+
+    # One content-addressed image, no temporary files left behind
+    images = os.listdir(output / IMAGE_DIRECTORY)
+    assert len(images) == 1 and images[0].endswith(".gif")
+    assert (output / IMAGE_DIRECTORY / images[0]).read_bytes() == IMAGE
+    with open(output / "index.json", 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    assert sorted(index) == sorted(titles)
+    page = (output / index["KEYWORD1"]["5.3"]).read_text()
+    assert page == f'<p>KEYWORD1 <img src="app/static/keyword_pages/{IMAGE_DIRECTORY}/{images[0]}"></p>'
@@ -0,0 +1,55 @@
+from langchain_core.documents import Document
+
+from hybrid_retriever import HybridRetriever
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+CHUNKS = [
+    ("compdat-0", "COMPDAT connects a well to grid cells", {'title': "COMPDAT", 'source': "COMPDAT.html"}),
+    ("compdat-1", "COMPDAT item 7 is the well bore diameter", {'title': "COMPDAT", 'source': "COMPDAT.html"}),
+    ("wconprod-0", "WCONPROD sets the producer controls", {'title': "WCONPROD", 'source': "WCONPROD.html"}),
+    ("poro-0", "PORO gives the porosity of the grid cells", {'title': "PORO", 'source': "PORO.html"}),
+]
+
+
+class VectorStore:
+    # Returns the porosity page for any query, and counts the searches
+    embeddings = None
+
+    def __init__(self):
+        self.searches = 0
+
+    def similarity_search(self, query, k):
+        self.searches += 1
+        return [Document(id="poro-0", page_content=CHUNKS[3][1], metadata=CHUNKS[3][2])]
+
+
+def retriever(k=2):
+    ids, texts, metadatas = zip(*CHUNKS)
+    index = KeywordIndex(list(ids), list(texts), list(metadatas))
+    return HybridRetriever(vector_store=VectorStore(), load_keyword_index=lambda: index, k=k)
+
+
+def test_title_chunks_rank_within_the_page_and_interleave_pages():
+    index = retriever().load_keyword_index()
+    assert index.query_titles("What is COMPDAT item 7 and WCONPROD? NOTAKEYWORD") == ["COMPDAT", "WCONPROD"]
+    assert [index.ids[i] for i in index.title_chunks("COMPDAT item 7 or WCONPROD")] == \
+        ["compdat-1", "wconprod-0", "compdat-0"]
+
+
+def test_named_keywords_that_fill_k_skip_the_vector_search():
+    hybrid = retriever()
+    assert [doc.id for doc in hybrid.retrieve("COMPDAT item 7")] == ["compdat-1", "compdat-0"]
+    assert hybrid.vector_store.searches == 0
+
+
+def test_lexical_and_vector_results_are_fused():
+    hybrid = retriever(k=3)
+    ids = [doc.id for doc in hybrid.retrieve("which keyword sets the producer controls")]
+    assert hybrid.vector_store.searches == 1
+    # The porosity page is second in BM25 (on "the") and first in the vector search
+    assert ids[:2] == ["poro-0", "wconprod-0"]
+
+
+def test_reciprocal_rank_fusion():
+    assert reciprocal_rank_fusion([["a", "b"], ["b", "c"]]) == ["b", "a", "c"]
+    assert reciprocal_rank_fusion([["a", "b"], ["b", "a"]], weights=[2.0, 1.0]) == ["a", "b"]
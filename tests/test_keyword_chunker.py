@@ -0,0 +1,57 @@
+from keyword_chunker import PageStore, chunk_page, parse_page
+
+ITEMS = "".join(f"<tr><td>{i}</td><td>NAME{i}</td><td>Description of item {i} {'word ' * 20}</td><td>1*</td></tr>"
+                f"<tr><td></td><td>m</td><td>m</td><td>cm</td></tr>" for i in range(1, 9))
+PAGE = f"""<html><body>
+<table><tr><td>RUNSPEC</td><td>GRID</td><td>EDIT</td><td>PROPS</td><td>REGIONS</td><td>SOLUTION</td>
+<td>SUMMARY</td><td>SCHEDULE</td></tr></table>
+<h3>12.3.25 COMPDAT - Well completion data</h3>
+<h4>Description</h4>
+<p>COMPDAT defines the connections of a well to the grid.</p>
+<table><tr><th>No.</th><th>Name</th><th>Description</th><th>Default</th></tr>
+<tr><td>Field</td><td>Metric</td><td>Laboratory</td></tr>{ITEMS}
+<tr><td>Note 1: item 8 is only used with item 7 defaulted.</td></tr></table>
+<h4>Example</h4>
+<p>Two connections of PROD:</p>
+<p class="@example-western">COMPDAT<br/>  'PROD'  1  1  1  2  'OPEN' /<br/>/</p>
+</body></html>"""
+
+
+def page(tmp_path):
+    path = tmp_path / "12.3" / "compdat.html"
+    path.parent.mkdir()
+    path.write_text(PAGE)
+    return parse_page(str(path))
+
+
+def test_page_is_split_into_its_parts(tmp_path):
+    keyword_page = page(tmp_path)
+    assert keyword_page.title == "COMPDAT" and keyword_page.heading == "COMPDAT - Well completion data"
+    assert [part for part, _ in keyword_page.parts] == ['description', 'items', 'notes', 'example']
+    items = dict(keyword_page.parts)['items']
+    assert items[0] == ('items', [f"Item 1 NAME1: Description of item 1 {'word ' * 19}word Default: 1*.",
+                                  "Units: m / cm"])
+    assert dict(keyword_page.parts)['example'] == [('text', "Two connections of PROD:"),
+                                                   ('code', "COMPDAT\n  'PROD'  1  1  1  2  'OPEN' /\n/")]
+
+
+def test_item_rows_and_examples_are_never_split(tmp_path):
+    chunks = chunk_page(page(tmp_path), max_chars=400)
+    item_chunks = [chunk for chunk in chunks if chunk.metadata['part'] == 'items']
+    assert len(item_chunks) > 1
+    assert [chunk.metadata['items'] for chunk in item_chunks] == ["1-2", "3-4", "5-6", "7-8"]
+    assert item_chunks[1].page_content.startswith("COMPDAT - Well completion data\nItems 3-4\nItem 3 NAME3")
+    example = chunks[-1]
+    assert example.metadata['part'] == 'example' and example.page_content.endswith(
+        "Two connections of PROD:\nCOMPDAT\n  'PROD'  1  1  1  2  'OPEN' /\n/")
+    assert {chunk.metadata['section'] for chunk in chunks} == {"SCHEDULE"}
+    assert [chunk.metadata['chunk_index'] for chunk in chunks] == list(range(len(chunks)))
+
+
+def test_page_store_keeps_the_whole_page(tmp_path):
+    keyword_page = page(tmp_path)
+    store = PageStore(":memory:")
+    store.put([keyword_page])
+    assert store.get(keyword_page.source) == keyword_page.text()
+    store.delete_missing([])
+    assert store.get(keyword_page.source) is None
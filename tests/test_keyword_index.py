@@ -0,0 +1,23 @@
+from keyword_index import KeywordIndex
+
+CHUNKS = [
+    ("welspecs", "WELSPECS introduces a well and its group", {'title': "WELSPECS", 'section': "SCHEDULE"}),
+    ("compdat", "COMPDAT connects a well to grid cells", {'title': "COMPDAT", 'section': "SCHEDULE"}),
+    ("actnum", "ACTNUM marks the active grid cells", {'title': "ACTNUM", 'section': "GRID"}),
+    ("tops", "TOPS gives the depth of the top of the grid cells", {'title': "TOPS", 'section': "GRID"}),
+    ("title", "TITLE of the run, no cells here", {'title': "TITLE", 'section': "GLOBAL"}),
+]
+
+
+def keyword_index():
+    ids, texts, metadatas = zip(*CHUNKS)
+    return KeywordIndex(list(ids), list(texts), list(metadatas))
+
+
+def test_section_search_ranks_like_separate_searches():
+    index = keyword_index()
+    overall, in_sections = index.section_search("well grid cells", 3, ["SCHEDULE"])
+    assert overall == index.search("well grid cells", 3)
+    assert in_sections == index.search("well grid cells", 3, ["SCHEDULE"])
+    assert {index.ids[i] for i in in_sections} == {"welspecs", "compdat"}
+    assert index.section_search("well grid cells", 3, None)[1] == []
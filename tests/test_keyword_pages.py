@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from keyword_pages import (keyword_page_path, load_keyword_page_index, manual_keywords, manual_titles,
+                           render_keyword_page, scan_keywords)
+
+RAW_PAGE = "<html><head><style>p{color:red}</style></head><body><p>WELSPECS</p></body></html>"
+
+
+def write_manual(tmp_path):
+    html = tmp_path / "html_parts"
+    for chapter in ("4.3", "12.3"):
+        (html / chapter).mkdir(parents=True)
+        (html / chapter / "END.html").write_text(RAW_PAGE.replace("WELSPECS", "END"))
+    (html / "12.3" / "WELSPECS.html").write_text(RAW_PAGE)
+    (html / "12.3" / "index.html").write_text("<html></html>")
+    return html
+
+
+def test_unprocessed_pages_are_shown_without_the_built_pages(tmp_path, capsys):
+    html = write_manual(tmp_path)
+    pages = tmp_path / "keyword_pages"
+    load_keyword_page_index.cache_clear()
+    try:
+        index = load_keyword_page_index(str(pages), str(html))
+    finally:
+        load_keyword_page_index.cache_clear()
+    assert "run generate_keyword_pages.py" in capsys.readouterr().out
+    assert sorted(index) == ["END", "WELSPECS"]
+    assert sorted(index["END"]) == ["12.3", "4.3"]
+    assert render_keyword_page(index["WELSPECS"]["12.3"], str(pages)) == RAW_PAGE
+
+
+def test_built_pages_are_preferred_and_chosen_by_chapter(tmp_path):
+    html = write_manual(tmp_path)
+    pages = tmp_path / "keyword_pages"
+    (pages / "12.3").mkdir(parents=True)
+    (pages / "12.3" / "END.html").write_text("<p>END of SCHEDULE</p>")
+    (pages / "index.json").write_text(json.dumps({"END": {"4.3": "4.3/END.html", "12.3": "12.3/END.html"}}))
+    load_keyword_page_index.cache_clear()
+    try:
+        assert load_keyword_page_index(str(pages), str(html)) == json.loads((pages / "index.json").read_text())
+        path = keyword_page_path("END", "./txt_parts/chapters/subsections/12.3/END.txt", str(pages))
+        assert path == "12.3/END.html"
+        assert keyword_page_path("WELSPECS", "", str(pages)) is None
+        page = render_keyword_page(path, str(pages))
+        assert page.startswith("<html><head>") and page.endswith("<body><p>END of SCHEDULE</p></body></html>")
+    finally:
+        load_keyword_page_index.cache_clear()
+
+
+def test_scanner_finds_the_manual_keywords_of_a_text_in_order(tmp_path):
+    html = write_manual(tmp_path)
+    manual_titles.cache_clear()
+    try:
+        text = "WELSPECS\n 'P1' 'G1' 1 1 /\n/\n-- see UNKNOWN and the END\nwelspecs END"
+        assert scan_keywords(text, str(tmp_path / "keyword_pages"), str(html)) == ["WELSPECS", "END"]
+        assert manual_keywords(["END", "TSTEP", "END"], str(tmp_path / "keyword_pages"), str(html)) == ["END"]
+    finally:
+        manual_titles.cache_clear()
+
+
+def test_scanner_uses_the_built_pages_without_the_export(tmp_path):
+    pages = tmp_path / "keyword_pages"
+    pages.mkdir()
+    (pages / "index.json").write_text(json.dumps({"TSTEP": {"12.3": "12.3/TSTEP.html"}}))
+    manual_titles.cache_clear()
+    load_keyword_page_index.cache_clear()
+    try:
+        assert scan_keywords("TSTEP\n 10*30 /", str(pages), str(tmp_path / "html_parts")) == ["TSTEP"]
+    finally:
+        manual_titles.cache_clear()
+        load_keyword_page_index.cache_clear()
+
+
+def test_scanner_fails_without_any_manual_pages(tmp_path):
+    manual_titles.cache_clear()
+    try:
+        with pytest.raises(FileNotFoundError, match="generate_keyword_pages.py"):
+            scan_keywords("TSTEP", str(tmp_path / "keyword_pages"), str(tmp_path / "html_parts"))
+    finally:
+        manual_titles.cache_clear()
@@ -0,0 +1,62 @@
+import hashlib
+import io
+
+import pdf_extract
+from pdf_extract import PageCache, extract_pdf
+
+PAGES = [
+    "The WCONPROD keyword sets the production controls of each producer well in the schedule section " * 2,
+    "1.0 2.5 3.75 100 200 300 400 500 600 700 1e5 2e5",
+    "COMPDAT connects the wells to the grid cells they are completed in, one record per range of cells",
+]
+
+
+def make_pdf(texts):
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+    writer = PdfWriter()
+    font = DictionaryObject({NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+                             NameObject("/BaseFont"): NameObject("/Helvetica")})
+    for text in texts:
+        page = writer.add_blank_page(2000, 200)
+        page[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): DictionaryObject(
+            {NameObject("/F1"): writer._add_object(font)})})
+        stream = DecodedStreamObject()
+        stream.set_data(f"BT /F1 10 Tf 10 100 Td ({text}) Tj ET".encode())
+        page[NameObject("/Contents")] = writer._add_object(stream)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def test_number_pages_are_skipped_and_the_budget_cuts_the_last_page(tmp_path):
+    content = make_pdf(PAGES)
+    words = len(PAGES[0].split())
+
+    extract = extract_pdf(content, words + 5, cache=PageCache(str(tmp_path / "pages.sqlite3")))
+
+    assert extract.page_count == 3 and extract.skipped == 1 and extract.truncated
+    assert [page.number for page in extract.pages] == [0, 2]
+    assert extract.pages[1].text.split() == PAGES[2].split()[:5] and extract.words == words + 5
+
+
+def test_pages_are_cached_by_content(tmp_path, monkeypatch):
+    content = make_pdf(PAGES)
+    cache = PageCache(str(tmp_path / "pages.sqlite3"))
+    extract_pdf(content, 10, cache=cache)
+
+    page_count, cached = cache.get(hashlib.sha256(content).hexdigest())
+    assert page_count == 3 and cached[1][1] == 'numeric'
+    # Pages are extracted in batches, so the short document was cached whole and is not opened again
+    assert sorted(cached) == [0, 1, 2]
+    monkeypatch.setattr(pdf_extract, "_open_reader", None)
+    extract = extract_pdf(content, 1000, cache=cache)
+    assert not extract.truncated and [page.number for page in extract.pages] == [0, 2]
+
+
+def test_cache_keeps_the_most_recently_used_pages(tmp_path):
+    cache = PageCache(str(tmp_path / "pages.sqlite3"), max_pages=3)
+    cache.put("a", 2, [(0, "a0", 'text'), (1, "a1", 'text')])
+    cache.put("b", 2, [(0, "b0", 'text'), (1, "b1", 'text')])
+    assert len(cache.get("a")[1]) + len(cache.get("b")[1]) == 3
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from resource_cache import ResourceCache, ResourceKey, hash_api_key
+
+
+def key(name, collection='KEYWORDS'):
+    return ResourceKey('chain', name, hash_api_key('sk-test'), collection)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResourceCache(max_size=2)
+    cache.get_or_create(key('a'), lambda: 'A')
+    cache.get_or_create(key('b'), lambda: 'B')
+    cache.get_or_create(key('a'), lambda: 'not rebuilt')
+    cache.get_or_create(key('c'), lambda: 'C')
+    assert cache.keys() == [key('a'), key('c')]
+    assert cache.get_or_create(key('a'), lambda: 'not rebuilt') == 'A'
+
+
+def test_idle_entries_are_rebuilt():
+    cache = ResourceCache(idle_timeout=0.01)
+    cache.get_or_create(key('a'), lambda: 'old')
+    time.sleep(0.02)
+    assert cache.get_or_create(key('a'), lambda: 'new') == 'new'
+
+
+def test_concurrent_sessions_build_once():
+    cache = ResourceCache()
+    builds = []
+
+    def factory():
+        builds.append(1)
+        time.sleep(0.05)
+        return object()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_create(key('a'), factory)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1 and len({id(result) for result in results}) == 1
+
+
+def test_failed_build_releases_the_lock():
+    cache = ResourceCache()
+
+    def failing():
+        raise RuntimeError("no API key")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_create(key('a'), failing)
+    assert cache._building == {}
+    assert cache.get_or_create(key('a'), lambda: 'A') == 'A'
+
+
+def test_invalidate_by_field():
+    cache = ResourceCache()
+    cache.get_or_create(key('a'), lambda: 'A')
+    cache.get_or_create(key('b', 'OTHER'), lambda: 'B')
+    assert cache.invalidate(collection='KEYWORDS') == 1
+    assert cache.keys() == [key('b', 'OTHER')]
+    assert 'sk-test' not in repr(cache.keys())
@@ -0,0 +1,66 @@
+import pytest
+
+from local_models import HashingEmbeddings
+from session_store import EVICTION_INTERVAL, SessionStore
+
+IDLE_TIMEOUT = 3600
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def session_store(tmp_path, clock, **options):
+    return SessionStore(HashingEmbeddings(16), "hashing:16", persist_directory=str(tmp_path / "chroma"),
+                        collection_name="uploads", db_path=str(tmp_path / "sessions.sqlite3"),
+                        idle_timeout=IDLE_TIMEOUT, clock=clock, **options)
+
+
+def test_uploads_are_searched_per_session_and_embedded_once(tmp_path, clock):
+    store = session_store(tmp_path, clock)
+    assert store.add_texts("a", ["porosity of the reservoir", "well WELL1 rates"], [{'source': "a.txt"}] * 2) == 2
+    assert store.add_texts("b", ["porosity of the reservoir"], [{'source': "b.txt"}]) == 0  # cached embedding
+    results = store.search("b", store.embeddings.embed_query("porosity"), 4)
+    assert [(doc.page_content, doc.metadata['source']) for doc in results] == [("porosity of the reservoir", "b.txt")]
+    assert store.usage()['sessions'] == 2 and store.usage()['cached_embeddings'] == 2
+
+
+def test_idle_sessions_are_evicted_on_queries_of_other_sessions(tmp_path, clock):
+    store = session_store(tmp_path, clock)
+    store.add_texts("active", ["water injection"], [{}])
+    store.add_texts("left", ["gas cap"], [{}])
+
+    clock.now += IDLE_TIMEOUT - 10
+    store.search("active", store.embeddings.embed_query("water"), 1)
+    clock.now += EVICTION_INTERVAL
+    assert store.has_session("active")
+    assert not store.has_session("left")
+    assert store.collection.get(where={'session_id': "left"})['ids'] == []
+
+    # At most one idle check per interval: "active" turns idle just after a check
+    clock.now = 1000 + 2 * IDLE_TIMEOUT - 11
+    assert store.has_session("active")
+    clock.now += 2
+    assert store.has_session("active")
+    clock.now += EVICTION_INTERVAL
+    assert not store.has_session("active")
+
+
+def test_least_recently_used_sessions_are_evicted_over_the_quota(tmp_path, clock):
+    store = session_store(tmp_path, clock, disk_quota=400)
+    store.add_texts("first", ["x" * 100], [{}])
+    clock.now += 1
+    store.add_texts("second", ["y" * 100], [{}])
+    clock.now += 1
+    store.add_texts("third", ["z" * 100], [{}])
+    assert not store.has_session("first")
+    assert store.has_session("second") and store.has_session("third")
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from table_store import Table, TableStore, table_chart
+
+SWOF = [[0.2, 0.0, 0.9, 4.0],
+        [0.5, np.nan, 0.4, 1.0],
+        [0.8, 0.6, 0.0, 0.0]]
+SGOF = [[0.0, 0.0, 0.9, 0.0],
+        [0.3, 0.2, 0.3, 0.1],
+        [0.6, 0.7, 0.0, 0.3]]
+# Two saturated rows (RS 10 and 50), the second with an undersaturated block
+PVTO = [[10, 50, 1.10, 1.5],
+        [50, 100, 1.20, 1.0],
+        [50, 200, 1.18, 1.1]]
+
+
+def test_defaults_are_interpolated_along_the_first_column():
+    table = Table("SWOF", 1, SWOF)
+    assert table.column("KRW") == pytest.approx([0.0, 0.3, 0.6])
+    assert not np.isnan(table.data).any()
+
+
+def test_interpolation_is_clamped_and_uses_the_saturated_rows():
+    swof = Table("SWOF", 1, SWOF)
+    assert swof.interpolate(0.35, "KROW") == pytest.approx(0.65)
+    assert swof.interpolate([0.0, 1.0], "KROW") == pytest.approx([0.9, 0.0])
+    assert swof.interpolate(0.45, "SW", by="KRW") == pytest.approx(0.65)
+    pvto = Table("PVTO", 1, PVTO)
+    assert len(pvto.saturated()) == 2
+    assert pvto.interpolate(30, "BO") == pytest.approx(1.15)
+    assert pvto.interpolate(75, "RS", by="P") == pytest.approx(30)
+
+
+def test_scaling_maps_the_saturations_and_the_maxima():
+    scaled = Table("SWOF", 2, SWOF, "CASE").scaled(low=0.1, high=0.9, maxima={"KRW": 0.3, "KROW": 1.0})
+    assert scaled.column("SW") == pytest.approx([0.1, 0.5, 0.9])
+    assert scaled.column("KRW") == pytest.approx([0.0, 0.15, 0.3])
+    assert scaled.column("KROW") == pytest.approx([1.0, 0.4 / 0.9, 0.0])
+    assert (scaled.keyword, scaled.region, scaled.deck_name) == ("SWOF", 2, "CASE")
+    with pytest.raises(ValueError):
+        Table("PVDO", 1, [[100, 1.2, 1.0], [200, 1.1, 1.1]]).scaled(low=0.1)
+
+
+def test_validate_reports_direction_and_range_violations():
+    assert Table("SWOF", 1, SWOF).validate() == []
+    bad = Table("SWOF", 1, [[0.2, 0.0, 0.9, 4.0], [0.2, 0.5, 1.2, 5.0], [0.8, 0.4, 0.0, 0.0]], "CASE")
+    assert bad.validate() == [
+        "CASE SWOF 1: SW is not increasing at rows 2",
+        "CASE SWOF 1: KRW decreases at rows 3",
+        "CASE SWOF 1: KROW increases at rows 2",
+        "CASE SWOF 1: PCOW increases at rows 2",
+        "CASE SWOF 1: saturations or relative permeabilities outside [0, 1] at rows 2",
+    ]
+    assert Table("SWOF", 1, [[0.2, 0.0, 0.9, 0.0]]).validate() == ["SWOF 1: fewer than two rows"]
+
+
+def test_validate_checks_nested_tables_within_and_across_blocks():
+    assert Table("PVTO", 1, PVTO).validate() == []
+    # BO rising within the undersaturated block, and the saturated pressure falling with RS
+    bad = Table("PVTO", 1, [[10, 150, 1.10, 1.5], [50, 100, 1.20, 1.0], [50, 200, 1.21, 1.1]])
+    assert bad.validate() == ["PVTO 1: BO is not decreasing at rows 3",
+                              "PVTO 1: saturated P is not increasing at rows 2"]
+
+
+def test_end_points_are_checked_per_deck_and_region():
+    store = TableStore([Table("SWOF", 1, SWOF, "A"), Table("SGOF", 1, SGOF, "A")])
+    assert store.validate() == []
+    sgof = np.array(SGOF)
+    sgof[0, 1:3] = [0.1, 0.8]
+    swof = np.array(SWOF)
+    swof[0, 1] = 0.05
+    store = TableStore([Table("SWOF", 1, SWOF, "A"), Table("SGOF", 1, sgof, "A"),
+                        Table("SWOF", 1, swof, "B"), Table("SGOF", 2, SGOF, "B")])
+    assert store.endpoint_issues() == [
+        "B SWOF 1: KRW is 0.05 at the first saturation, expected 0",
+        "A SGOF 1: KRG is 0.1 at the first saturation, expected 0",
+        "A SGOF 1: KROG at SG = 0 is 0.8 but KROW at connate water in A SWOF 1 is 0.9",
+    ]
+
+
+def test_charts_of_equal_tables_keep_their_own_labels():
+    first = table_chart([Table("SWOF", 1, SWOF, "A")])
+    assert table_chart([Table("SWOF", 1, SWOF, "A")]) is first
+    other = table_chart([Table("SWOF", 1, SWOF, "B")])
+    assert other is not first
+    assert {row['table'] for row in other.vconcat[0].data.values} == {"B SWOF 1"}
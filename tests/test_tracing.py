@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+import tracing
+from tracing import start_trace
+
+
+def read_traces(path):
+    return [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+
+
+def test_trace_is_written_with_its_spans(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(path))
+    trace = start_trace("chat", session_id="s1")
+    with trace.stage("retrieve", sections=["GRID"]) as span:
+        span.set(chunk_ids=["a", "b"])
+    trace.event("contextualize_skipped")
+    trace.mark("first_token")
+    stages = trace.finish()
+    assert trace.finish() is stages  # exported once
+
+    (record,) = read_traces(path)
+    assert record["name"] == "chat" and record["status"] == "ok" and record["session_id"] == "s1"
+    assert [span["name"] for span in record["spans"]] == ["retrieve", "contextualize_skipped"]
+    assert record["spans"][0]["chunk_ids"] == ["a", "b"] and record["spans"][0]["sections"] == ["GRID"]
+    assert set(stages) == {"retrieve", "first_token", "total"}
+
+
+def test_failed_stage_and_sampling(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(path))
+    trace = start_trace("upload", sample_rate=1.0)
+    with pytest.raises(ValueError):
+        with trace.stage("parse"):
+            raise ValueError("bad deck")
+    trace.finish("error")
+    start_trace("upload", sample_rate=0.0).finish()
+
+    (record,) = read_traces(path)
+    assert record["status"] == "error" and record["spans"][0]["error"] == "ValueError('bad deck')"
+
+
+def test_export_never_fails_a_request(tmp_path, monkeypatch):
+    (tmp_path / "file").write_text("")
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(tmp_path / "file" / "traces.jsonl"))
+    assert "total" in start_trace("chat").finish()
+    monkeypatch.setattr(tracing, "TRACE_FILE", "")
+    start_trace("chat").finish()
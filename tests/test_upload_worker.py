@@ -0,0 +1,27 @@
+import rag_chain
+from process_file import MAX_CONTEXT_WORDS
+from upload_worker import start_upload, upload_key
+
+
+class Store:
+    def __init__(self, api_key, stored):
+        self.api_key = api_key
+        self.stored = stored
+
+    def add_documents(self, session_id, texts, metadatas):
+        self.stored.append((session_id, self.api_key, len(texts)))
+        return len(texts)
+
+
+def test_upload_is_stored_with_the_given_api_key(monkeypatch):
+    # The store runs in a worker thread, where there is no Streamlit session state to fall back to
+    stored = []
+    monkeypatch.setattr(rag_chain, "get_session_store", lambda api_key: Store(api_key, stored))
+    content = " ".join(f"word{i}" for i in range(MAX_CONTEXT_WORDS + 1)).encode()
+    key = upload_key("run.dbg", content)
+
+    tasks = [start_upload(key, "run.dbg", content, {"run.dbg": content}, "session-1", "sk-session-1"),
+             start_upload(key, "run.dbg", content, {"run.dbg": content}, "session-2", None)]
+
+    assert [not task.result().add_to_context for task in tasks] == [True, True]
+    assert sorted(stored) == [("session-1", "sk-session-1", 1), ("session-2", None, 1)]
@@ -0,0 +1,61 @@
+import time
+from contextlib import contextmanager
+
+# Cold-start timings, recorded once per process: Streamlit reruns the app script on every
+# interaction, so only the first measurement of each stage reflects real startup cost.
+STARTUP_TIMINGS = {}
+_report_printed = False
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS.setdefault(stage, time.perf_counter() - start)
+
+
+def startup_report():
+    lines = ["Startup timing report:"]
+    for stage, seconds in sorted(STARTUP_TIMINGS.items(), key=lambda item: -item[1]):
+        lines.append(f"  {stage:<50} {seconds * 1000:9.1f} ms")
+    lines.append(f"  {'total':<50} {sum(STARTUP_TIMINGS.values()) * 1000:9.1f} ms")
+    return "\n".join(lines)
+
+
+def print_startup_report_once():
+    global _report_printed
+    if not _report_printed and STARTUP_TIMINGS:
+        print(startup_report())
+        _report_printed = True
+
+
+class StageTimer:
+    # Per-turn timings of the chat pipeline stages, in seconds. Stages that run more than
+    # once in a turn accumulate.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def mark(self, name):
+        # Time from the start of the turn until now, e.g. for the first streamed token
+        self.stages.setdefault(name, time.perf_counter() - self.start)
+
+    def finish(self):
+        self.stages['total'] = time.perf_counter() - self.start
+        return self.stages
+
+    def summary(self):
+        return ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.stages.items())
@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+# Token counting with the model's real tokenizer (tiktoken). tiktoken downloads its encoding
+# files on first use; when that is not possible (air-gapped hosts) fall back to an estimate.
+DEFAULT_ENCODING = "o200k_base"  # gpt-4o and gpt-4o-mini
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=None):
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        print(f"Tokenizer unavailable ({type(e).__name__}), estimating token counts")
+        return None
+
+
+def count_tokens(text, model=None):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
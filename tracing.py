@@ -0,0 +1,184 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from timing import StageTimer
+
+# Per-request traces of the chat pipeline and uploads. A Trace is a StageTimer whose stages are
+# also kept as spans with attributes (token counts, retrieved chunk ids, cache hits). Finished
+# traces update Prometheus metrics (when prometheus_client is installed) and a sample of them is
+# appended to a JSON-lines file. Prompts, answers and retrieved text are only logged with
+# OPM_LOG_CONTEXT=1.
+TRACE_FILE = os.getenv("OPM_TRACE_FILE", "./cache/traces.jsonl")  # empty to disable
+TRACE_SAMPLE_RATE = float(os.getenv("OPM_TRACE_SAMPLE_RATE", "1.0"))
+TRACE_FILE_MAX_BYTES = 100 * 1024 * 1024  # then rotated to <file>.1
+LOG_CONTEXT = os.getenv("OPM_LOG_CONTEXT", "") == "1"
+METRICS_PORT = int(os.getenv("OPM_METRICS_PORT", "0"))  # for the Streamlit process; 0 to disable
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_metrics = None
+_metrics_server_started = False
+
+
+class Span:
+    def __init__(self, name, start, attributes):
+        self.name = name
+        self.start = start
+        self.duration = 0.0
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {'name': self.name, 'start_ms': round(self.start * 1000, 3),
+                'duration_ms': round(self.duration * 1000, 3), **self.attributes}
+
+
+class Trace(StageTimer):
+    def __init__(self, name, sample_rate=None, **attributes):
+        super().__init__()
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.status = 'ok'
+        self.sampled = random.random() < (TRACE_SAMPLE_RATE if sample_rate is None else sample_rate)
+        self._finished = False
+
+    @contextmanager
+    def stage(self, name, **attributes):
+        span = Span(name, time.perf_counter() - self.start, attributes)
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            span.duration = time.perf_counter() - self.start - span.start
+            self.spans.append(span)
+            self.record(name, span.duration)
+
+    def event(self, name, **attributes):
+        # A span without duration, e.g. a skipped stage or the first token
+        self.spans.append(Span(name, time.perf_counter() - self.start, attributes))
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, status=None):
+        if self._finished:
+            return self.stages
+        self._finished = True
+        self.status = status or self.status
+        stages = super().finish()
+        export(self)
+        return stages
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id, 'name': self.name, 'time': time.time(), 'status': self.status,
+                'duration_ms': round(self.stages.get('total', 0.0) * 1000, 3), **self.attributes,
+                'spans': [span.to_dict() for span in self.spans]}
+
+
+def start_trace(name, **attributes):
+    return Trace(name, **attributes)
+
+
+def document_ids(documents):
+    # Chroma ids where known, otherwise source and title
+    return [document.id or f"{document.metadata.get('source', '')}#{document.metadata.get('title', '')}"
+            for document in documents]
+
+
+def _create_metrics():
+    try:
+        from prometheus_client import Counter, Histogram
+    except ImportError:
+        print("prometheus_client not installed, metrics are not exported")
+        return False
+    return {
+        'requests': Counter('opm_requests_total', 'Finished traces', ['trace', 'status']),
+        'stages': Histogram('opm_stage_seconds', 'Duration of pipeline stages', ['trace', 'stage'],
+                            buckets=STAGE_BUCKETS),
+        'tokens': Counter('opm_tokens_total', 'Tokens counted in spans', ['trace', 'stage', 'kind']),
+        'cache': Counter('opm_cache_lookups_total', 'Cache lookups', ['stage', 'result']),
+    }
+
+
+def get_metrics():
+    global _metrics
+    with _lock:
+        if _metrics is None:
+            _metrics = _create_metrics()
+    return _metrics or None
+
+
+def _update_metrics(trace):
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    metrics['requests'].labels(trace.name, trace.status).inc()
+    for stage, seconds in trace.stages.items():
+        metrics['stages'].labels(trace.name, stage).observe(seconds)
+    for span in trace.spans:
+        for key, value in span.attributes.items():
+            if key.endswith('_tokens') and isinstance(value, (int, float)):
+                metrics['tokens'].labels(trace.name, span.name, key[:-len('_tokens')]).inc(value)
+        if 'cache_hit' in span.attributes:
+            metrics['cache'].labels(span.name, 'hit' if span.attributes['cache_hit'] else 'miss').inc()
+
+
+def _write_trace(trace, path=TRACE_FILE):
+    line = json.dumps(trace.to_dict(), default=str) + "\n"
+    with _lock:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path) > TRACE_FILE_MAX_BYTES:
+            os.replace(path, path + '.1')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def export(trace):
+    try:
+        _update_metrics(trace)
+        if trace.sampled and TRACE_FILE:
+            _write_trace(trace, TRACE_FILE)
+    except Exception as e:
+        # Tracing must never fail a request
+        print(f"Exporting trace {trace.name} failed: {e!r}")
+
+
+def metrics_response():
+    # (body, content type) in the Prometheus text format, or None without prometheus_client.
+    # Aggregates all worker processes when PROMETHEUS_MULTIPROC_DIR is set.
+    if get_metrics() is None:
+        return None
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server_once(port=METRICS_PORT):
+    # Streamlit has no route for /metrics, so the app serves them on a port of their own
+    global _metrics_server_started
+    with _lock:
+        if _metrics_server_started or not port:
+            return
+        _metrics_server_started = True
+    if get_metrics() is not None:
+        from prometheus_client import start_http_server
+
+        start_http_server(port)
+        print(f"Metrics served on port {port}")
@@ -0,0 +1,129 @@
+import hashlib
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Uploads are parsed in a process pool so a large PDF or deck does not block the Streamlit
+# script. Parse results are cached by content hash for all sessions in this server process;
+# adding chunks to the retrieval store (network bound) runs per session in a thread pool.
+UPLOAD_WORKERS = 2
+UPLOAD_STORE_WORKERS = 4
+UPLOAD_CACHE_ENTRIES = 32
+
+_lock = threading.Lock()
+_process_pool = None
+_thread_pool = None
+_parsed = OrderedDict()  # upload key -> future of the parse result
+
+
+def upload_key(name, content, files=None):
+    # The extension decides how a file is parsed; for decks the INCLUDEd files matter as well
+    from process_file import DECK_EXTENSIONS
+
+    extension = name.split('.')[-1].lower()
+    digest = hashlib.sha256(extension.encode('utf-8') + b'\0' + content)
+    if extension in DECK_EXTENSIONS:
+        for other_name, other_content in sorted((files or {}).items()):
+            if other_content is not content:
+                digest.update(other_name.lower().encode('utf-8') + b'\0')
+                digest.update(hashlib.sha256(other_content).digest())
+    return digest.hexdigest()
+
+
+def _pools(replace_broken=False):
+    global _process_pool, _thread_pool
+    with _lock:
+        if replace_broken and _process_pool is not None:
+            # A worker died (e.g. out of memory on a huge file); start a fresh pool
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+        if _process_pool is None:
+            # Not fork: the Streamlit server process is multi-threaded
+            _process_pool = ProcessPoolExecutor(UPLOAD_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _thread_pool = ThreadPoolExecutor(UPLOAD_STORE_WORKERS)
+    return _process_pool, _thread_pool
+
+
+def _parse(name, content, files):
+    from process_file import parse_file
+
+    result = parse_file(name, content, files)
+    result.deck = None  # the summary and tables are kept; the full arrays are not sent back
+    return result
+
+
+def submit_parse(key, name, content, files=None):
+    with _lock:
+        future = _parsed.get(key)
+        if future is not None and not (future.done() and future.exception() is not None):
+            _parsed.move_to_end(key)
+            return future
+    process_pool, _ = _pools()
+    try:
+        future = process_pool.submit(_parse, name, content, files)
+    except BrokenProcessPool:
+        process_pool, _ = _pools(replace_broken=True)
+        future = process_pool.submit(_parse, name, content, files)
+    with _lock:
+        _parsed[key] = future
+        while len(_parsed) > UPLOAD_CACHE_ENTRIES:
+            _parsed.popitem(last=False)
+    return future
+
+
+def _parse_and_store(parse_future, session_id, api_key, name, size):
+    from api_client import API_URL
+    from process_file import store_result
+    from tracing import start_trace
+
+    trace = start_trace("upload", session_id=session_id, file_type=name.split('.')[-1].lower(), bytes=size)
+    try:
+        # Parsing started when the task was submitted (or earlier, for a cached upload)
+        with trace.stage("parse") as span:
+            span.set(cached=parse_future.done())
+            result = parse_future.result()
+        with trace.stage("store") as span:
+            span.set(texts=len(result.database_texts), in_context=result.add_to_context,
+                     deck=result.deck_summary is not None)
+            store_result(result, session_id, api_key)
+        if result.keywords and not API_URL:
+            # With an API server the pages are fetched there, on the first question
+            from rag_chain import prefetch_deck_pages
+
+            with trace.stage("prefetch_pages") as span:
+                span.set(keywords=len(result.keywords))
+                prefetch_deck_pages(session_id, result.keywords)
+    except Exception:
+        trace.finish("error")
+        raise
+    trace.finish()
+    return result
+
+
+class UploadTask:
+    def __init__(self, key, name, parse_future, store_future):
+        self.key = key
+        self.name = name
+        self.parse_future = parse_future
+        self.store_future = store_future
+
+    @property
+    def status(self):
+        if self.store_future.done():
+            return 'failed' if self.store_future.exception() is not None else 'done'
+        return 'indexing' if self.parse_future.done() else 'parsing'
+
+    def result(self):
+        return self.store_future.result()
+
+    def error(self):
+        return self.store_future.exception()
+
+
+def start_upload(key, name, content, files, session_id, api_key):
+    parse_future = submit_parse(key, name, content, files)
+    _, thread_pool = _pools()
+    return UploadTask(key, name, parse_future, thread_pool.submit(_parse_and_store, parse_future, session_id, api_key,
+                                                                    name, len(content)))